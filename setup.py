@@ -60,4 +60,5 @@ setup(
     package_data={'wal_e': ['VERSION']},
 
     # install
-    entry_points={'console_scripts': ['wal-e=wal_e.cmd:main']})
+    entry_points={'console_scripts': ['wal-e=wal_e.cmd:main',
+                                      'wal-e-client=wal_e.client:main']})
@@ -0,0 +1,86 @@
+import gevent.socket
+import pytest
+
+from gevent.server import StreamServer
+
+from wal_e import agent
+from wal_e import client
+from wal_e.exception import UserException
+
+
+class FakeBackup(object):
+    def __init__(self):
+        self.pushed = []
+
+    def wal_archive(self, wal_path, concurrency=1, clear_xlog_tail=False):
+        if wal_path.endswith('broken'):
+            raise UserException(msg='could not push')
+
+        self.pushed.append(wal_path)
+
+    def wal_restore(self, wal_name, wal_destination, prefetch_max):
+        if wal_name == 'unexpected':
+            raise Exception('bogus')
+
+        return wal_name == '0' * 24
+
+
+@pytest.fixture
+def agent_socket(tmpdir, monkeypatch):
+    # The client uses blocking sockets, which would keep the agent
+    # from running in this same process.
+    monkeypatch.setattr(client, 'socket', gevent.socket)
+
+    socket_path = unicode(tmpdir.join('agent.sock'))
+    backup = FakeBackup()
+    a = agent.Agent(backup, socket_path, pool_size=1, prefetch_max=0)
+
+    server = StreamServer(agent.bind_unix_socket(socket_path), a.handle)
+    server.start()
+
+    yield socket_path, backup
+
+    server.stop()
+
+
+def test_push(agent_socket):
+    socket_path, backup = agent_socket
+
+    status = client.send(socket_path, {'op': 'wal-push', 'path': '/seg'})
+    assert status == agent.STATUS_OK
+    assert backup.pushed == ['/seg']
+
+    status = client.send(socket_path, {'op': 'wal-push', 'path': '/broken'})
+    assert status == agent.STATUS_FAILED
+
+
+def test_fetch(agent_socket):
+    socket_path, backup = agent_socket
+
+    def fetch(name):
+        return client.send(socket_path, {'op': 'wal-fetch', 'segment': name,
+                                         'destination': '/dest'})
+
+    assert fetch('0' * 24) == agent.STATUS_OK
+    assert fetch('1' * 24) == agent.STATUS_FAILED
+    assert fetch('unexpected') == agent.STATUS_UNEXPECTED
+
+
+def test_unknown_op(agent_socket):
+    socket_path, backup = agent_socket
+    assert client.send(socket_path, {'op': 'bogus'}) == agent.STATUS_FAILED
+
+
+def test_refuse_second_agent(agent_socket):
+    socket_path, backup = agent_socket
+
+    with pytest.raises(UserException):
+        agent.bind_unix_socket(socket_path)
+
+
+def test_socket_path_too_long(tmpdir):
+    socket_path = unicode(tmpdir.join('x' * agent.MAX_SOCKET_PATH))
+    assert not agent.socket_path_fits(socket_path)
+
+    with pytest.raises(UserException):
+        agent.bind_unix_socket(socket_path)
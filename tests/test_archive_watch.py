@@ -0,0 +1,145 @@
+import gevent
+import gevent.event
+import pytest
+
+from wal_e import inotify
+from wal_e.worker.pg import archive_watch
+from wal_e.worker.pg.archive_watch import ArchiveWatcher
+from wal_e.worker.pg.archive_watch import ReadyQueue
+
+
+class FakeUploader(object):
+    def __init__(self):
+        self.uploaded = []
+        self.release = gevent.event.Event()
+        self.release.set()
+
+    def __call__(self, segment):
+        self.release.wait()
+        self.uploaded.append(segment.name)
+        return segment
+
+
+@pytest.fixture()
+def xlog_dir(tmpdir):
+    d = tmpdir.join('pg_xlog')
+    d.join('archive_status').ensure(dir=True)
+    return d
+
+
+def make_ready(xlog_dir, name):
+    xlog_dir.join(name).write('segment')
+    xlog_dir.join('archive_status', name + '.ready').write('')
+
+
+def wait_for(predicate):
+    with gevent.Timeout(5):
+        while not predicate():
+            gevent.sleep(0.01)
+
+
+def seg_name(n):
+    return '00000001000000000000{0:04X}'.format(n)
+
+
+def test_ready_queue():
+    q = ReadyQueue()
+    for n in [3, 1, 2, 1]:
+        q.add(seg_name(n))
+
+    assert len(q) == 3
+    q.discard(seg_name(2))
+    assert seg_name(2) not in q
+
+    assert [q.pop() for i in xrange(len(q))] == [seg_name(1), seg_name(3)]
+
+
+def test_ready_segment_name():
+    assert archive_watch.ready_segment_name(seg_name(1) + '.ready') == \
+        seg_name(1)
+    assert archive_watch.ready_segment_name(seg_name(1) + '.done') is None
+    assert archive_watch.ready_segment_name('00000002.history.ready') is None
+
+
+@pytest.mark.parametrize('use_inotify', [True, False])
+def test_watch(xlog_dir, monkeypatch, use_inotify):
+    if use_inotify and not inotify.available():
+        pytest.skip('inotify is not available')
+
+    monkeypatch.setattr(inotify, 'available', lambda: use_inotify)
+    monkeypatch.setattr(archive_watch, 'POLL_INTERVAL', 0.05)
+
+    # Ready before the watcher starts.
+    for n in [2, 1]:
+        make_ready(xlog_dir, seg_name(n))
+
+    uploader = FakeUploader()
+    watcher = ArchiveWatcher(uploader, str(xlog_dir), concurrency=1)
+    g = gevent.spawn(watcher.run)
+    try:
+        wait_for(lambda: len(uploader.uploaded) == 2)
+
+        # Ready after the watcher started.
+        make_ready(xlog_dir, seg_name(3))
+        wait_for(lambda: len(uploader.uploaded) == 3)
+    finally:
+        g.kill()
+
+    assert uploader.uploaded == [seg_name(1), seg_name(2), seg_name(3)]
+
+    status_dir = xlog_dir.join('archive_status')
+    wait_for(lambda: len(status_dir.listdir('*.done')) == 3)
+    assert status_dir.listdir('*.ready') == []
+
+
+def test_archive_waits_for_upload(xlog_dir, monkeypatch):
+    monkeypatch.setattr(inotify, 'available', lambda: False)
+
+    make_ready(xlog_dir, seg_name(1))
+    make_ready(xlog_dir, seg_name(2))
+
+    uploader = FakeUploader()
+    uploader.release.clear()
+
+    watcher = ArchiveWatcher(uploader, str(xlog_dir), concurrency=1)
+    g = gevent.spawn(watcher.run)
+    try:
+        wait_for(lambda: watcher.uploading)
+        assert seg_name(1) in watcher.uploading
+        assert seg_name(2) in watcher.queue
+
+        # Postgres asks for both: the first is already being
+        # uploaded, the second only queued.
+        first = gevent.spawn(watcher.archive, str(xlog_dir.join(seg_name(1))))
+        second = gevent.spawn(watcher.archive,
+                              str(xlog_dir.join(seg_name(2))))
+        gevent.sleep(0.05)
+        assert seg_name(2) in watcher.uploading
+
+        uploader.release.set()
+        first.get(timeout=5)
+        second.get(timeout=5)
+
+        # Asking again for an archived segment is a no-op.
+        watcher.archive(str(xlog_dir.join(seg_name(1))))
+    finally:
+        g.kill()
+
+    assert sorted(uploader.uploaded) == [seg_name(1), seg_name(2)]
+
+    # Postgres marks segments it asked for done by itself.
+    status_dir = xlog_dir.join('archive_status')
+    assert len(status_dir.listdir('*.ready')) == 2
+
+
+def test_archive_error(xlog_dir, monkeypatch):
+    monkeypatch.setattr(inotify, 'available', lambda: False)
+
+    def broken(segment):
+        raise IOError('no space left on device')
+
+    watcher = ArchiveWatcher(broken, str(xlog_dir), concurrency=1)
+    make_ready(xlog_dir, seg_name(1))
+
+    with pytest.raises(IOError):
+        watcher.archive(str(xlog_dir.join(seg_name(1))))
@@ -0,0 +1,281 @@
+import hashlib
+import json
+import time
+
+import pytest
+
+from wal_e import storage
+from wal_e.worker import backup_index
+from wal_e.worker.backup_index import BackupIndex
+from wal_e.worker.base import _BackupList, _DeleteFromContext
+
+
+class FakeBlobstore(object):
+    """Objects in memory, with the MD5 of their content as ETag"""
+
+    def __init__(self):
+        self.objects = {}
+        self.conflicts = 0
+        self.failures = 0
+
+    def _etag(self, uri):
+        if uri not in self.objects:
+            return None
+        return hashlib.md5(self.objects[uri]).hexdigest()
+
+    def uri_get_tagged(self, creds, uri):
+        return self.objects.get(uri), self._etag(uri)
+
+    def uri_put_if_match(self, creds, uri, data, etag):
+        if self.failures:
+            self.failures -= 1
+            raise IOError('write denied')
+
+        if self.conflicts:
+            self.conflicts -= 1
+            return False
+
+        if self._etag(uri) != etag:
+            return False
+
+        self.objects[uri] = data
+        return True
+
+    def uri_put_file(self, creds, uri, fp, content_encoding=None):
+        self.objects[uri] = fp.read()
+
+
+class Key(object):
+    def __init__(self, name):
+        self.name = name
+        self.last_modified = '2016-01-01T00:00:00.000Z'
+
+
+class FakeStore(object):
+    def __init__(self, names):
+        self.names = set(names)
+        self.listed = []
+
+    def _backup_list(self, prefix):
+        self.listed.append(prefix)
+        return [Key(n) for n in sorted(self.names) if n.startswith(prefix)]
+
+    def _list_level(self, prefix):
+        self.listed.append(('level', prefix))
+        keys = []
+        directories = []
+        for n in sorted(self.names):
+            if not n.startswith(prefix):
+                continue
+
+            rest = n[len(prefix):]
+            if '/' in rest:
+                directory = prefix + rest.split('/', 1)[0] + '/'
+                if directory not in directories:
+                    directories.append(directory)
+            else:
+                keys.append(Key(n))
+
+        return keys, directories
+
+
+class BackupList(FakeStore, _BackupList):
+    def __init__(self, names, layout, index, detail=False):
+        FakeStore.__init__(self, names)
+        _BackupList.__init__(self, None, layout, detail, index=index)
+
+
+class FakeDeleter(object):
+    def __init__(self, store):
+        self.store = store
+
+    def delete(self, key):
+        self.store.names.remove(key.name)
+
+    def close(self):
+        pass
+
+
+class DeleteFromContext(FakeStore, _DeleteFromContext):
+    def __init__(self, names, layout, index):
+        FakeStore.__init__(self, names)
+        _DeleteFromContext.__init__(self, None, layout, False, index=index)
+        self.deleter = FakeDeleter(self)
+
+    def _container_name(self, key):
+        return self.layout.store_name()
+
+
+def backup_names(start):
+    base = 'p/basebackups_005/base_{0}_00000028'.format(start)
+    return [base + '_backup_stop_sentinel.json',
+            base + '/extended_version.txt',
+            base + '/tar_partitions/part_0.tar.lzo']
+
+
+def entry(start, **kwargs):
+    e = {'name': 'base_{0}_00000028'.format(start),
+         'last_modified': '2016-01-01T00:00:00.000Z',
+         'wal_segment_backup_start': start,
+         'wal_segment_offset_backup_start': '00000028',
+         'wal_segment_backup_stop': start,
+         'wal_segment_offset_backup_stop': '000000F8',
+         'expanded_size_bytes': 1024,
+         'partitions': 1}
+    e.update(kwargs)
+    return e
+
+
+@pytest.fixture
+def layout():
+    return storage.StorageLayout('s3://bucket/p')
+
+
+@pytest.fixture
+def blobstore():
+    return FakeBlobstore()
+
+
+@pytest.fixture
+def index(blobstore, layout):
+    return BackupIndex(blobstore, None, layout)
+
+
+def stored(blobstore):
+    return json.loads(blobstore.objects['s3://bucket/p/backup_index_005.json'])
+
+
+def test_list_then_index(layout, blobstore, index):
+    names = (backup_names('000000010000000000000002') +
+             backup_names('000000010000000000000009'))
+    expected = ['base_000000010000000000000002_00000028',
+                'base_000000010000000000000009_00000028']
+
+    # Without an index, backups are listed, but not indexed: listing
+    # is read-only.
+    bl = BackupList(names, layout, index)
+    assert [b.name for b in bl] == expected
+    assert bl.listed == [('level', 'p/basebackups_005/')]
+    assert blobstore.objects == {}
+
+    # Once indexed, the index is used instead.
+    index.backups()
+    assert index.rebuild([entry('000000010000000000000002'),
+                          entry('000000010000000000000009')])
+    bl = BackupList(names, layout, BackupIndex(blobstore, None, layout))
+    assert [b.name for b in bl] == expected
+    assert bl.listed == []
+
+
+def test_detail_from_index(layout, blobstore, index):
+    index.backups()
+    index.rebuild([entry('000000010000000000000002')])
+
+    bl = BackupList([], layout, index, detail=True)
+    [info] = list(bl)
+    assert info.wal_segment_offset_backup_stop == '000000F8'
+    assert info.expanded_size_bytes == 1024
+
+
+def test_stale_index(layout, blobstore, index, monkeypatch):
+    index.backups()
+    assert index.rebuild([entry('000000010000000000000002')])
+    assert index.backups() is not None
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time',
+                        lambda: now + backup_index.REBUILD_INTERVAL + 1)
+    assert index.backups() is None
+
+
+def test_rebuild_after_write(layout, blobstore, index):
+    assert index.backups() is None
+
+    # A backup is added after the listing started: the index is not
+    # rebuilt from the listing, which would miss it.
+    BackupIndex(blobstore, None, layout).update(
+        lambda entries: entries + [entry('000000010000000000000009')])
+    assert not index.rebuild([entry('000000010000000000000002')])
+    assert index.backups() is None
+
+    assert index.rebuild([entry('000000010000000000000002'),
+                          entry('000000010000000000000009')])
+    assert len(index.backups()) == 2
+
+
+def test_update_retries(layout, blobstore, index):
+    index.backups()
+    index.rebuild([entry('000000010000000000000002')])
+
+    blobstore.conflicts = backup_index.MAX_ATTEMPTS - 1
+    index.update(lambda entries: entries + [entry('000000010000000000000009')])
+    assert len(index.backups()) == 2
+
+    # An index that keeps changing is marked stale.
+    blobstore.conflicts = backup_index.MAX_ATTEMPTS
+    index.update(lambda entries: [])
+    assert index.backups() is None
+
+
+def test_delete_with_retention(layout, blobstore, index):
+    names = (backup_names('000000010000000000000002') +
+             backup_names('000000010000000000000009') +
+             backup_names('00000001000000000000000F'))
+
+    dc = DeleteFromContext(names, layout, index)
+    dc._wal_list = lambda horizon=None: []
+    dc.delete_with_retention(2)
+
+    assert dc.names == set(backup_names('000000010000000000000009') +
+                           backup_names('00000001000000000000000F'))
+    assert [e['name'] for e in stored(blobstore)['backups']] == [
+        'base_000000010000000000000009_00000028',
+        'base_00000001000000000000000F_00000028']
+
+    # Retention is then planned from the index.
+    dc = DeleteFromContext(dc.names, layout,
+                           BackupIndex(blobstore, None, layout))
+    dc._wal_list = lambda horizon=None: []
+    dc.delete_with_retention(1)
+
+    assert dc.names == set(backup_names('00000001000000000000000F'))
+    assert dc.listed == [
+        ('level', 'p/basebackups_005/'),
+        'p/basebackups_005/base_000000010000000000000009_00000028/']
+    assert [e['name'] for e in stored(blobstore)['backups']] == [
+        'base_00000001000000000000000F_00000028']
+
+
+def test_delete_despite_rebuild_failure(layout, blobstore, index):
+    names = (backup_names('000000010000000000000002') +
+             backup_names('000000010000000000000009'))
+
+    # Rebuilding the index fails, which does not stop the deletion.
+    blobstore.failures = 1
+    dc = DeleteFromContext(names, layout, index)
+    dc._wal_list = lambda horizon=None: []
+    dc.delete_with_retention(1)
+
+    assert dc.names == set(backup_names('000000010000000000000009'))
+    assert index.backups() is None
+
+
+def test_created_empty(layout):
+    class WabsLikeBlobstore(FakeBlobstore):
+        def uri_put_if_match(self, creds, uri, data, etag):
+            if etag is None:
+                self.objects.setdefault(uri, '')
+                return False
+
+            return FakeBlobstore.uri_put_if_match(self, creds, uri, data,
+                                                  etag)
+
+    blobstore = WabsLikeBlobstore()
+    index = BackupIndex(blobstore, None, layout)
+
+    # The empty index first created is taken for a missing one.
+    assert index.backups() is None
+    assert not index.rebuild([entry('000000010000000000000002')])
+    assert index.backups() is None
+    assert index.rebuild([entry('000000010000000000000002')])
+    assert len(index.backups()) == 1
@@ -0,0 +1,136 @@
+import pytest
+
+from wal_e import storage
+from wal_e.worker.base import _BackupList, _DeleteFromContext
+
+
+class Key(object):
+    def __init__(self, name):
+        self.name = name
+        self.last_modified = '2016-01-01T00:00:00.000Z'
+
+
+class FakeStore(object):
+    """Keys listed either recursively, or one level at a time"""
+
+    def __init__(self, names):
+        self.names = sorted(names)
+        self.listed = []
+
+    def _backup_list(self, prefix):
+        self.listed.append(prefix)
+        return [Key(n) for n in self.names if n.startswith(prefix)]
+
+    def _list_level(self, prefix):
+        keys = []
+        directories = []
+        for n in self.names:
+            if not n.startswith(prefix):
+                continue
+
+            rest = n[len(prefix):]
+            if '/' in rest:
+                directory = prefix + rest.split('/', 1)[0] + '/'
+                if directory not in directories:
+                    directories.append(directory)
+            else:
+                keys.append(Key(n))
+
+        return keys, directories
+
+
+class BackupList(FakeStore, _BackupList):
+    def __init__(self, names, layout):
+        FakeStore.__init__(self, names)
+        _BackupList.__init__(self, None, layout, False)
+
+
+class FakeDeleter(object):
+    def __init__(self):
+        self.deleted = []
+
+    def delete(self, key):
+        self.deleted.append(key.name)
+
+    def close(self):
+        pass
+
+
+class DeleteFromContext(FakeStore, _DeleteFromContext):
+    def __init__(self, names, layout):
+        FakeStore.__init__(self, names)
+        _DeleteFromContext.__init__(self, None, layout, False)
+        self.deleter = FakeDeleter()
+
+    def _container_name(self, key):
+        return self.layout.store_name()
+
+
+def backup_names(start, partitions=2):
+    base = 'p/basebackups_005/base_{0}_00000028'.format(start)
+    return ([base + '_backup_stop_sentinel.json',
+             base + '/extended_version.txt'] +
+            [base + '/tar_partitions/part_{0}.tar.lzo'.format(i)
+             for i in range(partitions)])
+
+
+@pytest.fixture
+def layout():
+    return storage.StorageLayout('s3://bucket/p')
+
+
+@pytest.fixture
+def names():
+    return (backup_names('000000010000000000000002') +
+            backup_names('000000010000000000000009') +
+            backup_names('00000001000000000000000F') +
+            ['p/wal_005/000000010000000000000002.lzo',
+             'p/wal_005/00000001000000000000000A.lzo'])
+
+
+def test_backup_list(layout, names):
+    bl = BackupList(names, layout)
+    assert [b.name for b in bl] == [
+        'base_000000010000000000000002_00000028',
+        'base_000000010000000000000009_00000028',
+        'base_00000001000000000000000F_00000028']
+
+    # Partitions are never listed.
+    assert bl.listed == []
+
+
+def test_delete_before(layout, names):
+    dc = DeleteFromContext(names, layout)
+    dc.delete_before(storage.SegmentNumber(log='00000000', seg='00000009'))
+
+    assert sorted(dc.deleter.deleted) == sorted(
+        backup_names('000000010000000000000002') +
+        ['p/wal_005/000000010000000000000002.lzo'])
+
+    # Only the contents of the deleted backup are listed.
+    assert dc.listed == [
+        'p/basebackups_005/base_000000010000000000000002_00000028/',
+        'p/wal_005/']
+
+
+def test_delete_with_retention(layout, names):
+    dc = DeleteFromContext(names, layout)
+    dc.delete_with_retention(2)
+
+    assert sorted(dc.deleter.deleted) == sorted(
+        backup_names('000000010000000000000002') +
+        ['p/wal_005/000000010000000000000002.lzo'])
+
+
+def test_delete_before_unexpected(layout, names):
+    dc = DeleteFromContext(
+        names + ['p/basebackups_005/unexpected/file',
+                 'p/basebackups_005/base_000000010000000000000002_00000028'
+                 '/unexpected'],
+        layout)
+    dc.delete_before(storage.SegmentNumber(log='00000000', seg='00000009'))
+
+    # Unexpected keys are left alone.
+    assert 'p/basebackups_005/unexpected/file' not in dc.deleter.deleted
+    assert ('p/basebackups_005/base_000000010000000000000002_00000028'
+            '/unexpected') not in dc.deleter.deleted
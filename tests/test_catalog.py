@@ -0,0 +1,213 @@
+import pytest
+
+from wal_e import storage
+from wal_e.worker.base import _BackupList, _DeleteFromContext
+from wal_e.worker.catalog import Catalog, CatalogKey, segment_number
+
+
+class FakeStore(object):
+    """Keys listed recursively, one level at a time, or in ranges"""
+
+    can_list_ranges = True
+
+    def __init__(self, names):
+        self.names = set(names)
+        self.listed = []
+
+    def _key(self, name):
+        return CatalogKey(name, len(name), '2016-01-01T00:00:00.000Z')
+
+    def _make_key(self, name, size, last_modified):
+        return CatalogKey(name, size, last_modified)
+
+    def _backup_list(self, prefix):
+        self.listed.append(prefix)
+        return [self._key(n) for n in sorted(self.names)
+                if n.startswith(prefix)]
+
+    def _list_level(self, prefix):
+        self.listed.append(('level', prefix))
+        keys = []
+        directories = []
+        for n in sorted(self.names):
+            if not n.startswith(prefix):
+                continue
+
+            rest = n[len(prefix):]
+            if '/' in rest:
+                directory = prefix + rest.split('/', 1)[0] + '/'
+                if directory not in directories:
+                    directories.append(directory)
+            else:
+                keys.append(self._key(n))
+
+        return keys, directories
+
+    def _list_range(self, prefix, start_after, end_before):
+        self.listed.append(('after', start_after))
+        return [self._key(n) for n in sorted(self.names)
+                if n.startswith(prefix) and n > start_after]
+
+    def _remote_wal_list(self, horizon=None):
+        return self._backup_list(prefix='p/wal_005/')
+
+
+class BackupList(FakeStore, _BackupList):
+    def __init__(self, names, layout, catalog):
+        FakeStore.__init__(self, names)
+        _BackupList.__init__(self, None, layout, False, catalog=catalog)
+
+
+class FakeDeleter(object):
+    def __init__(self, store):
+        self.store = store
+
+    def delete(self, key):
+        self.store.names.remove(key.name)
+
+    def close(self):
+        pass
+
+
+class DeleteFromContext(FakeStore, _DeleteFromContext):
+    def __init__(self, names, layout, catalog):
+        FakeStore.__init__(self, names)
+        _DeleteFromContext.__init__(self, None, layout, False,
+                                    catalog=catalog)
+        self.deleter = FakeDeleter(self)
+
+    def _container_name(self, key):
+        return self.layout.store_name()
+
+
+def backup_names(start, partitions=2):
+    base = 'p/basebackups_005/base_{0}_00000028'.format(start)
+    return ([base + '_backup_stop_sentinel.json',
+             base + '/extended_version.txt'] +
+            [base + '/tar_partitions/part_{0}.tar.lzo'.format(i)
+             for i in range(partitions)])
+
+
+def wal_names(*segments):
+    return ['p/wal_005/{0}.lzo'.format(s) for s in segments]
+
+
+@pytest.fixture
+def layout():
+    return storage.StorageLayout('s3://bucket/p')
+
+
+@pytest.fixture
+def catalog(tmpdir, layout):
+    return Catalog(str(tmpdir.join('catalog.db')), layout)
+
+
+def test_segment_number():
+    assert segment_number(
+        'p/wal_005/000000010000000200000003.lzo') == 0x200000003
+    assert segment_number(
+        'p/wal_005/000000010000000200000003.00000020.backup.lzo'
+    ) == 0x200000003
+    assert segment_number(
+        'p/basebackups_005/base_000000010000000200000003_00000028'
+        '_backup_stop_sentinel.json') == 0x200000003
+    assert segment_number('p/wal_005/00000002.history') is None
+
+
+def test_delete_before_incremental(layout, catalog):
+    names = (backup_names('000000010000000000000002') +
+             backup_names('000000010000000000000009') +
+             wal_names('000000010000000000000002',
+                       '00000001000000000000000A'))
+
+    dc = DeleteFromContext(names, layout, catalog)
+    dc.delete_before(storage.SegmentNumber(log='00000000', seg='00000009'))
+    assert sorted(dc.names) == sorted(
+        backup_names('000000010000000000000009') +
+        wal_names('00000001000000000000000A'))
+
+    # The deleted keys are forgotten.
+    assert set(name for name, _, _ in catalog.keys('p/')) <= dc.names
+
+    # A new backup and WAL files arrive.
+    names = (sorted(dc.names) +
+             backup_names('00000001000000000000000F') +
+             wal_names('00000001000000000000000B',
+                       '000000010000000000000010'))
+    dc = DeleteFromContext(names, layout, catalog)
+    dc.delete_with_retention(1)
+    assert sorted(dc.names) == sorted(
+        backup_names('00000001000000000000000F') +
+        wal_names('000000010000000000000010'))
+
+    # The base backups directory is listed once, and only the WAL
+    # files after the last one seen.  The backup now deleted had not
+    # been listed before, but those deleted earlier are not listed
+    # again.
+    assert dc.listed == [
+        ('level', 'p/basebackups_005/'),
+        ('after', 'p/wal_005/00000001000000000000000A.lzo'),
+        'p/basebackups_005/base_000000010000000000000009_00000028/']
+
+
+def test_incomplete_backup_relisted(layout, catalog):
+    in_progress = backup_names('000000010000000000000002')[1:]
+    dc = DeleteFromContext(in_progress, layout, catalog)
+    list(dc._keys(layout.basebackups()))
+
+    directory = 'p/basebackups_005/base_000000010000000000000002_00000028/'
+    assert directory in dc.listed
+
+    # The backup completes: its directory is listed once more, and
+    # not again after that.
+    for i in range(2):
+        dc = DeleteFromContext(
+            backup_names('000000010000000000000002', partitions=3),
+            layout, catalog)
+        keys = [k.name for k in dc._keys(layout.basebackups())]
+        assert (directory + 'tar_partitions/part_2.tar.lzo') in keys
+        assert (directory in dc.listed) == (i == 0)
+
+
+def test_backup_list(layout, catalog):
+    names = (backup_names('000000010000000000000002') +
+             backup_names('000000010000000000000009'))
+    bl = BackupList(names, layout, catalog)
+    assert [b.name for b in bl] == [
+        'base_000000010000000000000002_00000028',
+        'base_000000010000000000000009_00000028']
+
+    # Backups deleted by other means are gone, along with their
+    # contents.
+    bl = BackupList(names[len(names) // 2:], layout, catalog)
+    assert [b.name for b in bl] == [
+        'base_000000010000000000000009_00000028']
+    assert not [name for name, _, _ in catalog.keys('p/')
+                if '000000010000000000000002' in name]
+
+
+def test_reconcile(layout, catalog):
+    names = wal_names('000000010000000000000002',
+                      '000000010000000000000004')
+    dc = DeleteFromContext(names, layout, catalog)
+    dc._sync_catalog()
+
+    # A key archived out of order is only found by reconciling.
+    names.append(wal_names('000000010000000000000003')[0])
+    dc = DeleteFromContext(names, layout, catalog)
+    dc._sync_catalog()
+    assert [k.name for k in dc._wal_list()] == sorted(names)[::2]
+
+    catalog.reconcile(dc)
+    assert [k.name for k in dc._wal_list()] == sorted(names)
+
+
+def test_other_archive(tmpdir, layout, catalog):
+    dc = DeleteFromContext(wal_names('000000010000000000000002'), layout,
+                           catalog)
+    dc._sync_catalog()
+    catalog.close()
+
+    other = Catalog(str(tmpdir.join('catalog.db')),
+                    storage.StorageLayout('s3://bucket/other'))
+    assert list(other.keys('p/')) == []
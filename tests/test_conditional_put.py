@@ -0,0 +1,105 @@
+import itertools
+
+from azure import WindowsAzureConflictError
+from azure import WindowsAzureMissingResourceError
+from swiftclient.exceptions import ClientException
+
+from wal_e.blobstore.swift import utils as swift_utils
+from wal_e.blobstore.wabs import wabs_util
+
+_etags = itertools.count()
+
+
+class SwiftConnection(object):
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, container, name, data, headers=None):
+        if (headers or {}).get('If-None-Match') == '*' and \
+                name in self.objects:
+            raise ClientException('precondition failed', http_status=412)
+
+        self.objects[name] = (data, str(next(_etags)))
+
+    def head_object(self, container, name):
+        if name not in self.objects:
+            raise ClientException('not found', http_status=404)
+
+        return {'etag': self.objects[name][1]}
+
+    def delete_object(self, container, name):
+        if self.objects.pop(name, None) is None:
+            raise ClientException('not found', http_status=404)
+
+
+def test_swift_put_if_match():
+    conn = SwiftConnection()
+    uri = 'swift://container/p/index.json'
+
+    assert swift_utils.uri_put_if_match(None, uri, 'a', None, conn=conn)
+    assert not swift_utils.uri_put_if_match(None, uri, 'b', None, conn=conn)
+
+    etag = conn.head_object('container', '/p/index.json')['etag']
+    assert not swift_utils.uri_put_if_match(None, uri, 'b', 'other',
+                                            conn=conn)
+    assert swift_utils.uri_put_if_match(None, uri, 'b', etag, conn=conn)
+    assert conn.objects.keys() == ['/p/index.json']
+
+    # Another writer holds the lock.
+    etag = conn.head_object('container', '/p/index.json')['etag']
+    conn.put_object('container', '/p/index.json.lock', '')
+    assert not swift_utils.uri_put_if_match(None, uri, 'c', etag, conn=conn)
+    assert conn.objects['/p/index.json'][0] == 'b'
+
+
+class WabsConnection(object):
+    def __init__(self):
+        self.blobs = {}
+        self.leases = {}
+
+    def put_blob(self, container, name, data, blob_type, x_ms_lease_id=None):
+        if self.leases.get(name) != x_ms_lease_id:
+            raise WindowsAzureConflictError('leased')
+
+        self.blobs[name] = (data, str(next(_etags)))
+
+    def get_blob_properties(self, container, name):
+        if name not in self.blobs:
+            raise WindowsAzureMissingResourceError('not found')
+
+        data, etag = self.blobs[name]
+        return {'etag': etag, 'content-length': str(len(data))}
+
+    def lease_blob(self, container, name, action, x_ms_lease_id=None,
+                   x_ms_lease_duration=None):
+        if name not in self.blobs:
+            raise WindowsAzureMissingResourceError('not found')
+
+        if action == 'acquire':
+            if name in self.leases:
+                raise WindowsAzureConflictError('leased')
+            self.leases[name] = 'lease-' + name
+            return {'x-ms-lease-id': self.leases[name]}
+
+        assert self.leases.pop(name) == x_ms_lease_id
+
+
+def test_wabs_put_if_match():
+    conn = WabsConnection()
+    uri = 'wabs://container/p/index.json'
+
+    # Creating the blob cannot be guarded: an empty one is created,
+    # to be replaced under a lease.
+    assert not wabs_util.uri_put_if_match(None, uri, 'a', None, conn=conn)
+    data, etag = conn.blobs['/p/index.json']
+    assert data == ''
+
+    assert not wabs_util.uri_put_if_match(None, uri, 'a', None, conn=conn)
+    assert conn.blobs['/p/index.json'][1] == etag
+
+    assert wabs_util.uri_put_if_match(None, uri, 'a', etag, conn=conn)
+    assert conn.blobs['/p/index.json'][0] == 'a'
+    assert not conn.leases
+
+    assert not wabs_util.uri_put_if_match(None, uri, 'b', etag, conn=conn)
+    assert conn.blobs['/p/index.json'][0] == 'a'
@@ -0,0 +1,119 @@
+import contextlib
+import pytest
+
+from swiftclient.exceptions import ClientException
+
+from wal_e.blobstore import swift
+from wal_e.blobstore.connection_pool import ConnectionPool, pool
+from wal_e.blobstore.swift import calling_format
+from wal_e.blobstore.swift import utils as swift_utils
+
+
+class Counter(object):
+    def __init__(self):
+        self.made = 0
+
+    def __call__(self):
+        self.made += 1
+        return object()
+
+
+def test_reuse():
+    pool = ConnectionPool()
+    factory = Counter()
+
+    with pool.connection('a', factory) as first:
+        pass
+
+    with pool.connection('a', factory) as second:
+        assert second is first
+
+    assert factory.made == 1
+
+
+def test_keys_are_separate():
+    pool = ConnectionPool()
+    factory = Counter()
+
+    with pool.connection('a', factory) as a:
+        pass
+
+    with pool.connection('b', factory) as b:
+        assert b is not a
+
+    assert factory.made == 2
+
+
+def test_concurrent_checkouts():
+    """Connections in use are never handed out twice"""
+    pool = ConnectionPool()
+    factory = Counter()
+
+    with pool.connection('a', factory) as first:
+        with pool.connection('a', factory) as second:
+            assert first is not second
+
+    assert factory.made == 2
+
+
+def test_discard_after_error():
+    pool = ConnectionPool()
+    factory = Counter()
+
+    with pytest.raises(ValueError):
+        with pool.connection('a', factory):
+            raise ValueError('connection is in an unknown state')
+
+    with pool.connection('a', factory):
+        pass
+
+    assert factory.made == 2
+
+
+def test_max_idle():
+    pool = ConnectionPool(max_idle=1)
+    factory = Counter()
+
+    conns = [pool.checkout('a', factory) for i in xrange(3)]
+    for conn in conns:
+        pool.checkin('a', conn)
+
+    assert pool.checkout('a', factory) is conns[0]
+    pool.checkout('a', factory)
+    assert factory.made == 4
+
+
+class FakePipeline(object):
+    class stdin(object):
+        @staticmethod
+        def close():
+            pass
+
+    def abort(self):
+        pass
+
+
+def test_swift_reuse_after_missing(tmpdir, monkeypatch):
+    """A 404 is a complete response: the connection is reused"""
+    def missing(*args, **kwargs):
+        raise ClientException('not found', http_status=404)
+
+    @contextlib.contextmanager
+    def pipeline(*args, **kwargs):
+        yield FakePipeline()
+
+    factory = Counter()
+    monkeypatch.setattr(calling_format, 'connect', lambda creds: factory())
+    monkeypatch.setattr(swift_utils, 'uri_get_file', missing)
+    monkeypatch.setattr(swift_utils, 'get_download_pipeline', pipeline)
+    pool.clear()
+
+    creds = swift.Credentials('http://auth', 'user', 'password', 'tenant',
+                              'region', 'publicURL')
+    for i in xrange(2):
+        assert not swift_utils.do_lzop_get(
+            creds, 'swift://container/wal_005/missing.lzo',
+            str(tmpdir.join('missing')), False, do_retry=False)
+
+    assert factory.made == 1
+    pool.clear()
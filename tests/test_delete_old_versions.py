@@ -0,0 +1,27 @@
+from wal_e import storage
+from wal_e.operator.backup import Backup
+
+
+class FakeDeleteFromContext(object):
+    made = []
+
+    def __init__(self, conn, layout, dry_run, pool_size=1, catalog=None,
+                 index=None):
+        self.made.append((dry_run, pool_size))
+
+    def delete_everything(self):
+        pass
+
+
+class FakeWorker(object):
+    DeleteFromContext = FakeDeleteFromContext
+
+
+def test_delete_old_versions(monkeypatch):
+    backup = Backup(storage.StorageLayout('s3://bucket/p'), None, None)
+    backup.worker = FakeWorker
+    monkeypatch.setattr(backup, 'new_connection', lambda: None)
+
+    backup.delete_old_versions(True, pool_size=3)
+    assert FakeDeleteFromContext.made == [
+        (True, 3)] * len(storage.OBSOLETE_VERSIONS)
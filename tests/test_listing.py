@@ -0,0 +1,72 @@
+import gevent
+import pytest
+
+from wal_e.blobstore import swift
+from wal_e.blobstore.listing import prefetch_pages
+
+
+class Pages(object):
+    def __init__(self, pages):
+        self.pages = pages
+        self.requested = []
+
+    def __call__(self, marker):
+        self.requested.append(marker)
+        i = marker or 0
+        return self.pages[i], (i + 1 if i + 1 < len(self.pages) else None)
+
+
+def test_prefetch_pages():
+    pages = Pages([['a', 'b'], ['c'], ['d']])
+    items = prefetch_pages(pages)
+
+    assert items.next() == 'a'
+    gevent.sleep(0)
+
+    # The next page is on its way while the first is gone through.
+    assert pages.requested == [None, 1]
+    assert list(items) == ['b', 'c', 'd']
+    assert pages.requested == [None, 1, 2]
+
+
+def test_prefetch_pages_abandoned():
+    pages = Pages([['a'], ['b'], ['c']])
+    items = prefetch_pages(pages)
+    assert items.next() == 'a'
+    items.close()
+    gevent.sleep(0)
+
+    assert pages.requested == [None]
+
+
+def test_prefetch_pages_failure():
+    def broken(marker):
+        raise IOError('connection reset')
+
+    with pytest.raises(IOError):
+        list(prefetch_pages(broken))
+
+
+class FakeSwiftConnection(object):
+    def __init__(self, names):
+        self.names = names
+        self.http_conn = 'connected'
+
+    def get_container(self, container, prefix=None, marker=None,
+                      end_marker=None, delimiter=None):
+        assert self.http_conn is None
+        names = [n for n in self.names
+                 if (marker is None or n > marker) and
+                 (end_marker is None or n < end_marker)]
+        return {}, [{'name': n} for n in names[:2]]
+
+
+def test_swift_list_objects():
+    conn = FakeSwiftConnection(['/a', '/b', '/c', '/d', '/e'])
+
+    # Listings go on past pages shorter than the cluster's limit, and
+    # do not use the connection they are given.
+    listed = swift.list_objects(conn, 'container', '/', marker='/a',
+                                end_marker='/e')
+    assert [obj['name'] for obj in listed] == ['/b', '/c', '/d']
+    assert conn.http_conn == 'connected'
@@ -1,9 +1,11 @@
 import errno
+import itertools
 import os
 import pytest
 
-from wal_e.worker import prefetch
+from wal_e import pipeline
 from wal_e import worker
+from wal_e.worker import prefetch
 
 
 @pytest.fixture
@@ -109,3 +111,113 @@ def test_clear_error(pd, seg, monkeypatch, raise_eperm):
     pd.create(seg)
     monkeypatch.setattr(os, 'rmdir', raise_eperm)
     pd.clear()
+
+
+def test_cleanup_keeps_ahead(pd, seg):
+    """Segments ahead of the retained ones are not cleared"""
+    stream = seg.future_segment_stream()
+    nxt = stream.next()
+    ahead = stream.next()
+
+    for s in (seg, ahead):
+        pd.create(s)
+        with pd.download(s):
+            pass
+
+    pd.clear_except([nxt])
+    assert not pd.contains(seg)
+    assert pd.contains(ahead)
+
+    pd.clear_except([])
+    assert not pd.contains(ahead)
+
+
+def test_failed_download(pd, seg):
+    """A download marked as failed is not moved into place"""
+    pd.create(seg)
+
+    with pd.download(seg) as d:
+        d.failed = True
+
+    assert not pd.is_running(seg)
+    assert not pd.contains(seg)
+
+
+def test_transfer(pd, seg, tmpdir):
+    pd.create(seg)
+    with pd.download(seg):
+        pass
+
+    other = prefetch.Dirs(unicode(tmpdir.join('other')))
+    pd.transfer(other)
+
+    assert not pd.contains(seg)
+    assert other.contains(seg)
+
+
+def prefetched(pd, segment, contents, compressed=False):
+    pd.create(segment)
+    with pd.download(segment, compressed=compressed) as d:
+        d.tf.write(contents)
+
+
+def test_compressed(pd, seg, tmpdir, monkeypatch):
+    def cat_pipeline(in_fd, out_fd, gpg=False):
+        assert gpg
+        return pipeline.Pipeline([pipeline.CatFilter()], in_fd, out_fd)
+
+    monkeypatch.setattr(prefetch, 'get_download_pipeline', cat_pipeline)
+
+    prefetched(pd, seg, 'compressed', compressed=True)
+    assert pd.contains(seg)
+    assert os.path.exists(pd.complete_path(seg, compressed=True))
+
+    # The segment replay is at is kept, compressed or not.
+    pd.clear_except([seg])
+    assert pd.contains(seg)
+
+    dest = tmpdir.join('RECOVERYXLOG')
+    assert pd.promote(seg, unicode(dest), decrypt=True)
+    assert dest.read() == 'compressed'
+    assert not pd.contains(seg)
+
+
+def test_compressed_failure(pd, seg, tmpdir, monkeypatch):
+    def broken_pipeline(in_fd, out_fd, gpg=False):
+        out_fd.write('partial')
+        raise IOError('lzop: not a lzop file')
+
+    monkeypatch.setattr(prefetch, 'get_download_pipeline', broken_pipeline)
+
+    prefetched(pd, seg, 'damaged', compressed=True)
+    dest_dir = tmpdir.join('pg_xlog').ensure(dir=True)
+    dest = dest_dir.join('RECOVERYXLOG')
+
+    # Neither the damaged segment, nor a partial file, are left
+    # behind, so that the segment is downloaded again.
+    assert not pd.promote(seg, unicode(dest))
+    assert not pd.contains(seg)
+    assert dest_dir.listdir() == []
+
+
+def test_evict(pd, seg):
+    segs = [seg] + list(itertools.islice(seg.future_segment_stream(), 4))
+    for i, s in enumerate(segs):
+        prefetched(pd, s, 'x' * 10)
+
+        # Prefetched in reverse order.
+        t = 1000 - i
+        os.utime(pd.complete_path(s), (t, t))
+
+    assert pd.complete_size() == 50
+
+    # Behind replay, least recently prefetched first; then furthest
+    # ahead first.
+    pd.evict(40, segs[2])
+    assert [pd.contains(s) for s in segs] == [True, False, True, True, True]
+
+    pd.evict(20, segs[2])
+    assert [pd.contains(s) for s in segs] == [False, False, True, True, False]
+
+    pd.evict(0, segs[2])
+    assert pd.complete_size() == 0
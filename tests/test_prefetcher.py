@@ -0,0 +1,243 @@
+import gevent
+import gevent.event
+import pytest
+
+from wal_e import prefetcher
+from wal_e.worker import prefetch
+from wal_e.worker import WalSegment
+
+
+class FakeFetch(object):
+    def __init__(self):
+        self.fetched = []
+        self.contents = {}
+        self.release = gevent.event.Event()
+        self.release.set()
+
+    def __call__(self, base, segment_name, compressed=False):
+        pd = prefetch.Dirs(base)
+        seg = WalSegment(segment_name)
+        pd.create(seg)
+        with pd.download(seg) as d:
+            self.release.wait()
+            d.tf.write(self.contents.get(segment_name, segment_name))
+            self.fetched.append(segment_name)
+
+        return True
+
+
+def seg(n):
+    return WalSegment('00000001000000000000{0:04X}'.format(n))
+
+
+@pytest.fixture
+def fetch():
+    return FakeFetch()
+
+
+@pytest.fixture
+def pf(tmpdir, fetch):
+    return prefetch.Prefetcher(fetch, unicode(tmpdir), max_window=2)
+
+
+def test_advance(pf, fetch, monkeypatch):
+    # Instant downloads would shrink the window.
+    monkeypatch.setattr(pf, 'resize', lambda starved: None)
+
+    assert [s.name for s in pf.advance(seg(1))] == [seg(2).name,
+                                                     seg(3).name]
+    assert pf.wait(seg(2))
+    assert pf.wait(seg(3))
+
+    # Moving on removes what replay is past, and downloads only what
+    # is new.
+    pf.advance(seg(3))
+    assert pf.wait(seg(4))
+    assert not pf.pd.contains(seg(2))
+    assert fetch.fetched == [seg(n).name for n in [2, 3, 4, 5]]
+
+
+def test_resize(pf):
+    pf.max_window = 20
+    pf.window = 4
+
+    # Replay consumes a segment every second, and downloads take
+    # five: ten segments ahead keeps replay fed.
+    pf.interval = 1.0
+    pf.download_time = 5.0
+    pf.resize(starved=False)
+    assert pf.window == 10
+
+    # Slow replay only needs a segment or so ahead.
+    pf.interval = 60.0
+    pf.resize(starved=False)
+    assert pf.window == 1
+
+    # Replay waiting on a download always widens the window.
+    pf.resize(starved=True)
+    assert pf.window == 2
+
+    # The window stays within its bound.
+    pf.interval = 0.01
+    pf.resize(starved=False)
+    assert pf.window == 20
+
+
+def test_resize_unknown(pf):
+    # Without observations, only starvation changes the window.
+    assert pf.window == 2
+    pf.max_window = 5
+    pf.resize(starved=False)
+    assert pf.window == 2
+    pf.resize(starved=True)
+    assert pf.window == 3
+
+
+def test_observations(pf, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(prefetch.time, 'time', lambda: now[0])
+
+    pf.advance(seg(1))
+    assert pf.interval is None
+
+    now[0] += 10
+    pf.advance(seg(2))
+    assert pf.interval == 10
+    gevent.sleep(0)
+    assert pf.download_time == 0
+
+
+def test_wait_unknown(pf):
+    assert not pf.wait(seg(1))
+
+
+def test_wait_stalled(pf, fetch, monkeypatch):
+    monkeypatch.setattr(prefetch, 'STALL_TIMEOUT', 0.01)
+    fetch.release.clear()
+
+    pf.advance(seg(1))
+    assert not pf.wait(seg(2))
+
+
+def test_failed_download(pf, monkeypatch):
+    def broken(base, segment_name, compressed=False):
+        raise IOError('connection reset')
+
+    pf.fetch = broken
+    pf.advance(seg(1))
+    assert not pf.wait(seg(2))
+    assert pf.downloads == {}
+
+
+def test_server(pf, fetch):
+    server = prefetcher.PrefetchServer(pf)
+    g = gevent.spawn(server.serve, idle_timeout=1)
+    try:
+        with gevent.Timeout(5):
+            while prefetcher.ask(pf.pd, seg(1), 2) is None:
+                gevent.sleep(0.01)
+
+        # The segment after the one asked for first is prefetched.
+        assert prefetcher.ask(pf.pd, seg(2), 3)
+        assert pf.max_window == 3
+        assert prefetcher.ask(pf.pd, seg(3), 3)
+    finally:
+        g.kill()
+
+
+def test_server_bound_before_prefetching(pf, fetch):
+    listing = gevent.event.Event()
+
+    class SlowIndex(object):
+        def missing(self, name, max_age):
+            # As when listing the archive.
+            listing.wait()
+            return False
+
+    pf.index = SlowIndex()
+    server = prefetcher.PrefetchServer(pf)
+    g = gevent.spawn(server.serve, seg(1), idle_timeout=1)
+    try:
+        # wal-fetch reaches the prefetcher during the listing, and
+        # gets its answer once done.
+        asked = gevent.spawn(prefetcher.ask, pf.pd, seg(1), 2)
+        gevent.sleep(0.1)
+        assert not asked.ready()
+
+        listing.set()
+        with gevent.Timeout(5):
+            assert asked.get() is not None
+    finally:
+        g.kill()
+
+
+def test_server_idle_exit(pf):
+    server = prefetcher.PrefetchServer(pf)
+    server.serve(idle_timeout=0.01)
+    assert prefetcher.ask(pf.pd, seg(1), 2) is None
+
+
+def test_socket_path_too_long(tmpdir, fetch):
+    base = tmpdir.join('x' * 100).ensure(dir=True)
+    pf = prefetch.Prefetcher(fetch, unicode(base), max_window=2)
+    assert not prefetcher.available(pf.pd)
+
+    # The prefetcher gives up at once, instead of failing to bind
+    # once the first segments are downloaded.
+    prefetcher.PrefetchServer(pf).serve(seg(1), idle_timeout=1)
+    assert fetch.fetched == []
+
+
+def test_ask_nothing(tmpdir):
+    assert prefetcher.ask(prefetch.Dirs(unicode(tmpdir)), seg(1), 2) is None
+
+
+def test_skip_unarchived(pf, fetch, monkeypatch):
+    monkeypatch.setattr(pf, 'resize', lambda starved: None)
+
+    class FakeIndex(object):
+        def missing(self, name, max_age):
+            return name != seg(2).name
+
+    pf.index = FakeIndex()
+    pf.advance(seg(1))
+    assert pf.wait(seg(2))
+    assert not pf.wait(seg(3))
+    assert fetch.fetched == [seg(2).name]
+
+
+def test_budget(pf, fetch, monkeypatch):
+    monkeypatch.setattr(pf, 'resize', lambda starved: None)
+    monkeypatch.setattr(prefetch, 'SEGMENT_SIZE', 100)
+
+    # Room for one download in flight next to the segment replay is
+    # at.
+    pf.max_window = pf.window = 4
+    fetch(pf.pd.base, seg(1).name)
+    pf.budget = len(seg(1).name) + 100
+
+    pf.advance(seg(1))
+    assert pf.wait(seg(2))
+    assert not pf.wait(seg(3))
+
+    # Moving on frees up room.
+    pf.advance(seg(2))
+    assert pf.wait(seg(3))
+    assert fetch.fetched == [seg(n).name for n in [1, 2, 3]]
+
+
+def test_follow_history(pf, fetch, monkeypatch):
+    monkeypatch.setattr(pf, 'resize', lambda starved: None)
+    fetch.contents['00000002.history'] = (
+        '1\t0/3000090\tno recovery target specified\n')
+
+    # Postgres asks for the history file of the next timeline before
+    # switching to it.
+    history = WalSegment('00000002.history')
+    assert pf.advance(history) == []
+    assert pf.wait(history)
+    assert pf.history.tli == 2
+
+    assert [s.name for s in pf.advance(seg(1))] == [
+        '000000010000000000000002', '000000020000000000000003']
+    assert pf.wait(WalSegment('000000020000000000000003'))
@@ -0,0 +1,168 @@
+import contextlib
+import hashlib
+import os
+
+import pytest
+
+from wal_e import storage
+from wal_e.blobstore import BlobStat
+from wal_e.worker import upload
+from wal_e.worker import WalSegment
+from wal_e.worker.push_cache import PushCache
+
+SEGMENT_NAME = '000000010000000000000002'
+
+
+@pytest.fixture()
+def seg_path(tmpdir):
+    p = tmpdir.join('pg_xlog', SEGMENT_NAME)
+    p.write('segment contents', ensure=True)
+    return str(p)
+
+
+def compress(local_path, fp):
+    with open(local_path) as f:
+        fp.write('compressed ' + f.read())
+
+
+def store(cache, name, fingerprint, write):
+    with cache.writing(name, fingerprint) as fp:
+        write(fp)
+
+    return cache.lookup(name, fingerprint)
+
+
+def test_store_lookup(seg_path):
+    cache = PushCache(os.path.dirname(seg_path))
+    fingerprint = cache.fingerprint(seg_path, gpg_key_id=None)
+
+    assert cache.lookup(SEGMENT_NAME, fingerprint) is None
+
+    entry = store(cache, SEGMENT_NAME, fingerprint,
+                  lambda fp: compress(seg_path, fp))
+    data = 'compressed segment contents'
+    assert entry['size'] == len(data)
+    assert entry['md5'] == hashlib.md5(data).hexdigest()
+    assert open(entry['path']).read() == data
+
+    assert cache.lookup(SEGMENT_NAME, fingerprint) == entry
+
+    # Other options, or a changed file, do not match.
+    assert cache.lookup(SEGMENT_NAME,
+                        cache.fingerprint(seg_path, gpg_key_id='key')) is None
+    os.utime(seg_path, (0, 0))
+    assert cache.lookup(SEGMENT_NAME, cache.fingerprint(
+        seg_path, gpg_key_id=None)) is None
+
+
+def test_failed_store(seg_path):
+    cache = PushCache(os.path.dirname(seg_path))
+    fingerprint = cache.fingerprint(seg_path)
+
+    def broken(fp):
+        raise IOError('lzop failed')
+
+    with pytest.raises(IOError):
+        store(cache, SEGMENT_NAME, fingerprint, broken)
+
+    assert cache.lookup(SEGMENT_NAME, fingerprint) is None
+    assert os.listdir(cache.push_dir) == []
+
+
+def test_prune(tmpdir, monkeypatch):
+    cache = PushCache(str(tmpdir))
+
+    for i in xrange(5):
+        store(cache, '{0:024X}'.format(i), {}, lambda fp: fp.write('x'))
+
+    cache.prune(keep=2)
+    assert sorted(os.listdir(cache.push_dir)) == [
+        '000000000000000000000003.json', '000000000000000000000003.lzo',
+        '000000000000000000000004.json', '000000000000000000000004.lzo']
+
+    # Leftovers are only removed once they are old.
+    leftover = os.path.join(cache.push_dir, 'tmpABCDEF')
+    open(leftover, 'w').close()
+    cache.prune(keep=2)
+    assert os.path.exists(leftover)
+
+    os.utime(leftover, (0, 0))
+    cache.prune(keep=2)
+    assert not os.path.exists(leftover)
+
+
+def test_intact():
+    entry = {'size': 10, 'md5': 'abc'}
+
+    assert PushCache.intact(entry, BlobStat(size=10, md5='abc'))
+    assert PushCache.intact(entry, BlobStat(size=10, md5=None))
+    assert not PushCache.intact(entry, BlobStat(size=10, md5='def'))
+    assert not PushCache.intact(entry, BlobStat(size=9, md5=None))
+    assert not PushCache.intact(entry, None)
+
+
+class FakeBlobstore(object):
+    def __init__(self):
+        self.objects = {}
+        self.puts = 0
+
+    def uri_stat(self, creds, uri):
+        data = self.objects.get(uri)
+        if data is None:
+            return None
+
+        return BlobStat(size=len(data), md5=hashlib.md5(data).hexdigest())
+
+    def uri_put_file(self, creds, uri, fp):
+        return self.uri_put_stream(creds, uri, fp)
+
+    def uri_put_stream(self, creds, uri, stream):
+        self.puts += 1
+        self.objects[uri] = stream.read()
+        return BlobStat(size=len(self.objects[uri]), md5=None)
+
+
+class FakeStream(object):
+    def __init__(self, data, tee):
+        self.data = data
+        self.tee = tee
+
+    def read(self, size=None):
+        data, self.data = self.data, ''
+        self.tee.write(data)
+        return data
+
+
+def test_repeated_push(seg_path, monkeypatch):
+    compressions = []
+
+    @contextlib.contextmanager
+    def fake_lzop_stream(local_path, gpg_key, clear_xlog_tail, tee):
+        compressions.append(1)
+        with open(local_path) as f:
+            yield FakeStream('compressed ' + f.read(), tee)
+
+    monkeypatch.setattr(upload, 'lzop_stream', fake_lzop_stream)
+
+    uploader = upload.WalUploader(storage.StorageLayout('s3://bucket/prefix'),
+                                  None, None)
+    uploader.blobstore = FakeBlobstore()
+
+    segment = WalSegment(seg_path, explicit=True)
+    uploader(segment)
+    assert uploader.blobstore.puts == 1
+    assert uploader.blobstore.objects.values() == [
+        'compressed segment contents']
+
+    # Pushed again after a failure: nothing is redone.
+    uploader(segment)
+    assert uploader.blobstore.puts == 1
+    assert len(compressions) == 1
+
+    # The upload did not make it: the compressed segment is reused.
+    uploader.blobstore.objects.clear()
+    uploader(segment)
+    assert uploader.blobstore.puts == 2
+    assert len(compressions) == 1
+    assert uploader.blobstore.objects.values() == [
+        'compressed segment contents']
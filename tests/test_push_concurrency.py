@@ -0,0 +1,121 @@
+import json
+
+import pytest
+
+from wal_e.worker import push_concurrency
+from wal_e.worker.push_concurrency import AdaptiveConcurrency
+
+MiB = 1024 * 1024
+
+
+class Throttled(Exception):
+    status = 503
+    error_code = 'SlowDown'
+
+
+@pytest.fixture()
+def xlog_dir(tmpdir):
+    return str(tmpdir)
+
+
+def invocation(xlog_dir, backlog, rates=(), failure=None,
+               min_size=1, max_size=8):
+    controller = AdaptiveConcurrency(xlog_dir, min_size, max_size)
+    started = controller.concurrency(backlog)
+    for rate in rates:
+        controller.record(16 * MiB, 16 * MiB / float(rate))
+
+    if failure is not None:
+        controller.record_failure(failure)
+
+    controller.update()
+    return started, controller.limit
+
+
+def test_caught_up(xlog_dir):
+    # Without history the limit is the maximum, but only ready
+    # segments are uploaded.
+    assert invocation(xlog_dir, 1, [MiB]) == (1, 8)
+    assert invocation(xlog_dir, 3, [MiB] * 3) == (3, 8)
+
+
+def test_failures_halve(xlog_dir):
+    assert invocation(xlog_dir, 20, [MiB] * 7, failure=IOError()) == (8, 4)
+    assert invocation(xlog_dir, 20, [MiB] * 3, failure=Throttled()) == (4, 2)
+    assert invocation(xlog_dir, 20, failure=Throttled()) == (2, 1)
+    assert invocation(xlog_dir, 20, failure=Throttled()) == (1, 1)
+
+    # Back to growing while the backlog persists.
+    assert invocation(xlog_dir, 20, [MiB]) == (1, 2)
+    assert invocation(xlog_dir, 20, [MiB] * 2) == (2, 3)
+
+
+def test_saturation(xlog_dir):
+    invocation(xlog_dir, 20, [MiB], failure=IOError(), max_size=4)
+    assert invocation(xlog_dir, 20, [4 * MiB] * 2, max_size=4) == (2, 3)
+
+    # Three uploads side by side are each much slower: back off.
+    assert invocation(xlog_dir, 20, [MiB] * 3, max_size=4) == (3, 2)
+
+
+def test_bounds(xlog_dir):
+    assert invocation(xlog_dir, 20, failure=IOError(),
+                      min_size=3, max_size=4) == (4, 3)
+
+    # Stored limits outside of new bounds are brought inside them.
+    assert invocation(xlog_dir, 20, [MiB] * 2, max_size=2) == (2, 2)
+
+
+def test_damaged_state(xlog_dir):
+    invocation(xlog_dir, 1, [MiB])
+    controller = AdaptiveConcurrency(xlog_dir, 1, 8)
+    with open(controller.state_path, 'w') as f:
+        f.write('{')
+
+    assert invocation(xlog_dir, 20, [MiB] * 8) == (8, 8)
+    with open(controller.state_path) as f:
+        assert json.load(f)['limit'] == 8
+
+
+def test_is_throttling():
+    assert push_concurrency.is_throttling(Throttled())
+    assert not push_concurrency.is_throttling(IOError())
+
+    class SwiftRateLimited(Exception):
+        http_status = 498
+
+    assert push_concurrency.is_throttling(SwiftRateLimited())
+
+
+def test_measure(xlog_dir):
+    class Segment(object):
+        uploaded_bytes = None
+
+    def upload(segment):
+        segment.uploaded_bytes = 100
+        return segment
+
+    controller = AdaptiveConcurrency(xlog_dir, 1, 8)
+    controller.concurrency(2)
+    assert isinstance(controller.measure(upload)(Segment()), Segment)
+    assert len(controller.rates) == 1
+
+    # Segments already archived upload nothing, and are not measured.
+    controller.measure(lambda segment: segment)(Segment())
+    assert len(controller.rates) == 1
+
+    def broken(segment):
+        raise Throttled()
+
+    with pytest.raises(Throttled):
+        controller.measure(broken)(Segment())
+
+    assert controller.throttled == 1
+    controller.update()
+    assert controller.limit == 4
+
+
+def test_update_without_uploads(xlog_dir):
+    controller = AdaptiveConcurrency(xlog_dir, 1, 8)
+    controller.update()
+    assert controller.limit == 8
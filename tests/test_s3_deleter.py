@@ -218,3 +218,24 @@ def test_no_retry_on_keyboadinterrupt(b, collect):
 
     # Since there is no retrying, no keys should be deleted.
     assert not collect.deleted_keys
+
+
+def test_concurrent_pages(b, monkeypatch):
+    """Pages of keys are deleted concurrently."""
+    in_flight = []
+    most_in_flight = []
+
+    def delete_keys(self, keys):
+        in_flight.append(keys)
+        most_in_flight.append(len(in_flight))
+        gevent.sleep(0)
+        in_flight.remove(keys)
+
+    monkeypatch.setattr(bucket.Bucket, 'delete_keys', delete_keys)
+
+    d = s3_deleter.Deleter(concurrency=3)
+    for x in range(3000):
+        d.delete(key.Key(bucket=b, name='test-key-' + str(x)))
+    d.close()
+
+    assert max(most_in_flight) == 3
@@ -0,0 +1,156 @@
+import datetime
+import os
+import stat
+import time
+
+import boto
+import boto.provider
+import pytest
+
+from boto import utils
+from boto.s3 import connection
+
+from wal_e.blobstore.connection_pool import pool
+from wal_e.blobstore.s3 import calling_format
+from wal_e.blobstore.s3 import host_cache
+from wal_e.blobstore.s3 import s3_credentials
+from wal_e.blobstore.s3 import s3_util
+
+
+@pytest.fixture()
+def cache_dir(tmpdir, monkeypatch):
+    d = tmpdir.join('cache')
+    monkeypatch.setenv('WALE_S3_CACHE_DIR', str(d))
+    return d
+
+
+def test_disabled_by_default(monkeypatch):
+    monkeypatch.delenv('WALE_S3_CACHE_DIR', raising=False)
+
+    host_cache.store('entry', 'value', time.time() + 60)
+    assert host_cache.load('entry') is None
+
+
+def test_store_load(cache_dir):
+    assert host_cache.load('entry') is None
+
+    host_cache.store('entry', {'a': 1}, time.time() + 60)
+    assert host_cache.load('entry') == {'a': 1}
+
+    mode = stat.S_IMODE(os.stat(str(cache_dir.join('entry.json'))).st_mode)
+    assert mode == 0600
+
+    # No temporary files are left behind.
+    assert cache_dir.listdir() == [cache_dir.join('entry.json')]
+
+    host_cache.invalidate('entry')
+    assert host_cache.load('entry') is None
+
+    # Invalidating a missing entry is not an error.
+    host_cache.invalidate('entry')
+
+
+def test_expired_and_damaged(cache_dir):
+    host_cache.store('entry', 'value', time.time() - 1)
+    assert host_cache.load('entry') is None
+
+    cache_dir.join('entry.json').write('{not json')
+    assert host_cache.load('entry') is None
+
+
+def test_region_from_cache(cache_dir, monkeypatch):
+    def no_lookup(self):
+        assert False, 'the region should have come from the cache'
+
+    monkeypatch.setattr(boto.s3.bucket.Bucket, 'get_location', no_lookup)
+
+    host_cache.store(host_cache.bucket_entry('my.aws.bucket'),
+                     {'region': 'us-west-1',
+                      'endpoint': 's3-us-west-1.amazonaws.com'},
+                     time.time() + 60)
+
+    cinfo = calling_format.from_store_name('my.aws.bucket')
+    conn = cinfo.connect(s3_credentials.Credentials('foo', 'bar'))
+
+    assert cinfo.region == 'us-west-1'
+    assert conn.host == 's3-us-west-1.amazonaws.com'
+
+    cinfo.invalidate()
+    assert cinfo.region is None
+    assert cinfo.ordinary_endpoint is None
+    assert host_cache.load(host_cache.bucket_entry('my.aws.bucket')) is None
+
+
+def test_region_detected_and_stored(cache_dir, monkeypatch):
+    monkeypatch.setattr(boto.s3.bucket.Bucket, 'get_location',
+                        lambda self: 'us-west-2')
+
+    cinfo = calling_format.from_store_name('my.aws.bucket')
+    cinfo.connect(s3_credentials.Credentials('foo', 'bar'))
+
+    assert host_cache.load(host_cache.bucket_entry('my.aws.bucket')) == {
+        'region': 'us-west-2', 'endpoint': 's3-us-west-2.amazonaws.com'}
+
+
+@pytest.fixture()
+def metadata(monkeypatch):
+    expiration = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    m = {
+        'Code': 'Success',
+        'LastUpdated': '2014-01-11T02:13:53Z',
+        'Type': 'AWS-HMAC',
+        'AccessKeyId': 'foo',
+        'SecretAccessKey': 'bar',
+        'Token': 'baz',
+        'Expiration': expiration.strftime('%Y-%m-%dT%H:%M:%SZ'),
+    }
+
+    calls = []
+
+    def get_instance_metadata(*args, **kwargs):
+        calls.append(1)
+        return {'irrelevant': m}
+
+    monkeypatch.setattr(utils, 'get_instance_metadata',
+                        get_instance_metadata)
+    return calls
+
+
+def test_instance_profile_cached(cache_dir, metadata):
+    ipp = s3_credentials.InstanceProfileCredentials()
+    assert ipp.get_secret_key() == 'bar'
+    assert len(metadata) == 1
+
+    # Another process would find the credentials in the cache.
+    ipp = s3_credentials.InstanceProfileCredentials()
+    assert ipp.get_access_key() == 'foo'
+    assert ipp.get_secret_key() == 'bar'
+    assert ipp.get_security_token() == 'baz'
+    assert len(metadata) == 1
+
+    ipp.invalidate()
+    assert host_cache.load(host_cache.INSTANCE_PROFILE_ENTRY) is None
+
+    # The rejected credentials are not used again.
+    assert ipp.get_secret_key() == 'bar'
+    assert len(metadata) == 2
+
+
+def test_invalidate_on_auth_error(cache_dir, monkeypatch):
+    host_cache.store(host_cache.bucket_entry('my.aws.bucket'),
+                     {'region': 'us-west-1',
+                      'endpoint': 's3-us-west-1.amazonaws.com'},
+                     time.time() + 60)
+
+    monkeypatch.setattr(s3_util, '_calling_infos', {})
+    creds = s3_credentials.Credentials('foo', 'bar')
+
+    with pytest.raises(boto.exception.S3ResponseError):
+        with s3_util._connection(creds, 's3://my.aws.bucket/key') as conn:
+            assert isinstance(conn, connection.S3Connection)
+            raise boto.exception.S3ResponseError(301, 'Moved Permanently')
+
+    assert host_cache.load(host_cache.bucket_entry('my.aws.bucket')) is None
+    assert s3_util._calling_info('my.aws.bucket').region is None
+
+    pool.clear()
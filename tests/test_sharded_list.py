@@ -0,0 +1,126 @@
+import bisect
+import re
+
+import pytest
+
+from wal_e import storage
+from wal_e.worker import sharded_list
+from wal_e.worker.swift import swift_worker
+
+
+class FakeStore(object):
+    """Keys held in order, listed by prefix and range"""
+
+    def __init__(self, names):
+        self.names = sorted(names)
+        self.probes = []
+        self.ranges = []
+
+    def probe(self, prefix):
+        self.probes.append(prefix)
+        return any(n.startswith(prefix) for n in self.names)
+
+    def list_range(self, prefix, start_after, end_before):
+        self.ranges.append((start_after, end_before))
+        i = 0
+        if start_after is not None:
+            i = bisect.bisect_right(self.names, start_after)
+
+        for name in self.names[i:]:
+            if end_before is not None and name >= end_before:
+                break
+            if name.startswith(prefix):
+                yield name
+
+
+def wal_names(tli, logs):
+    return ['wal_005/{0:08X}{1:08X}{2:08X}.lzo'.format(tli, log, seg)
+            for log in logs for seg in (0, 0x7F, 0xFE)]
+
+
+@pytest.fixture
+def store():
+    return FakeStore(wal_names(1, range(0x2C0, 0x300)) +
+                     wal_names(2, range(0x2F0, 0x310)) +
+                     ['wal_005/00000002.history',
+                      'wal_005/00000001000002C00000007F.00000028.backup.lzo',
+                      'wal_005/unexpected'])
+
+
+def test_range_starts(store):
+    starts = sharded_list.range_starts(store.probe, 'wal_005/', 8)
+
+    # Both timelines are split on the log number, until there are
+    # enough ranges.
+    assert starts == ['00000001000002C', '00000001000002D',
+                      '00000001000002E', '00000001000002F',
+                      '00000002000002F', '000000020000030']
+
+
+def test_range_starts_empty():
+    assert sharded_list.range_starts(FakeStore([]).probe, 'wal_005/', 8) == []
+
+
+def test_list_everything(store):
+    listed = list(sharded_list.list_sharded(store.probe, store.list_range,
+                                            'wal_005/', 2))
+    assert sorted(listed) == store.names
+
+
+def test_list_before_horizon(store):
+    horizon = storage.SegmentNumber(log='000002F1', seg='00000000')
+    listed = list(sharded_list.list_sharded(store.probe, store.list_range,
+                                            'wal_005/', 2, horizon=horizon))
+
+    # History files are never deleted, and need not be listed.
+    below = [n for n in store.names
+             if re.match(storage.SEGMENT_REGEXP, n[len('wal_005/'):]) and
+             n[len('wal_005/') + 8:] < '000002F100000000']
+    assert sorted(listed) == below
+
+    # Prefixes after the horizon are not looked into, and ranges of
+    # names after the horizon are not listed.
+    assert 'wal_005/0000000100000300' not in store.probes
+    assert not any(start == 'wal_005/00000002000002F100000000'
+                   for start, end in store.ranges)
+
+
+def test_list_failure(store):
+    def broken(prefix, start_after, end_before):
+        raise IOError('connection reset')
+
+    with pytest.raises(IOError):
+        list(sharded_list.list_sharded(store.probe, broken, 'wal_005/', 2))
+
+
+class SwiftConnection(object):
+    """Records which copy of the connection made each request"""
+
+    def __init__(self, names):
+        self.names = sorted('/' + n for n in names)
+        self.used = []
+
+    def get_container(self, container, prefix='', marker=None,
+                      end_marker=None, delimiter=None, limit=None,
+                      full_listing=False):
+        self.used.append(id(self))
+        page = [{'name': n, 'bytes': 0, 'last_modified': ''}
+                for n in self.names
+                if n.startswith(prefix) and n > (marker or '') and
+                (not end_marker or n < end_marker)]
+        return {}, page[:limit]
+
+
+def test_swift_concurrent_requests(store):
+    conn = SwiftConnection(store.names)
+    dc = swift_worker.DeleteFromContext(
+        conn, storage.StorageLayout('swift://container/'), True)
+
+    assert dc._probe('wal_005/00000001')
+    assert len(list(dc._list_range('wal_005/', None, None))) == len(
+        [n for n in store.names if n.startswith('wal_005/')])
+
+    # Probes and ranges run concurrently, so none of them uses the
+    # connection of the context itself.
+    assert conn.used
+    assert id(conn) not in conn.used
@@ -0,0 +1,104 @@
+"""Track how long WAL-E takes to start up
+
+Postgres runs wal-push and wal-fetch once per WAL segment, so start-up
+time bounds the rate of archiving and recovery.  These tests start a
+fresh interpreter for each command and backend, check that only the
+modules that are needed are imported, and that start-up fits in a
+time budget.
+
+The budget is deliberately generous to avoid spurious failures on
+slow machines; it can be adjusted with WALE_STARTUP_BUDGET (seconds).
+
+"""
+import json
+import os
+import pytest
+import sys
+
+from os import path
+
+from wal_e import subprocess
+
+BUDGET = float(os.getenv('WALE_STARTUP_BUDGET', '2.0'))
+
+BACKEND_MODULES = {
+    's3': 'boto',
+    'wabs': 'azure',
+    'swift': 'swiftclient',
+}
+
+# Imports wal_e.cmd, parses a command line and configures the backup
+# context as main() would, then reports the time taken and the
+# third-party backend modules that were loaded.
+PROBE = '''
+import json, sys, time
+start = time.time()
+from wal_e import cmd
+args = cmd.build_parser().parse_args(sys.argv[1:])
+if args.subcommand != 'version':
+    cmd.configure_backup_cxt(args)
+print json.dumps({
+    'elapsed': time.time() - start,
+    'modules': [m for m in %r if m in sys.modules]})
+''' % (sorted(BACKEND_MODULES.values()),)
+
+
+def probe(argv, extra_env=None):
+    env = dict(os.environ)
+    env.update({
+        'AWS_ACCESS_KEY_ID': 'bogus',
+        'AWS_SECRET_ACCESS_KEY': 'bogus',
+        'WABS_ACCOUNT_NAME': 'bogus',
+        'WABS_ACCESS_KEY': 'bogus',
+        'PYTHONPATH': path.dirname(path.dirname(path.abspath(__file__))),
+    })
+
+    for name in ('WALE_S3_PREFIX', 'WALE_WABS_PREFIX', 'WALE_SWIFT_PREFIX',
+                 'WALE_GPG_KEY_ID'):
+        env.pop(name, None)
+
+    env.update(extra_env or {})
+
+    proc = subprocess.Popen([sys.executable, '-c', PROBE] + argv,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            env=env)
+    out, err = proc.communicate()
+    assert proc.returncode == 0, err
+
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def backend_installed(backend):
+    try:
+        __import__(BACKEND_MODULES[backend])
+    except ImportError:
+        return False
+
+    return True
+
+
+def test_import_loads_no_backend():
+    result = probe(['version'])
+
+    assert result['modules'] == []
+    assert result['elapsed'] < BUDGET
+
+
+@pytest.mark.parametrize('backend', sorted(BACKEND_MODULES))
+@pytest.mark.parametrize('subcommand', [
+    ['wal-push', 'pg_xlog/000000010000000000000001'],
+    ['wal-fetch', '000000010000000000000001', 'pg_xlog/RECOVERYXLOG'],
+    ['backup-list'],
+])
+def test_subcommand_startup(backend, subcommand):
+    if not backend_installed(backend):
+        pytest.skip('{0} is not installed'.format(BACKEND_MODULES[backend]))
+
+    prefix = '{0}://bucket/prefix'.format(backend)
+    extra_env = {'WALE_{0}_PREFIX'.format(backend.upper()): prefix}
+
+    result = probe(subcommand, extra_env)
+
+    # Only the backend in use is to be loaded.
+    assert result['modules'] == [BACKEND_MODULES[backend]]
+    assert result['elapsed'] < BUDGET
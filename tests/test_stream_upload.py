@@ -0,0 +1,156 @@
+import pytest
+
+from wal_e import pipeline
+from wal_e.blobstore.s3 import s3_util
+from wal_e.exception import UserCritical
+from wal_e.worker import worker_util
+
+
+class Tee(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+
+def cat_pipeline(in_fd, out_fd, gpg_key=None):
+    return pipeline.Pipeline([pipeline.CatFilter()], in_fd, out_fd)
+
+
+def failing_pipeline(in_fd, out_fd, gpg_key=None):
+    return pipeline.Pipeline(
+        [pipeline.PipelineCommand(['sh', '-c', 'head -c 3; exit 3'])],
+        in_fd, out_fd)
+
+
+@pytest.fixture()
+def seg_path(tmpdir):
+    p = tmpdir.join('000000010000000000000002')
+    p.write('0123456789' * 1000)
+    return str(p)
+
+
+@pytest.mark.parametrize('clear_xlog_tail', [False, True])
+def test_lzop_stream(seg_path, monkeypatch, clear_xlog_tail):
+    monkeypatch.setattr(pipeline, 'get_upload_pipeline', cat_pipeline)
+
+    # The test file is not a real segment, so clearing its tail
+    # leaves it as it is, but it is fed through a greenlet.
+    tee = Tee()
+    with worker_util.lzop_stream(seg_path, None, tee=tee,
+                                 clear_xlog_tail=clear_xlog_tail) as stream:
+        data = stream.read(4096) + stream.read()
+
+    assert data == '0123456789' * 1000
+    assert ''.join(tee.written) == data
+
+
+def test_lzop_stream_failure(seg_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'get_upload_pipeline', failing_pipeline)
+
+    with pytest.raises(UserCritical):
+        with worker_util.lzop_stream(seg_path, None) as stream:
+            assert stream.read(3) == '012'
+
+            # The end of the stream is not reported as such.
+            stream.read(3)
+
+
+def test_lzop_stream_abandoned(seg_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'get_upload_pipeline', cat_pipeline)
+
+    # An upload that fails part way does not leave the pipeline
+    # blocked.
+    with pytest.raises(IOError):
+        with worker_util.lzop_stream(seg_path, None) as stream:
+            stream.read(10)
+            raise IOError('connection reset')
+
+
+class FakeMultiPartUpload(object):
+    def __init__(self):
+        self.parts = {}
+        self.completed = False
+        self.cancelled = False
+
+    def upload_part_from_file(self, fp, part_num):
+        self.parts[part_num] = fp.read()
+
+    def complete_upload(self):
+        self.completed = True
+
+    def cancel_upload(self):
+        self.cancelled = True
+
+
+class FakeBucket(object):
+    def __init__(self):
+        self.mp = FakeMultiPartUpload()
+
+    def initiate_multipart_upload(self, name, headers=None,
+                                  encrypt_key=False):
+        return self.mp
+
+
+class FakeKey(object):
+    def __init__(self):
+        self.name = '/prefix/key'
+        self.bucket = FakeBucket()
+        self.contents = None
+        self.size = None
+
+    def set_contents_from_string(self, data, encrypt_key=False):
+        self.contents = data
+        self.size = len(data)
+
+
+class FakeStream(object):
+    def __init__(self, data, fail_at_end=False):
+        self.data = data
+        self.fail_at_end = fail_at_end
+
+    def read(self, size=None):
+        data, self.data = self.data[:size], self.data[size:]
+        if not data and self.fail_at_end:
+            raise UserCritical(msg='pipeline process did not exit gracefully')
+        return data
+
+
+@pytest.fixture()
+def fake_key(monkeypatch):
+    key = FakeKey()
+    monkeypatch.setattr(s3_util, 'S3_PART_SIZE', 4)
+    monkeypatch.setattr(s3_util, '_uri_to_key',
+                        lambda creds, uri, conn=None: key)
+    return key
+
+
+def test_s3_small_stream(fake_key):
+    k = s3_util.uri_put_stream(None, 's3://bucket/prefix/key',
+                               FakeStream('abc'), conn=object())
+
+    assert k.contents == 'abc'
+    assert k.size == 3
+    assert fake_key.bucket.mp.parts == {}
+
+
+def test_s3_multipart_stream(fake_key):
+    k = s3_util.uri_put_stream(None, 's3://bucket/prefix/key',
+                               FakeStream('0123456789'), conn=object())
+
+    mp = fake_key.bucket.mp
+    assert mp.parts == {1: '0123', 2: '4567', 3: '89'}
+    assert mp.completed
+    assert k.size == 10
+
+
+def test_s3_multipart_stream_failure(fake_key):
+    with pytest.raises(UserCritical):
+        s3_util.uri_put_stream(None, 's3://bucket/prefix/key',
+                               FakeStream('0123456789', fail_at_end=True),
+                               conn=object())
+
+    mp = fake_key.bucket.mp
+    assert not mp.completed
+    assert mp.cancelled
@@ -0,0 +1,60 @@
+import pytest
+import swiftclient
+
+from swiftclient.exceptions import ClientException
+
+from wal_e.blobstore import swift
+from wal_e.blobstore.swift import calling_format
+
+
+@pytest.fixture
+def creds():
+    return swift.Credentials('http://auth.invalid/v2.0', 'user', 'password',
+                             'tenant', 'region', 'publicURL')
+
+
+@pytest.fixture
+def tokens(monkeypatch):
+    """Issue a new token on each authentication"""
+    monkeypatch.setattr(calling_format, '_auth_cache', {})
+    issued = []
+
+    def get_auth(self):
+        issued.append('token-{0}'.format(len(issued) + 1))
+        self.url, self.token = 'http://swift.invalid/v1', issued[-1]
+        return self.url, self.token
+
+    monkeypatch.setattr(swiftclient.Connection, 'get_auth', get_auth)
+    return issued
+
+
+def test_token_shared(creds, tokens):
+    first = calling_format.connect(creds)
+    second = calling_format.connect(creds)
+
+    assert tokens == ['token-1']
+    assert first.token == second.token == 'token-1'
+
+
+def test_renewed_token_shared(creds, tokens):
+    conn = calling_format.connect(creds)
+
+    # As swiftclient does after a request failed with 401.
+    conn.url = conn.token = None
+    conn.get_auth()
+
+    assert tokens == ['token-1', 'token-2']
+    assert calling_format.connect(creds).token == 'token-2'
+
+
+def test_expired_token_forgotten(creds, tokens, monkeypatch):
+    conn = calling_format.connect(creds)
+
+    def fail(self):
+        raise ClientException('Unauthorized', http_status=401)
+
+    monkeypatch.setattr(swiftclient.Connection, 'get_auth', fail)
+    with pytest.raises(ClientException):
+        conn.get_auth()
+
+    assert calling_format._auth_cache == {}
@@ -0,0 +1,103 @@
+import json
+
+import pytest
+from collections import namedtuple
+
+from swiftclient.exceptions import ClientException
+
+from wal_e import exception
+from wal_e.worker.swift import swift_deleter
+
+B = namedtuple('Blob', ['name'])
+
+
+class FakeConnection(object):
+    def __init__(self, capabilities):
+        self.capabilities = capabilities
+        self.deleted = []
+        self.bulk_requests = []
+
+    def get_capabilities(self):
+        if self.capabilities is None:
+            raise ClientException('no /info', http_status=404)
+        return self.capabilities
+
+    def delete_object(self, container, name):
+        if name == '/gone':
+            raise ClientException('not found', http_status=404)
+        self.deleted.append(name)
+
+    def post_account(self, headers, query_string=None, data=None):
+        assert query_string == 'bulk-delete'
+        self.bulk_requests.append(data.split('\n'))
+        errors = [[n, '409 Conflict'] for n in data.split('\n')
+                  if n.endswith('busy')]
+        return {}, json.dumps({'Response Status': '200 OK',
+                               'Errors': errors})
+
+
+class OldConnection(object):
+    """The interface of python-swiftclient 1.8.0"""
+
+    def __init__(self):
+        self.deleted = []
+
+    def delete_object(self, container, name):
+        self.deleted.append(name)
+
+    def post_account(self, headers, response_dict=None):
+        raise AssertionError('cannot send a body')
+
+
+@pytest.mark.parametrize('capabilities', [None, {'swift': {}}])
+def test_one_at_a_time(capabilities):
+    conn = FakeConnection(capabilities)
+    d = swift_deleter.Deleter(conn, 'container')
+    d.delete(B(name='/gone'))
+    d.delete(B(name='/here'))
+    d.close()
+
+    assert conn.deleted == ['/here']
+    assert conn.bulk_requests == []
+
+
+def test_bulk_delete():
+    conn = FakeConnection({'bulk_delete': {}})
+    d = swift_deleter.Deleter(conn, 'container')
+    d.delete(B(name='/wal 1'))
+    d.delete(B(name=u'/wal\xe9'))
+    d.close()
+
+    assert conn.bulk_requests == [['container//wal%201',
+                                   'container//wal%C3%A9']]
+    assert conn.deleted == []
+
+
+def test_bulk_delete_errors():
+    conn = FakeConnection({'bulk_delete': {}})
+    d = swift_deleter.Deleter(conn, 'container')
+
+    with pytest.raises(exception.UserException):
+        d._bulk_delete(conn, [B(name='/busy')])
+
+    d.close()
+
+
+def test_old_client():
+    conn = OldConnection()
+    d = swift_deleter.Deleter(conn, 'container')
+    d.delete(B(name='/here'))
+    d.close()
+
+    assert conn.deleted == ['/here']
+    assert d.bulk_delete is False
+
+
+def test_connection_per_worker():
+    conn = FakeConnection({})
+    d = swift_deleter.Deleter(conn, 'container', concurrency=3)
+    conns = [d._conns.get() for i in xrange(3)]
+    d.close()
+
+    # Workers never share a connection, nor use the one passed in.
+    assert len(set(map(id, conns + [conn]))) == 4
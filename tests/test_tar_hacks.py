@@ -117,3 +117,200 @@ def test_creation_upper_dir(tmpdir, monkeypatch):
 
     # Make sure the test exercised cat_extraction.
     assert check.called
+
+
+def test_small_file_extract_metadata(tmpdir):
+    """Check the small-file path restores contents and metadata
+
+    Metadata application is deferred to the end of extraction in
+    batches, so verify modes and modification times survive that,
+    including for directories that had members written into them
+    after their creation.
+
+    """
+    src = tmpdir.join('src').ensure(dir=True)
+    empty = src.join('empty').ensure(dir=True)
+    deep = src.join('a', 'b').ensure(dir=True)
+    small = deep.join('small')
+    small.write('hello')
+
+    os.chmod(unicode(small), 0640)
+    os.utime(unicode(small), (1000000000, 1000000000))
+    os.chmod(unicode(empty), 0750)
+    os.utime(unicode(empty), (1100000000, 1100000000))
+
+    tar_path = unicode(tmpdir.join('small.tar'))
+    tar = tarfile.open(name=tar_path, mode='w')
+    tar.add(unicode(empty), arcname='empty')
+    tar.add(unicode(small), arcname='a/b/small')
+    tar.close()
+
+    dest_dir = tmpdir.join('dest').ensure(dir=True)
+    with open(tar_path) as f:
+        tar_partition.TarPartition.tarfile_extract(f, unicode(dest_dir))
+
+    restored = dest_dir.join('a', 'b', 'small')
+    assert restored.read() == 'hello'
+
+    st = os.stat(unicode(restored))
+    assert st.st_mode & 0777 == 0640
+    assert int(st.st_mtime) == 1000000000
+
+    st = os.stat(unicode(dest_dir.join('empty')))
+    assert st.st_mode & 0777 == 0750
+    assert int(st.st_mtime) == 1100000000
+
+
+def test_delta_restore(tmpdir):
+    """Check delta restores patch changes and prune extraneous files"""
+    src = tmpdir.join('src').ensure(dir=True)
+    same = src.join('base', '1', 'same')
+    same.write('unchanged', ensure=True)
+    changed = src.join('base', '1', 'changed')
+    changed.write('new contents')
+
+    tar_path = unicode(tmpdir.join('delta.tar'))
+    tar = tarfile.open(name=tar_path, mode='w')
+    tar.add(unicode(src.join('base')), arcname='base')
+    tar.close()
+
+    dest = tmpdir.join('dest').ensure(dir=True)
+    dest.join('base', '1', 'same').write('unchanged', ensure=True)
+    dest.join('base', '1', 'changed').write('old contents')
+    dest.join('base', '1', 'dropped').write('gone')
+    dest.join('postgresql.conf').write('kept')
+    dest.join('pg_xlog', '000000010000000000000001').write('kept',
+                                                           ensure=True)
+
+    delta = tar_partition.DeltaRestore(unicode(dest), compare='checksum')
+    with open(tar_path) as f:
+        tar_partition.TarPartition.tarfile_extract(f, unicode(dest),
+                                                   delta=delta)
+    delta.remove_extraneous()
+
+    assert dest.join('base', '1', 'same').read() == 'unchanged'
+    assert dest.join('base', '1', 'changed').read() == 'new contents'
+    assert not dest.join('base', '1', 'dropped').check()
+    assert dest.join('postgresql.conf').check()
+    assert dest.join('pg_xlog', '000000010000000000000001').check()
+
+
+def test_delta_restore_replaces_other_types(tmpdir):
+    """Check delta restores replace symlinks and directories in the way"""
+    src = tmpdir.join('src').ensure(dir=True)
+    src.join('base', '1', 'linked').write('contents', ensure=True)
+    src.join('base', '1', 'nested').write('contents')
+    os.symlink('target', unicode(src.join('base', '1', 'link')))
+
+    tar_path = unicode(tmpdir.join('delta.tar'))
+    tar = tarfile.open(name=tar_path, mode='w')
+    tar.add(unicode(src.join('base')), arcname='base')
+    tar.close()
+
+    # A file outside the cluster directory, reachable through a
+    # symlink where a file goes.
+    outside = tmpdir.join('outside')
+    outside.write('untouched')
+
+    dest = tmpdir.join('dest').ensure(dir=True)
+    dest.join('base', '1').ensure(dir=True)
+    os.symlink(unicode(outside), unicode(dest.join('base', '1', 'linked')))
+    dest.join('base', '1', 'nested', 'file').write('x', ensure=True)
+    dest.join('base', '1', 'link', 'file').write('x', ensure=True)
+
+    for compare in tar_partition.DeltaRestore.COMPARE_MODES:
+        delta = tar_partition.DeltaRestore(unicode(dest), compare=compare)
+        with open(tar_path) as f:
+            tar_partition.TarPartition.tarfile_extract(f, unicode(dest),
+                                                       delta=delta)
+
+        assert outside.read() == 'untouched'
+        for name in ('linked', 'nested'):
+            path = dest.join('base', '1', name)
+            assert not path.islink()
+            assert path.read() == 'contents'
+
+        assert os.readlink(unicode(dest.join('base', '1', 'link'))) == \
+            'target'
+
+
+def test_selective_restore(tmpdir):
+    """Check unselected relation files are replaced by placeholders"""
+    src = tmpdir.join('src').ensure(dir=True)
+    src.join('global', 'pg_control').write('control', ensure=True)
+    src.join('base', '1', '1259').write('template', ensure=True)
+    src.join('base', '16385', '1259').write('wanted', ensure=True)
+    src.join('base', '16386', '1259').write('unwanted', ensure=True)
+
+    tar_path = unicode(tmpdir.join('selective.tar'))
+    tar = tarfile.open(name=tar_path, mode='w')
+    for name in ('global', 'base'):
+        tar.add(unicode(src.join(name)), arcname=name)
+    tar.close()
+
+    dest = tmpdir.join('dest').ensure(dir=True)
+    selective = tar_partition.SelectiveRestore(['16385'])
+    with open(tar_path) as f:
+        tar_partition.TarPartition.tarfile_extract(f, unicode(dest),
+                                                   selective=selective)
+
+    assert dest.join('global', 'pg_control').read() == 'control'
+    assert dest.join('base', '1', '1259').read() == 'template'
+    assert dest.join('base', '16385', '1259').read() == 'wanted'
+
+    placeholder = dest.join('base', '16386', '1259')
+    assert placeholder.read() == '\0' * len('unwanted')
+
+    selective = tar_partition.SelectiveRestore(['tablespace:16390'])
+    assert selective.wants('pg_tblspc/16390/PG_9.3_201306121/16386/1259')
+    assert not selective.wants('pg_tblspc/16391/PG_9.3_201306121/16386/1')
+    assert selective.wants('pg_tblspc/16391/PG_9.3_201306121/1/1259')
+
+
+def test_member_index(tmpdir):
+    """Check member offsets point at the data in the tar stream"""
+    from cStringIO import StringIO
+
+    src = tmpdir.join('src').ensure(dir=True)
+    src.join('base', '16385', '1259').write('x' * 1000, ensure=True)
+    src.join('global', 'pg_control').write('control', ensure=True)
+    src.join('a' * 120, 'long').write('long name', ensure=True)
+
+    bogus_tar = tarfile.TarFile(os.devnull, 'w', dereference=False)
+    tpart = tar_partition.TarPartition(0)
+    for name in ('base', 'base/16385', 'base/16385/1259',
+                 'global/pg_control', 'a' * 120 + '/long'):
+        path = unicode(src.join(name))
+        tpart.append(tar_partition.ExtendedTarInfo(
+            submitted_path=path,
+            tarinfo=bogus_tar.gettarinfo(path, arcname=name)))
+
+    raw = StringIO()
+    tpart.tarfile_write(raw)
+    raw = raw.getvalue()
+
+    assert len(tpart.member_entries) == 5
+    for entry in tpart.member_entries:
+        if entry.type in tarfile.REGULAR_TYPES:
+            expected = src.join(entry.name).read()
+            assert raw[entry.offset:entry.offset + entry.size] == expected
+
+    index = tar_partition.MemberIndex()
+    index.add_partition('part_00000000.tar.lzo', 1234, tpart.member_entries)
+
+    dumped = StringIO()
+    index.dump(dumped)
+    loaded = tar_partition.MemberIndex.load(StringIO(dumped.getvalue()))
+
+    assert loaded.partition_names() == ['part_00000000.tar.lzo']
+    assert loaded.compressed_size('part_00000000.tar.lzo') == 1234
+
+    part_name, entry = loaded.find('global/pg_control')
+    assert part_name == 'part_00000000.tar.lzo'
+    assert entry.size == len('control')
+    assert loaded.find('global/missing') is None
+
+    selective = tar_partition.SelectiveRestore(['16386'])
+    assert not selective.placeholders_only(loaded.entries(part_name))
+    assert selective.placeholders_only(
+        [e for e in loaded.entries(part_name) if e.name.startswith('base')])
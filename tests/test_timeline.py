@@ -0,0 +1,72 @@
+import itertools
+import re
+
+import pytest
+
+from wal_e import storage
+from wal_e.worker import WalSegment
+from wal_e.worker.pg.timeline import TimelineHistory
+
+
+HISTORY = '''1\t0/3000090\tno recovery target specified
+
+2\t1/A0000028\tbefore 2000-01-01 00:00:00+00
+'''
+
+
+@pytest.fixture
+def history():
+    return TimelineHistory.parse(3, HISTORY)
+
+
+def sn(name):
+    return WalSegment(name).segment_number
+
+
+def test_parse(history):
+    assert history.tli == 3
+    assert [(t, s.log, s.seg) for t, s in history.switches] == [
+        (1, '00000000', '00000003'), (2, '00000001', '000000A0')]
+
+
+def test_parse_malformed():
+    with pytest.raises(ValueError):
+        TimelineHistory.parse(2, 'not a history file\n')
+
+
+def test_includes(history):
+    assert history.includes(1)
+    assert history.includes(3)
+    assert not history.includes(4)
+
+
+def test_tli_for(history):
+    # The segment holding the switch point is read from the new
+    # timeline.
+    assert history.tli_for(sn('000000010000000000000002')) == 1
+    assert history.tli_for(sn('000000010000000000000003')) == 2
+    assert history.tli_for(sn('00000001000000010000009F')) == 2
+    assert history.tli_for(sn('0000000100000001000000A0')) == 3
+
+
+def test_future_segment_stream(history):
+    segment = WalSegment('00000002000000010000009E')
+    future = itertools.islice(
+        segment.future_segment_stream(history=history), 3)
+    assert [s.name for s in future] == ['00000002000000010000009F',
+                                        '0000000300000001000000A0',
+                                        '0000000300000001000000A1']
+
+
+def test_future_segment_stream_unrelated():
+    # The history of a timeline not descending from the one replayed
+    # is ignored.
+    other = TimelineHistory.parse(3, '2\t0/5000000\treason\n')
+    segment = WalSegment('000000010000000000000004')
+    assert (segment.future_segment_stream(history=other).next().name ==
+            '000000010000000000000005')
+
+
+def test_history_regexp():
+    assert re.match(storage.HISTORY_REGEXP, '00000002.history')
+    assert not re.match(storage.HISTORY_REGEXP, '000000010000000000000002')
@@ -2,6 +2,7 @@ import gevent
 import pytest
 from collections import namedtuple
 
+from azure import WindowsAzureMissingResourceError
 from azure.storage import BlobService
 from gevent import coros
 
@@ -198,3 +199,23 @@ def test_no_retry_on_keyboadinterrupt(collect):
 
     # Since there is no retrying, no keys should be deleted.
     assert not collect.deleted_keys
+
+
+def test_missing_blob(monkeypatch):
+    """Blobs already deleted, e.g. by an earlier attempt, are skipped."""
+    deleted = []
+
+    def delete_blob(self, container, key):
+        if key == 'gone':
+            raise WindowsAzureMissingResourceError('not found')
+        deleted.append(key)
+
+    monkeypatch.setattr(BlobService, 'delete_blob', delete_blob)
+
+    d = wabs_deleter.Deleter(BlobService('test', 'ing'), 'test-container',
+                             concurrency=2)
+    d.delete(B(name='gone'))
+    d.delete(B(name='here'))
+    d.close()
+
+    assert deleted == ['here']
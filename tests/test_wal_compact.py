@@ -0,0 +1,113 @@
+import struct
+
+import pytest
+
+from wal_e import wal_compact
+
+PAGE_SIZE = 8192
+SEGMENT_SIZE = 16 * PAGE_SIZE
+SEGMENT_NAME = '000000010000000A00000003'
+
+# Magic numbers of Postgres 9.4 and 9.2, with flat and split page
+# addresses respectively.
+NEW_MAGIC = 0xD07E
+OLD_MAGIC = 0xD071
+
+
+def page(magic, pageaddr, first=False):
+    if magic >= wal_compact.FLAT_PAGEADDR_MAGIC:
+        if first:
+            header = struct.pack('=HHIQI4xQII', magic,
+                                 wal_compact.XLP_LONG_HEADER, 1, pageaddr, 0,
+                                 1234, SEGMENT_SIZE, PAGE_SIZE)
+        else:
+            header = struct.pack('=HHIQI', magic, 0, 1, pageaddr, 0)
+    else:
+        xlogid, xrecoff = pageaddr >> 32, pageaddr & 0xFFFFFFFF
+        if first:
+            header = struct.pack('=HHIIIQII', magic,
+                                 wal_compact.XLP_LONG_HEADER, 1, xlogid,
+                                 xrecoff, 1234, SEGMENT_SIZE, PAGE_SIZE)
+        else:
+            header = struct.pack('=HHIII', magic, 0, 1, xlogid, xrecoff)
+
+    return header + 'r' * (PAGE_SIZE - len(header))
+
+
+def segment(magic, n_valid, name=SEGMENT_NAME):
+    """Build a segment with n_valid current pages, then stale ones"""
+    start = wal_compact.segment_start(name, SEGMENT_SIZE)
+    stale = start - 5 * SEGMENT_SIZE
+
+    pages = []
+    for i in xrange(SEGMENT_SIZE / PAGE_SIZE):
+        base = start if i < n_valid else stale
+        pages.append(page(magic, base + i * PAGE_SIZE, first=(i == 0)))
+
+    return ''.join(pages)
+
+
+def test_segment_start():
+    assert (wal_compact.segment_start(SEGMENT_NAME, SEGMENT_SIZE) ==
+            (0xA << 32) + 3 * SEGMENT_SIZE)
+    assert wal_compact.segment_start('00000002.history', SEGMENT_SIZE) is None
+
+
+@pytest.mark.parametrize('magic', [NEW_MAGIC, OLD_MAGIC])
+@pytest.mark.parametrize('n_valid', [1, 5, 16])
+def test_valid_length(magic, n_valid):
+    data = segment(magic, n_valid)
+    assert (wal_compact.valid_length(data, SEGMENT_NAME) ==
+            n_valid * PAGE_SIZE)
+
+
+def test_zeroed_pages_end_wal():
+    data = segment(NEW_MAGIC, 16)
+    data = data[:3 * PAGE_SIZE] + '\0' * (SEGMENT_SIZE - 3 * PAGE_SIZE)
+    assert wal_compact.valid_length(data, SEGMENT_NAME) == 3 * PAGE_SIZE
+
+
+def test_not_understood():
+    data = segment(NEW_MAGIC, 4)
+
+    # Named for another segment.
+    assert wal_compact.valid_length(data, '000000010000000A00000004') is None
+
+    # Not a segment at all.
+    assert wal_compact.valid_length(data, '00000002.history') is None
+
+    # Truncated.
+    assert wal_compact.valid_length(data[:-1], SEGMENT_NAME) is None
+
+    # Without a long header on the first page.
+    assert wal_compact.valid_length(data[PAGE_SIZE:] + data[:PAGE_SIZE],
+                                    SEGMENT_NAME) is None
+
+
+def test_write_cleared(tmpdir):
+    seg_path = tmpdir.join(SEGMENT_NAME)
+    data = segment(NEW_MAGIC, 2)
+    seg_path.write(data, mode='wb')
+
+    out_path = tmpdir.join('out')
+    with open(str(out_path), 'wb') as out:
+        assert wal_compact.write_cleared(str(seg_path), out) == 2 * PAGE_SIZE
+
+    cleared = out_path.read(mode='rb')
+    assert len(cleared) == SEGMENT_SIZE
+    assert cleared[:2 * PAGE_SIZE] == data[:2 * PAGE_SIZE]
+    assert cleared[2 * PAGE_SIZE:] == '\0' * (SEGMENT_SIZE - 2 * PAGE_SIZE)
+
+    # The segment in pg_xlog is left alone.
+    assert seg_path.read(mode='rb') == data
+
+
+def test_write_unchanged(tmpdir):
+    hist_path = tmpdir.join('00000002.history')
+    hist_path.write('1\t0/3000090\tno recovery target specified\n')
+
+    out_path = tmpdir.join('out')
+    with open(str(out_path), 'wb') as out:
+        assert wal_compact.write_cleared(str(hist_path), out) is None
+
+    assert out_path.read() == hist_path.read()
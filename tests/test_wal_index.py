@@ -0,0 +1,151 @@
+import pytest
+
+from wal_e.worker import wal_index
+from wal_e.worker.wal_index import WalIndex
+
+WAL_URI = 's3://bucket/prefix/wal_005/'
+
+
+def key(name):
+    return 'prefix/wal_005/' + name + '.lzo'
+
+
+class FakeBlobstore(object):
+    def __init__(self, names):
+        self.keys = sorted(key(n) for n in names)
+        self.listings = []
+        self.stats = []
+
+    def uri_list(self, creds, uri, start_after=None):
+        assert uri == WAL_URI
+        self.listings.append(start_after)
+        return [k for k in self.keys
+                if start_after is None or k > start_after]
+
+    def uri_stat(self, creds, uri):
+        assert uri.startswith(WAL_URI)
+        self.stats.append(uri)
+        if uri[len('s3://bucket/'):] in self.keys:
+            return object()
+        return None
+
+    def add(self, name):
+        self.keys = sorted(self.keys + [key(name)])
+
+
+@pytest.fixture
+def now(monkeypatch):
+    t = [1000.0]
+    monkeypatch.setattr(wal_index.time, 'time', lambda: t[0])
+    return t
+
+
+def seg(n):
+    return '00000001000000000000{0:04X}'.format(n)
+
+
+def test_wal_file_name():
+    assert wal_index.wal_file_name(key(seg(1))) == seg(1)
+    assert wal_index.wal_file_name('/p/wal_005/00000002.history.lzo') == \
+        '00000002.history'
+
+
+def test_missing(tmpdir, now):
+    store = FakeBlobstore([seg(1), seg(2)])
+    index = WalIndex(str(tmpdir), store, None, WAL_URI)
+
+    assert not index.missing(seg(1), 10)
+    assert index.missing(seg(3), 10)
+    assert index.missing('00000002.history', 10)
+    assert store.listings == [None]
+
+    # Within the allowed age, nothing is listed again.
+    store.add(seg(3))
+    assert index.missing(seg(3), 10)
+    assert len(store.listings) == 1
+
+    # Afterwards, only what follows the last key is listed.
+    now[0] += 11
+    assert not index.missing(seg(3), 10)
+    assert store.listings == [None, key(seg(2))]
+
+    # Files after the last key are not looked up one by one.
+    assert store.stats == []
+
+
+def test_persisted(tmpdir, now):
+    store = FakeBlobstore([seg(1)])
+    WalIndex(str(tmpdir), store, None, WAL_URI).refresh()
+
+    index = WalIndex(str(tmpdir), store, None, WAL_URI)
+    assert not index.missing(seg(1), 10)
+    assert index.missing(seg(2), 10)
+    assert store.listings == [None]
+
+    # The index of another archive is not used.
+    other = WalIndex(str(tmpdir), store, None, WAL_URI + 'other/')
+    assert other.names == set()
+
+
+def test_relist(tmpdir, now):
+    store = FakeBlobstore([seg(1), seg(3)])
+    index = WalIndex(str(tmpdir), store, None, WAL_URI)
+    index.refresh()
+
+    # Archived out of order: not seen by listing what follows the
+    # last key, but found by looking it up.
+    store.add(seg(2))
+    now[0] += 11
+    assert not index.missing(seg(2), 10)
+    assert store.stats == [WAL_URI + seg(2) + '.lzo']
+    assert store.listings[-1] == key(seg(3))
+
+    # Then remembered, until a complete listing.
+    assert not index.missing(seg(2), 10)
+    assert len(store.stats) == 1
+
+    now[0] += wal_index.RELIST_INTERVAL
+    index.refresh()
+    assert store.listings[-1] is None
+    assert seg(2) in index.names
+
+
+def test_gap(tmpdir, now):
+    store = FakeBlobstore([seg(1), seg(3)])
+    index = WalIndex(str(tmpdir), store, None, WAL_URI)
+
+    # A gap before the last key is confirmed before being reported.
+    assert index.missing(seg(2), 10)
+    assert store.stats == [WAL_URI + seg(2) + '.lzo']
+
+
+def test_saved_when_changed(tmpdir, now, monkeypatch):
+    store = FakeBlobstore([seg(1)])
+    index = WalIndex(str(tmpdir), store, None, WAL_URI)
+
+    saved = []
+    real_save = index._save
+    monkeypatch.setattr(index, '_save',
+                        lambda: saved.append(1) or real_save())
+
+    index.refresh()
+    assert len(saved) == 1
+
+    # Listing nothing new leaves the index file alone.
+    now[0] += 11
+    index.refresh()
+    assert len(saved) == 1
+
+    store.add(seg(2))
+    now[0] += 11
+    index.refresh()
+    assert len(saved) == 2
+
+
+def test_listing_failure(tmpdir, now):
+    class BrokenBlobstore(object):
+        def uri_list(self, creds, uri, start_after=None):
+            raise IOError('connection reset')
+
+    index = WalIndex(str(tmpdir), BrokenBlobstore(), None, WAL_URI)
+    assert not index.missing(seg(1), 10)
@@ -0,0 +1,229 @@
+"""A resident process serving wal-push and wal-fetch requests
+
+Postgres runs archive_command and restore_command once per segment,
+and starting WAL-E every time costs interpreter start-up, imports,
+credential and connection set-up.  The agent pays those once, and is
+sent requests over a Unix socket by the lightweight client in
+wal_e.client.
+
+The protocol is one JSON object per line in each direction.  Requests
+look like:
+
+    {"op": "wal-push", "path": "/abs/pg_xlog/000000010000000000000002"}
+
+    {"op": "wal-fetch", "segment": "000000010000000000000002",
+     "destination": "/abs/pg_xlog/RECOVERYXLOG"}
+
+and are answered with:
+
+    {"status": 0}
+
+where the status is the exit status "wal-e wal-push" or "wal-e
+wal-fetch" would have had.
+
+"""
+import errno
+import json
+import os
+import stat
+import sys
+import traceback
+
+import gevent
+import gevent.pool
+
+from gevent import socket
+from gevent.server import StreamServer
+
+from wal_e import log_help
+from wal_e.exception import UserException
+from wal_e.worker import WalSegment
+from wal_e.worker import prefetch
+
+logger = log_help.WalELogger(__name__)
+
+# Exit statuses, as used by wal_e.cmd.main.
+STATUS_OK = 0
+STATUS_FAILED = 1
+STATUS_UNEXPECTED = 2
+
+# The longest path a Unix socket can be bound to: sun_path holds 108
+# bytes on Linux, including the terminating NUL.
+MAX_SOCKET_PATH = 107
+
+
+def socket_path_fits(socket_path):
+    """Check if a Unix socket can be bound to socket_path"""
+    if isinstance(socket_path, unicode):
+        socket_path = socket_path.encode(sys.getfilesystemencoding() or
+                                         'utf-8')
+
+    return len(socket_path) <= MAX_SOCKET_PATH
+
+
+def bind_unix_socket(socket_path):
+    """Bind a listening Unix socket, replacing a stale one
+
+    A socket file is only considered stale if nothing accepts
+    connections on it, to avoid running two agents at once.
+
+    """
+    if not socket_path_fits(socket_path):
+        raise UserException(
+            msg='socket path is too long',
+            detail=('{0} is longer than the {1} bytes a Unix socket '
+                    'path can have.'.format(socket_path, MAX_SOCKET_PATH)),
+            hint='Choose a shorter path for the socket.')
+
+    try:
+        st = os.lstat(socket_path)
+    except EnvironmentError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    else:
+        if not stat.S_ISSOCK(st.st_mode):
+            raise UserException(
+                msg='agent socket path is in use',
+                detail=('{0} exists and is not a socket.'
+                        .format(socket_path)))
+
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except socket.error:
+            os.unlink(socket_path)
+        else:
+            raise UserException(
+                msg='another agent is already running',
+                detail=('An agent is accepting connections on {0}.'
+                        .format(socket_path)))
+        finally:
+            probe.close()
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    # Only the owner (i.e. the Postgres user) should be able to send
+    # requests.
+    old_umask = os.umask(0177)
+    try:
+        listener.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+
+    listener.listen(64)
+
+    return listener
+
+
+class Agent(object):
+
+    def __init__(self, backup_cxt, socket_path, pool_size, prefetch_max,
+                 clear_xlog_tail=False, watch_xlog_dir=None):
+        self.backup_cxt = backup_cxt
+        self.socket_path = socket_path
+        self.pool_size = pool_size
+        self.prefetch_max = prefetch_max
+        self.clear_xlog_tail = clear_xlog_tail
+
+        # With a watched pg_xlog, segments are uploaded as soon as
+        # they are ready, and wal-push requests mostly wait for
+        # uploads that are already done or under way.
+        if watch_xlog_dir is not None:
+            self.watcher = backup_cxt.wal_archive_watcher(
+                watch_xlog_dir, pool_size, clear_xlog_tail=clear_xlog_tail)
+        else:
+            self.watcher = None
+
+        # Pushes run one at a time: each may also upload other
+        # segments marked .ready, which must not be raced.
+        self.push_pool = gevent.pool.Pool(size=1)
+
+        # Base directory => Prefetcher of segments restored there.
+        self.prefetchers = {}
+
+    def serve_forever(self):
+        listener = bind_unix_socket(self.socket_path)
+        server = StreamServer(listener, self.handle)
+
+        logger.info(msg='agent accepting requests',
+                    detail='Listening on {0}.'.format(self.socket_path))
+
+        if self.watcher is not None:
+            gevent.spawn(self.watcher.run)
+
+        try:
+            server.serve_forever()
+        finally:
+            try:
+                os.unlink(self.socket_path)
+            except EnvironmentError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def handle(self, sock, address):
+        f = sock.makefile('r+b')
+
+        try:
+            for line in f:
+                status = self.dispatch(line)
+                f.write(json.dumps({'status': status}) + '\n')
+                f.flush()
+        except socket.error:
+            # The client went away, e.g. because Postgres was stopped.
+            pass
+        finally:
+            f.close()
+            sock.close()
+
+    def dispatch(self, line):
+        try:
+            request = json.loads(line)
+            op = request['op']
+
+            if op == 'wal-push':
+                ok = self.push_pool.spawn(self.push, request['path']).get()
+            elif op == 'wal-fetch':
+                ok = self.fetch(request['segment'], request['destination'])
+            else:
+                raise UserException(
+                    msg='unknown agent request',
+                    detail='The requested operation was {0!r}.'.format(op))
+
+            if ok is False:
+                return STATUS_FAILED
+
+            return STATUS_OK
+        except UserException as e:
+            logger.log(level=e.severity,
+                       msg=e.msg, detail=e.detail, hint=e.hint)
+            return STATUS_FAILED
+        except Exception:
+            logger.critical(
+                msg='An unprocessed exception has avoided all error handling',
+                detail=''.join(traceback.format_exception(*sys.exc_info())))
+            return STATUS_UNEXPECTED
+
+    def push(self, wal_path):
+        if self.watcher is not None:
+            self.watcher.archive(wal_path)
+        else:
+            self.backup_cxt.wal_archive(wal_path, concurrency=self.pool_size,
+                                        clear_xlog_tail=self.clear_xlog_tail)
+
+    def fetch(self, segment_name, destination):
+        if self.prefetch_max > 0:
+            # Wait for a download of this very segment that is in
+            # flight, rather than starting another.
+            base = os.path.dirname(os.path.realpath(destination))
+            prefetcher = self.prefetchers.get(base)
+            if prefetcher is None:
+                prefetcher = prefetch.Prefetcher(
+                    self.backup_cxt.wal_prefetch, base, self.prefetch_max,
+                    index=self.backup_cxt.wal_index(base))
+                self.prefetchers[base] = prefetcher
+
+            segment = WalSegment(segment_name)
+            prefetcher.advance(segment)
+            prefetcher.wait(segment)
+
+        return self.backup_cxt.wal_restore(segment_name, destination, 0)
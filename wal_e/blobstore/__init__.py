@@ -1,3 +1,10 @@
+import collections
+
+# What uri_stat of a blobstore reports about a stored object: its size,
+# and its MD5 digest in hex if the store keeps one.
+BlobStat = collections.namedtuple('BlobStat', ['size', 'md5'])
+
+
 def get_blobstore(layout):
     """Return Blobstore instance for a given storage layout
     Args:
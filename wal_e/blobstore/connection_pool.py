@@ -0,0 +1,61 @@
+"""Reuse of connections to a blob store within a process
+
+Every upload and download used to set up a fresh connection, which
+means a new TLS handshake and, for Swift, a new authentication
+request per object.  Connections that are returned to the pool after
+use are handed out again to later transfers for the same store and
+credentials, keeping the underlying HTTP connections alive.
+
+Greenlets are cooperatively scheduled, so no locking is needed: a
+connection is checked out by one greenlet at a time.
+
+"""
+import collections
+import contextlib
+
+# Idle connections kept per key, roughly the largest default
+# concurrency of WAL-E's transfers.
+MAX_IDLE = 8
+
+
+class ConnectionPool(object):
+
+    def __init__(self, max_idle=MAX_IDLE):
+        self.max_idle = max_idle
+        self._idle = collections.defaultdict(list)
+
+    def checkout(self, key, factory):
+        """Return an idle connection for key, or a new one from factory"""
+        idle = self._idle.get(key)
+        if idle:
+            return idle.pop()
+
+        return factory()
+
+    def checkin(self, key, conn):
+        idle = self._idle[key]
+        if len(idle) < self.max_idle:
+            idle.append(conn)
+
+    @contextlib.contextmanager
+    def connection(self, key, factory):
+        """Check out a connection for the duration of a with block
+
+        A connection is only returned to the pool if the block exits
+        normally: after an error, it may be in an unknown state.
+
+        """
+        conn = self.checkout(key, factory)
+        yield conn
+        self.checkin(key, conn)
+
+    def discard(self, key):
+        """Forget the idle connections for key"""
+        self._idle.pop(key, None)
+
+    def clear(self):
+        self._idle.clear()
+
+
+# The pool shared by everything in this process.
+pool = ConnectionPool()
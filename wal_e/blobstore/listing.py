@@ -0,0 +1,36 @@
+"""Go through listings that come a page at a time
+
+Stores list keys a page of up to a few thousand at a time, each page
+giving a marker to request the next one with.  Requesting a page only
+once the caller is done with the previous one leaves the connection
+idle while the caller works, and the caller idle while the request is
+on its way.  prefetch_pages instead requests the next page as soon as
+a page arrives, so that both happen at once.
+
+"""
+import gevent
+
+
+def prefetch_pages(get_page, marker=None):
+    """Yield the items of the pages returned by get_page
+
+    get_page is called with the marker of a page, starting with
+    marker, and returns the items of the page and the marker of the
+    next page, or None after the last page.  At most one page is
+    requested at a time.
+
+    """
+    pending = gevent.spawn(get_page, marker)
+    try:
+        while pending is not None:
+            items, marker = pending.get()
+
+            pending = None
+            if marker is not None:
+                pending = gevent.spawn(get_page, marker)
+
+            for item in items:
+                yield item
+    finally:
+        if pending is not None:
+            pending.kill()
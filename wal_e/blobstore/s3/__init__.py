@@ -1,15 +1,27 @@
 from wal_e.blobstore.s3.s3_credentials import Credentials
 from wal_e.blobstore.s3.s3_credentials import InstanceProfileCredentials
 from wal_e.blobstore.s3.s3_util import do_lzop_get
+from wal_e.blobstore.s3.s3_util import list_keys
 from wal_e.blobstore.s3.s3_util import uri_get_file
+from wal_e.blobstore.s3.s3_util import uri_get_tagged
+from wal_e.blobstore.s3.s3_util import uri_list
 from wal_e.blobstore.s3.s3_util import uri_put_file
+from wal_e.blobstore.s3.s3_util import uri_put_if_match
+from wal_e.blobstore.s3.s3_util import uri_put_stream
+from wal_e.blobstore.s3.s3_util import uri_stat
 from wal_e.blobstore.s3.s3_util import write_and_return_error
 
 __all__ = [
     'Credentials',
     'InstanceProfileCredentials',
     'do_lzop_get',
+    'list_keys',
     'uri_put_file',
+    'uri_put_if_match',
+    'uri_put_stream',
     'uri_get_file',
+    'uri_get_tagged',
+    'uri_list',
+    'uri_stat',
     'write_and_return_error',
 ]
@@ -1,8 +1,10 @@
 import boto
+import time
 
 from boto import s3
 from boto.s3 import connection
 from wal_e import log_help
+from wal_e.blobstore.s3 import host_cache
 
 logger = log_help.WalELogger(__name__)
 
@@ -142,13 +144,21 @@ class CallingInfo(object):
 
         # By this point, this is an OrdinaryCallingFormat bucket that
         # has never had its region detected in this CallingInfo
-        # instance.  So, detect its region (this can happen without
-        # knowing the right regional endpoint) and store it to speed
-        # future calls.
+        # instance.  A previous process may have detected it.
         assert self.calling_format is connection.OrdinaryCallingFormat
         assert self.region is None
         assert self.ordinary_endpoint is None
 
+        cached = host_cache.load(host_cache.bucket_entry(self.bucket_name))
+        if cached is not None:
+            self.region = cached['region']
+            self.ordinary_endpoint = cached['endpoint']
+            return _conn_help(host=self.ordinary_endpoint)
+
+        # Otherwise, detect its region (this can happen without
+        # knowing the right regional endpoint) and store it to speed
+        # future calls.
+
         conn = _conn_help()
 
         bucket = s3.bucket.Bucket(connection=conn,
@@ -185,10 +195,36 @@ class CallingInfo(object):
             self.region = loc
             self.ordinary_endpoint = _S3_REGIONS[loc]
 
+            # The fallback for a 403 above is a guess, and so only a
+            # detected region is kept for other processes.
+            host_cache.store(
+                host_cache.bucket_entry(self.bucket_name),
+                {'region': self.region,
+                 'endpoint': self.ordinary_endpoint},
+                time.time() + host_cache.REGION_TTL)
+
         # Region/endpoint information completed: connect.
         assert self.ordinary_endpoint is not None
         return _conn_help(host=self.ordinary_endpoint)
 
+    def invalidate(self):
+        """Forget a detected region, here and in the on-disk cache
+
+        Used when S3 rejects a request in a way that suggests the
+        region is wrong, so that the next connection detects it
+        again.
+        """
+        if self.calling_format is not connection.OrdinaryCallingFormat:
+            return
+
+        host_cache.invalidate(host_cache.bucket_entry(self.bucket_name))
+
+        # Names that are not subdomain compatible at all always use
+        # the us-standard endpoint; see from_store_name.
+        if _is_mostly_subdomain_compatible(self.bucket_name):
+            self.region = None
+            self.ordinary_endpoint = None
+
 
 def from_store_name(bucket_name):
     """Construct a CallingInfo value from a bucket name.
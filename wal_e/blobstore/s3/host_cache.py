@@ -0,0 +1,133 @@
+"""An optional on-disk cache of S3 set-up information
+
+Every WAL-E process would otherwise look up the region of buckets
+that need the OrdinaryCallingFormat, and, with --aws-instance-profile,
+ask the EC2 metadata service for credentials.  Because Postgres runs
+WAL-E once per WAL segment, that adds round trips to every
+archive_command and restore_command.
+
+The cache is only used if WALE_S3_CACHE_DIR names a directory.  It
+holds one small JSON file per entry, readable only by its owner and
+replaced atomically, each with the time after which it must no longer
+be used.  Entries are removed when S3 rejects a request in a way that
+suggests they are wrong, such as a redirect to another region or an
+authentication failure.
+
+"""
+import errno
+import json
+import os
+import tempfile
+import time
+
+from wal_e import log_help
+
+logger = log_help.WalELogger(__name__)
+
+# How long a detected bucket region is trusted for.  Buckets cannot
+# move between regions, but they can be deleted and re-created
+# elsewhere under the same name.
+REGION_TTL = 24 * 60 * 60
+
+# Temporary credentials are not used from the cache closer than this
+# to their expiration.  It is larger than the five minutes before
+# expiration at which boto refreshes credentials, so that a refresh
+# always goes to the metadata service.
+CREDENTIALS_MARGIN = 10 * 60
+
+# S3 response statuses that invalidate the cache: a redirect to
+# another endpoint, a bad request (such as a wrong region for a
+# signature) and an authentication failure.
+INVALIDATING_STATUSES = frozenset([301, 400, 403])
+
+INSTANCE_PROFILE_ENTRY = 'instance-profile'
+
+
+def cache_dir():
+    """Return the cache directory, or None if caching is disabled"""
+    return os.getenv('WALE_S3_CACHE_DIR') or None
+
+
+def bucket_entry(bucket_name):
+    return 'bucket-' + bucket_name
+
+
+def _entry_path(directory, name):
+    return os.path.join(directory, name + '.json')
+
+
+def load(name):
+    """Return the value stored as name if it has not expired"""
+    directory = cache_dir()
+    if directory is None:
+        return None
+
+    try:
+        with open(_entry_path(directory, name)) as f:
+            entry = json.load(f)
+
+        if entry['expires'] <= time.time():
+            return None
+
+        return entry['value']
+    except EnvironmentError as e:
+        if e.errno != errno.ENOENT:
+            logger.warning(
+                msg='could not read from the S3 cache',
+                detail='Reading entry {0!r} failed: {1}.'.format(name, e))
+        return None
+    except (ValueError, KeyError, TypeError):
+        # A damaged entry is treated like a missing one, and replaced
+        # on the next store.
+        return None
+
+
+def store(name, value, expires):
+    """Store value as name until the Unix time expires
+
+    Failures are only logged: the cache is an optimization.
+
+    """
+    directory = cache_dir()
+    if directory is None:
+        return
+
+    try:
+        try:
+            os.makedirs(directory, 0700)
+        except EnvironmentError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # mkstemp creates the file with mode 0600, so credentials
+        # are never readable by others, even before the rename.
+        fd, tmp_path = tempfile.mkstemp(prefix='.' + name,
+                                        dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'expires': expires, 'value': value}, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.rename(tmp_path, _entry_path(directory, name))
+        except:
+            os.unlink(tmp_path)
+            raise
+    except EnvironmentError as e:
+        logger.warning(
+            msg='could not write to the S3 cache',
+            detail='Writing entry {0!r} failed: {1}.'.format(name, e))
+
+
+def invalidate(name):
+    directory = cache_dir()
+    if directory is None:
+        return
+
+    try:
+        os.unlink(_entry_path(directory, name))
+    except EnvironmentError as e:
+        if e.errno != errno.ENOENT:
+            logger.warning(
+                msg='could not remove an entry from the S3 cache',
+                detail='Removing entry {0!r} failed: {1}.'.format(name, e))
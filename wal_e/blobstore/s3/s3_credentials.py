@@ -1,7 +1,15 @@
+import calendar
+import time
+
 from boto import provider
+from datetime import datetime
 from functools import partial
+from wal_e.blobstore.s3 import host_cache
 from wal_e.exception import UserException
 
+# The format of expiration times given by the metadata service.
+_EXPIRATION_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
 
 class InstanceProfileProvider(provider.Provider):
     """Override boto Provider to control use of the AWS metadata store
@@ -28,6 +36,48 @@ class InstanceProfileProvider(provider.Provider):
                                 hint='Check that your instance has an IAM '
                                 'profile or set --aws-access-key-id')
 
+    def _populate_keys_from_metadata_server(self):
+        """Use temporary credentials cached by another WAL-E process
+
+        Only if they are not about to expire: otherwise, or if there
+        are none, ask the metadata service and cache its answer.
+
+        """
+        cached = host_cache.load(host_cache.INSTANCE_PROFILE_ENTRY)
+        if cached is not None:
+            self._access_key = cached['access_key']
+            self._secret_key = cached['secret_key']
+            self._security_token = cached['security_token']
+            self._credential_expiry_time = datetime.strptime(
+                cached['expiration'], _EXPIRATION_FORMAT)
+            return
+
+        super(InstanceProfileProvider,
+              self)._populate_keys_from_metadata_server()
+
+        if self._secret_key and self._credential_expiry_time is not None:
+            expires = calendar.timegm(
+                self._credential_expiry_time.utctimetuple())
+            if expires - host_cache.CREDENTIALS_MARGIN > time.time():
+                host_cache.store(
+                    host_cache.INSTANCE_PROFILE_ENTRY,
+                    {'access_key': self._access_key,
+                     'secret_key': self._secret_key,
+                     'security_token': self._security_token,
+                     'expiration': self._credential_expiry_time.strftime(
+                         _EXPIRATION_FORMAT)},
+                    expires - host_cache.CREDENTIALS_MARGIN)
+
+    def invalidate(self):
+        """Forget the credentials, e.g. after they have been rejected
+
+        They are removed from the on-disk cache, and marked as expired
+        so that boto fetches new ones before their next use.
+
+        """
+        host_cache.invalidate(host_cache.INSTANCE_PROFILE_ENTRY)
+        self._credential_expiry_time = datetime.utcnow()
+
 
 Credentials = partial(provider.Provider, "aws")
 InstanceProfileCredentials = partial(InstanceProfileProvider, 'aws')
@@ -1,12 +1,20 @@
+from cStringIO import StringIO
 from urlparse import urlparse
+import contextlib
 import socket
 import traceback
 import gevent
+import gevent.pool
 
 import boto
 
 from . import calling_format
+from . import host_cache
+from . import s3_credentials
 from wal_e import log_help
+from wal_e.blobstore import BlobStat
+from wal_e.blobstore.connection_pool import pool
+from wal_e.blobstore.listing import prefetch_pages
 from wal_e.pipeline import get_download_pipeline
 from wal_e.piper import PIPE
 from wal_e.retries import retry, retry_with_count
@@ -24,13 +32,66 @@ if not boto.config.has_option('Boto', 'http_socket_timeout'):
     boto.config.set('Boto', 'http_socket_timeout', '5')
 
 
+# Size of the parts of multipart uploads of streams, and the largest
+# stream uploaded in one request.  S3 requires parts of at least 5MiB.
+S3_PART_SIZE = 8 * 1024 * 1024
+
+
+# Bucket name => CallingInfo, so that the region of a bucket is only
+# detected once per process.
+_calling_infos = {}
+
+
+def _calling_info(bucket_name):
+    cinfo = _calling_infos.get(bucket_name)
+    if cinfo is None:
+        cinfo = calling_format.from_store_name(bucket_name)
+        _calling_infos[bucket_name] = cinfo
+
+    return cinfo
+
+
+@contextlib.contextmanager
+def _connection(creds, uri):
+    """Check out a pooled connection for the bucket of uri
+
+    Cached set-up information is invalidated if S3 rejects a request
+    made with the connection because of it.
+
+    """
+    bucket_name = urlparse(uri).netloc
+    cinfo = _calling_info(bucket_name)
+    key = ('s3', bucket_name, creds)
+
+    try:
+        with pool.connection(key, lambda: cinfo.connect(creds)) as conn:
+            yield conn
+    except boto.exception.S3ResponseError, e:
+        if e.status in host_cache.INVALIDATING_STATUSES:
+            # Idle connections were made with the same information.
+            pool.discard(key)
+            _invalidate(creds, cinfo, e)
+        raise
+
+
+def _invalidate(creds, cinfo, e):
+    logger.info(
+        msg='invalidating cached S3 connection information',
+        detail=('A request to bucket {0!r} failed with HTTP status {1}.'
+                .format(cinfo.bucket_name, e.status)))
+
+    cinfo.invalidate()
+
+    if isinstance(creds, s3_credentials.InstanceProfileProvider):
+        creds.invalidate()
+
+
 def _uri_to_key(creds, uri, conn=None):
     assert uri.startswith('s3://')
     url_tup = urlparse(uri)
     bucket_name = url_tup.netloc
-    cinfo = calling_format.from_store_name(bucket_name)
     if conn is None:
-        conn = cinfo.connect(creds)
+        conn = _calling_info(bucket_name).connect(creds)
     bucket = boto.s3.bucket.Bucket(connection=conn, name=bucket_name)
     return boto.s3.key.Key(bucket=bucket, name=url_tup.path)
 
@@ -46,6 +107,11 @@ def uri_put_file(creds, uri, fp, content_encoding=None, conn=None):
     # in mind, assert it as a precondition for using this procedure.
     assert fp.tell() == 0
 
+    if conn is None:
+        with _connection(creds, uri) as conn:
+            return uri_put_file(creds, uri, fp,
+                                content_encoding=content_encoding, conn=conn)
+
     k = _uri_to_key(creds, uri, conn=conn)
 
     if content_encoding is not None:
@@ -55,18 +121,211 @@ def uri_put_file(creds, uri, fp, content_encoding=None, conn=None):
     return k
 
 
+def _log_part_failures_on_error(exc_tup, exc_processor_cxt):
+    typ, value, tb = exc_tup
+    del exc_tup
+
+    detail = ('There have been {n} attempts to send the part so far.'
+              .format(n=exc_processor_cxt))
+
+    # Screen for certain kinds of known-errors to retry from
+    if issubclass(typ, socket.error):
+        logger.info(msg='Retrying part upload because of a socket error',
+                    detail=detail)
+    elif (issubclass(typ, boto.exception.S3ResponseError) and
+          value.error_code == 'RequestTimeTooSkewed'):
+        logger.info(msg='Retrying part upload because of a Request Skew time',
+                    detail=detail)
+    else:
+        # The stream cannot be rewound, so the upload as a whole is
+        # not retried either: let the caller do it.
+        raise typ, value, tb
+
+
+def uri_put_stream(creds, uri, stream, content_encoding=None, conn=None):
+    """Upload a stream of unknown length, such as the output of lzop
+
+    Streams of up to S3_PART_SIZE bytes are sent in one request, and
+    longer ones as a multipart upload.  Parts are held in memory so
+    that each can be retried on its own: the one being sent, and the
+    next one being read from the stream while that happens.
+
+    The upload is completed only after the stream has been read to
+    its end.
+
+    """
+    if conn is None:
+        with _connection(creds, uri) as conn:
+            return uri_put_stream(creds, uri, stream,
+                                  content_encoding=content_encoding,
+                                  conn=conn)
+
+    k = _uri_to_key(creds, uri, conn=conn)
+
+    headers = {}
+    if content_encoding is not None:
+        k.content_type = content_encoding
+        headers['Content-Type'] = content_encoding
+
+    first = stream.read(S3_PART_SIZE)
+    part = stream.read(S3_PART_SIZE)
+    if not part:
+        k.set_contents_from_string(first, encrypt_key=True)
+        return k
+
+    mp = k.bucket.initiate_multipart_upload(k.name, headers=headers,
+                                            encrypt_key=True)
+
+    @retry(retry_with_count(_log_part_failures_on_error))
+    def upload_part(part_num, data):
+        mp.upload_part_from_file(StringIO(data), part_num)
+
+    try:
+        # A pool of one greenlet: spawning waits for the previous
+        # part to be sent.
+        p = gevent.pool.Pool(size=1)
+        g = p.spawn(upload_part, 1, first)
+        size = len(first)
+        del first
+
+        part_num = 2
+        while part:
+            p.wait_available()
+            g.get()
+
+            g = p.spawn(upload_part, part_num, part)
+            size += len(part)
+            part_num += 1
+            part = stream.read(S3_PART_SIZE)
+
+        g.get()
+        mp.complete_upload()
+    except:
+        mp.cancel_upload()
+        raise
+
+    k.size = size
+    return k
+
+
+def uri_stat(creds, uri, conn=None):
+    """Return the BlobStat of the object at uri, or None if missing"""
+    if conn is None:
+        with _connection(creds, uri) as conn:
+            return uri_stat(creds, uri, conn=conn)
+
+    k = _uri_to_key(creds, uri, conn=conn)
+    k = k.bucket.get_key(k.name)
+    if k is None:
+        return None
+
+    # The ETag is the MD5 of the content, except for objects uploaded
+    # in parts.
+    etag = k.etag.strip('"')
+    return BlobStat(size=k.size, md5=None if '-' in etag else etag)
+
+
+def uri_get_tagged(creds, uri, conn=None):
+    """Return the contents of uri and their ETag, or None, None if missing"""
+    if conn is None:
+        with _connection(creds, uri) as conn:
+            return uri_get_tagged(creds, uri, conn=conn)
+
+    k = _uri_to_key(creds, uri, conn=conn)
+    try:
+        data = k.get_contents_as_string()
+    except boto.exception.S3ResponseError as e:
+        if e.status == 404:
+            return None, None
+        raise
+
+    return data, k.etag
+
+
+def uri_put_if_match(creds, uri, data, etag, conn=None):
+    """Write data to uri, if the object there still has the ETag etag
+
+    With etag None, data is only written if there is no object at uri.
+    Return whether data was written.
+
+    """
+    if conn is None:
+        with _connection(creds, uri) as conn:
+            return uri_put_if_match(creds, uri, data, etag, conn=conn)
+
+    if etag is None:
+        headers = {'If-None-Match': '*'}
+    else:
+        headers = {'If-Match': etag}
+
+    k = _uri_to_key(creds, uri, conn=conn)
+    try:
+        k.set_contents_from_string(data, headers=headers, encrypt_key=True)
+    except boto.exception.S3ResponseError as e:
+        # 412 when the object changed, and 409 when another
+        # conditional write to it was in progress.
+        if e.status in (409, 412):
+            return False
+        raise
+
+    return True
+
+
+def uri_list(creds, uri, start_after=None, conn=None):
+    """Return the sorted names of keys under the path of uri
+
+    With start_after, only names sorting after it are listed.
+
+    """
+    if conn is None:
+        with _connection(creds, uri) as conn:
+            return uri_list(creds, uri, start_after=start_after, conn=conn)
+
+    url_tup = urlparse(uri)
+    bucket = boto.s3.bucket.Bucket(connection=conn, name=url_tup.netloc)
+    return [k.name for k in list_keys(bucket, url_tup.path.lstrip('/'),
+                                      marker=start_after)]
+
+
+def list_keys(bucket, prefix, marker=None, delimiter=None):
+    """Yield the keys under prefix, requesting a page ahead
+
+    Only keys sorting after marker are listed.  With a delimiter,
+    Prefix objects are yielded for the common prefixes of the keys
+    under prefix that contain it after prefix.
+
+    """
+    def get_page(marker):
+        rs = bucket.get_all_keys(prefix=prefix, marker=marker,
+                                 delimiter=delimiter)
+        if not rs.is_truncated:
+            return rs, None
+
+        # The next marker is only given when listing with a delimiter.
+        return rs, rs.next_marker or rs[-1].name
+
+    return prefetch_pages(get_page, marker)
+
+
 def uri_get_file(creds, uri, conn=None):
+    if conn is None:
+        with _connection(creds, uri) as conn:
+            return uri_get_file(creds, uri, conn=conn)
+
     k = _uri_to_key(creds, uri, conn=conn)
     return k.get_contents_as_string()
 
 
-def do_lzop_get(creds, url, path, decrypt, do_retry=True):
+def do_lzop_get(creds, url, path, decrypt, do_retry=True, raw=False):
     """
     Get and decompress a S3 URL
 
     This streams the content directly to lzop; the compressed version
     is never stored on disk.
 
+    With raw, the object is stored as it is instead: compressed, and
+    encrypted if it was.
+
     """
     assert url.endswith('.lzo'), 'Expect an lzop-compressed file'
 
@@ -108,31 +367,34 @@ def do_lzop_get(creds, url, path, decrypt, do_retry=True):
 
     def download():
         with open(path, 'wb') as decomp_out:
-            key = _uri_to_key(creds, url)
-            with get_download_pipeline(PIPE, decomp_out, decrypt) as pl:
-                g = gevent.spawn(write_and_return_error, key, pl.stdin)
-
-                try:
-                    # Raise any exceptions from write_and_return_error
-                    exc = g.get()
-                    if exc is not None:
-                        raise exc
-                except boto.exception.S3ResponseError, e:
-                    if e.status == 404:
-                        # Do not retry if the key not present, this
-                        # can happen under normal situations.
-                        pl.abort()
-                        logger.warning(
-                            msg=('could no longer locate object while '
-                                 'performing wal restore'),
-                            detail=('The absolute URI that could not be '
-                                    'located is {url}.'.format(url=url)),
-                            hint=('This can be normal when Postgres is trying '
-                                  'to detect what timelines are available '
-                                  'during restoration.'))
-                        return False
-                    else:
-                        raise
+            with _connection(creds, url) as conn:
+                key = _uri_to_key(creds, url, conn=conn)
+                with get_download_pipeline(
+                        PIPE, decomp_out, decrypt and not raw,
+                        lzop=not raw) as pl:
+                    g = gevent.spawn(write_and_return_error, key, pl.stdin)
+
+                    try:
+                        # Raise any exceptions from write_and_return_error
+                        exc = g.get()
+                        if exc is not None:
+                            raise exc
+                    except boto.exception.S3ResponseError, e:
+                        if e.status == 404:
+                            # Do not retry if the key not present, this
+                            # can happen under normal situations.
+                            pl.abort()
+                            logger.warning(
+                                msg=('could no longer locate object while '
+                                     'performing wal restore'),
+                                detail=('The absolute URI that could not be '
+                                        'located is {url}.'.format(url=url)),
+                                hint=('This can be normal when Postgres is '
+                                      'trying to detect what timelines are '
+                                      'available during restoration.'))
+                            return False
+                        else:
+                            raise
 
             logger.info(
                 msg='completed download and decompression',
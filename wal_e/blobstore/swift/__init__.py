@@ -1,13 +1,23 @@
 from wal_e.blobstore.swift.credentials import Credentials
 from wal_e.blobstore.swift.utils import (
-    uri_put_file, uri_get_file, do_lzop_get, write_and_return_error, SwiftKey
+    uri_put_file, uri_put_stream, uri_get_file, uri_list, uri_stat,
+    uri_get_tagged, uri_put_if_match,
+    do_lzop_get, clone_connection, list_objects,
+    write_and_return_error, SwiftKey
 )
 
 __all__ = [
     "Credentials",
     "uri_put_file",
+    "uri_put_stream",
     "uri_get_file",
+    "uri_list",
+    "uri_stat",
+    "uri_get_tagged",
+    "uri_put_if_match",
     "do_lzop_get",
+    "clone_connection",
+    "list_objects",
     "write_and_return_error",
     "SwiftKey",
 ]
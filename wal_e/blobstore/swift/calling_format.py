@@ -1,11 +1,44 @@
 import swiftclient
 
+# Storage URL and auth token per set of credentials, so that new
+# connections need not authenticate again.
+_auth_cache = {}
+
+
+def _auth_key(creds):
+    return (creds.authurl, creds.user, creds.tenant_name, creds.region,
+            creds.endpoint_type)
+
+
+class _Connection(swiftclient.Connection):
+    """A connection sharing each token it gets with new connections"""
+
+    def __init__(self, auth_key, *args, **kwargs):
+        super(_Connection, self).__init__(*args, **kwargs)
+        self._auth_key = auth_key
+
+    def get_auth(self):
+        # swiftclient calls get_auth again when a request fails with
+        # 401.  Forget the expired token first, so that connections
+        # made while authentication fails do not reuse it.
+        _auth_cache.pop(self._auth_key, None)
+        auth = super(_Connection, self).get_auth()
+        _auth_cache[self._auth_key] = auth
+        return auth
+
 
 def connect(creds):
     """
     Construct a connection value from a container
     """
-    return swiftclient.Connection(
+    cached = _auth_cache.get(_auth_key(creds))
+    if cached is None:
+        preauthurl, preauthtoken = None, None
+    else:
+        preauthurl, preauthtoken = cached
+
+    conn = _Connection(
+        _auth_key(creds),
         authurl=creds.authurl,
         user=creds.user,
         key=creds.password,
@@ -14,5 +47,19 @@ def connect(creds):
         os_options={
             "region_name": creds.region,
             "endpoint_type": creds.endpoint_type
-        }
+        },
+        preauthurl=preauthurl,
+        preauthtoken=preauthtoken,
     )
+
+    if cached is None:
+        # Authenticate right away to share the token.  An expired
+        # token is renewed by swiftclient, which retries requests
+        # failing with 401 after authenticating again.
+        conn.url, conn.token = conn.get_auth()
+
+    return conn
+
+
+def pool_key(creds):
+    return ('swift',) + _auth_key(creds)
@@ -1,3 +1,4 @@
+import copy
 import socket
 import traceback
 from urlparse import urlparse
@@ -7,6 +8,9 @@ import gevent
 from swiftclient.exceptions import ClientException
 
 from wal_e import log_help
+from wal_e.blobstore import BlobStat
+from wal_e.blobstore.connection_pool import pool
+from wal_e.blobstore.listing import prefetch_pages
 from wal_e.blobstore.swift import calling_format
 from wal_e.pipeline import get_download_pipeline
 from wal_e.piper import PIPE
@@ -23,14 +27,37 @@ class SwiftKey(object):
         self.last_modified = last_modified
 
 
-def uri_put_file(creds, uri, fp, content_encoding=None):
+def _connection(creds):
+    """Check out a pooled connection for the duration of a with block"""
+    return pool.connection(calling_format.pool_key(creds),
+                           lambda: calling_format.connect(creds))
+
+
+def clone_connection(conn):
+    """Return a copy of conn for use alongside it in another greenlet
+
+    A connection makes one request at a time, over a single HTTP
+    connection.  The copy shares the authentication of conn, but
+    opens an HTTP connection of its own.
+
+    """
+    clone = copy.copy(conn)
+    clone.http_conn = None
+    return clone
+
+
+def uri_put_file(creds, uri, fp, content_encoding=None, conn=None):
     assert fp.tell() == 0
     assert uri.startswith('swift://')
 
+    if conn is None:
+        with _connection(creds) as conn:
+            return uri_put_file(creds, uri, fp,
+                                content_encoding=content_encoding, conn=conn)
+
     url_tup = urlparse(uri)
 
     container_name = url_tup.netloc
-    conn = calling_format.connect(creds)
 
     conn.put_object(
         container_name, url_tup.path, fp, content_type=content_encoding
@@ -40,13 +67,51 @@ def uri_put_file(creds, uri, fp, content_encoding=None):
     return SwiftKey(url_tup.path, size=fp.tell())
 
 
-def do_lzop_get(creds, uri, path, decrypt, do_retry=True):
+class _CountingReader(object):
+    def __init__(self, fp):
+        self.fp = fp
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fp.read(size if size >= 0 else None)
+        self.size += len(data)
+        return data
+
+
+def uri_put_stream(creds, uri, fp, content_encoding=None, conn=None):
+    """Upload from a file object read to its end, such as a pipe
+
+    The object is sent with chunked transfer encoding as the stream
+    is read.  Since the stream cannot be rewound, swiftclient does
+    not retry such uploads: the caller has to.
+
+    """
+    assert uri.startswith('swift://')
+
+    if conn is None:
+        with _connection(creds) as conn:
+            return uri_put_stream(creds, uri, fp,
+                                  content_encoding=content_encoding,
+                                  conn=conn)
+
+    url_tup = urlparse(uri)
+    reader = _CountingReader(fp)
+    conn.put_object(url_tup.netloc, url_tup.path, reader,
+                    content_type=content_encoding)
+
+    return SwiftKey(url_tup.path, size=reader.size)
+
+
+def do_lzop_get(creds, uri, path, decrypt, do_retry=True, raw=False):
     """
     Get and decompress a Swift URL
 
     This streams the content directly to lzop; the compressed version
     is never stored on disk.
 
+    With raw, the object is stored as it is instead: compressed, and
+    encrypted if it was.
+
     """
     assert uri.endswith('.lzo'), 'Expect an lzop-compressed file'
 
@@ -84,15 +149,17 @@ def do_lzop_get(creds, uri, path, decrypt, do_retry=True):
 
     def download():
         with open(path, 'wb') as decomp_out:
-            with get_download_pipeline(PIPE, decomp_out, decrypt) as pl:
+            with get_download_pipeline(
+                    PIPE, decomp_out, decrypt and not raw, lzop=not raw) as pl:
 
-                conn = calling_format.connect(creds)
+                conn = pool.checkout(calling_format.pool_key(creds),
+                                     lambda: calling_format.connect(creds))
 
                 g = gevent.spawn(write_and_return_error, uri, conn, pl.stdin)
 
                 # Raise any exceptions from write_and_return_error
+                exc = g.get()
                 try:
-                    exc = g.get()
                     if exc is not None:
                         raise exc
                 except ClientException as e:
@@ -111,6 +178,12 @@ def do_lzop_get(creds, uri, path, decrypt, do_retry=True):
                         return False
                     else:
                         raise
+                finally:
+                    # A complete response, a 404 included, leaves the
+                    # connection fit for reuse; other errors may not.
+                    if (exc is None or
+                            getattr(exc, 'http_status', None) == 404):
+                        pool.checkin(calling_format.pool_key(creds), conn)
 
             logger.info(
                 msg='completed download and decompression',
@@ -132,13 +205,177 @@ def uri_get_file(creds, uri, conn=None, resp_chunk_size=None):
     object_name = url_tup.path
 
     if conn is None:
-        conn = calling_format.connect(creds)
+        if resp_chunk_size is not None:
+            # The response is read lazily, tying up the connection
+            # after returning, so it cannot go back into the pool.
+            conn = calling_format.connect(creds)
+        else:
+            with _connection(creds) as conn:
+                return uri_get_file(creds, uri, conn=conn)
+
     _, content = conn.get_object(
         container_name, object_name, resp_chunk_size=resp_chunk_size
     )
     return content
 
 
+def uri_get_tagged(creds, uri, conn=None):
+    """Return the contents of uri and their ETag, or None, None if missing"""
+    assert uri.startswith('swift://')
+    url_tup = urlparse(uri)
+
+    if conn is None:
+        with _connection(creds) as conn:
+            return uri_get_tagged(creds, uri, conn=conn)
+
+    try:
+        headers, content = conn.get_object(url_tup.netloc, url_tup.path)
+    except ClientException as e:
+        if e.http_status == 404:
+            return None, None
+        raise
+
+    return content, headers.get('etag')
+
+
+def uri_put_if_match(creds, uri, data, etag, conn=None):
+    """Write data to uri, if the object there still has the ETag etag
+
+    With etag None, data is only written if there is no object at uri.
+    Return whether data was written.
+
+    Swift only makes writes conditional on there being no object, so
+    replacing an object is guarded by a lock object next to it, which
+    is created on that condition.  Holding the lock, the ETag is
+    checked, and the object replaced, which other conditional writes
+    cannot do meanwhile.  Like a lease on WABS, the lock expires after
+    15 seconds, should its holder never remove it.
+
+    """
+    assert uri.startswith('swift://')
+    url_tup = urlparse(uri)
+    container, name = url_tup.netloc, url_tup.path
+
+    if conn is None:
+        with _connection(creds) as conn:
+            return uri_put_if_match(creds, uri, data, etag, conn=conn)
+
+    if etag is None:
+        return _put_if_none(conn, container, name, data)
+
+    lock = name + '.lock'
+    if not _put_if_none(conn, container, lock, '',
+                        headers={'X-Delete-After': '15'}):
+        # Locked by another writer.
+        return False
+
+    try:
+        try:
+            current = conn.head_object(container, name)
+        except ClientException as e:
+            if e.http_status == 404:
+                return False
+            raise
+
+        if current.get('etag') != etag:
+            return False
+
+        conn.put_object(container, name, data)
+    finally:
+        try:
+            conn.delete_object(container, lock)
+        except ClientException as e:
+            # Already expired.
+            if e.http_status != 404:
+                raise
+
+    return True
+
+
+def _put_if_none(conn, container, name, data, headers=None):
+    # Write data to name if there is no object there, returning
+    # whether it was written.
+    headers = dict(headers or {}, **{'If-None-Match': '*'})
+    try:
+        conn.put_object(container, name, data, headers=headers)
+    except ClientException as e:
+        if e.http_status == 412:
+            return False
+        raise
+
+    return True
+
+
+def uri_list(creds, uri, start_after=None, conn=None):
+    """Return the sorted names of objects under the path of uri
+
+    With start_after, only names sorting after it are listed.
+
+    """
+    assert uri.startswith('swift://')
+    url_tup = urlparse(uri)
+
+    if conn is None:
+        with _connection(creds) as conn:
+            return uri_list(creds, uri, start_after=start_after, conn=conn)
+
+    return [obj['name']
+            for obj in list_objects(conn, url_tup.netloc, url_tup.path,
+                                    marker=start_after)]
+
+
+def list_objects(conn, container, prefix, marker=None, end_marker=None,
+                 delimiter=None):
+    """Yield the objects under prefix, requesting a page ahead
+
+    Only objects sorting after marker, and before end_marker, are
+    listed.  With a delimiter, common prefixes of the objects under
+    prefix that contain it after prefix are yielded as {"subdir":
+    prefix} entries.  Pages are requested over a copy of conn, which
+    remains free for other requests.
+
+    """
+    conn = clone_connection(conn)
+
+    def get_page(marker):
+        _, page = conn.get_container(container, prefix=prefix,
+                                     marker=marker, end_marker=end_marker,
+                                     delimiter=delimiter)
+        if not page:
+            return page, None
+
+        # The page size limit depends on the cluster, so listings
+        # only end with an empty page.
+        return page, page[-1].get('name', page[-1].get('subdir'))
+
+    return prefetch_pages(get_page, marker)
+
+
+def uri_stat(creds, uri, conn=None):
+    """Return the BlobStat of the object at uri, or None if missing"""
+    assert uri.startswith('swift://')
+    url_tup = urlparse(uri)
+
+    if conn is None:
+        with _connection(creds) as conn:
+            return uri_stat(creds, uri, conn=conn)
+
+    try:
+        headers = conn.head_object(url_tup.netloc, url_tup.path)
+    except ClientException as e:
+        if e.http_status == 404:
+            return None
+        raise
+
+    # The ETag of large (manifest) objects is not the MD5 of their
+    # content, and is quoted.
+    etag = headers.get('etag', '')
+    if headers.get('x-object-manifest') or etag.startswith('"'):
+        etag = None
+
+    return BlobStat(size=int(headers['content-length']), md5=etag or None)
+
+
 def write_and_return_error(uri, conn, stream):
     try:
         response = uri_get_file(None, uri, conn, resp_chunk_size=8192)
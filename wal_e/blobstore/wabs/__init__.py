@@ -1,13 +1,25 @@
 from wal_e.blobstore.wabs.wabs_credentials import Credentials
 from wal_e.blobstore.wabs.wabs_util import do_lzop_get
+from wal_e.blobstore.wabs.wabs_util import list_blobs
 from wal_e.blobstore.wabs.wabs_util import uri_get_file
+from wal_e.blobstore.wabs.wabs_util import uri_get_tagged
+from wal_e.blobstore.wabs.wabs_util import uri_list
 from wal_e.blobstore.wabs.wabs_util import uri_put_file
+from wal_e.blobstore.wabs.wabs_util import uri_put_if_match
+from wal_e.blobstore.wabs.wabs_util import uri_put_stream
+from wal_e.blobstore.wabs.wabs_util import uri_stat
 from wal_e.blobstore.wabs.wabs_util import write_and_return_error
 
 __all__ = [
     'Credentials',
     'do_lzop_get',
+    'list_blobs',
     'uri_get_file',
+    'uri_get_tagged',
+    'uri_list',
     'uri_put_file',
+    'uri_put_if_match',
+    'uri_put_stream',
+    'uri_stat',
     'write_and_return_error',
 ]
@@ -7,6 +7,7 @@ import socket
 import sys
 import traceback
 
+from azure import WindowsAzureConflictError
 from azure import WindowsAzureMissingResourceError
 from azure.storage import BlobService
 
@@ -14,6 +15,9 @@ from . import calling_format
 from hashlib import md5
 from urlparse import urlparse
 from wal_e import log_help
+from wal_e.blobstore import BlobStat
+from wal_e.blobstore.connection_pool import pool
+from wal_e.blobstore.listing import prefetch_pages
 from wal_e.pipeline import get_download_pipeline
 from wal_e.piper import PIPE
 from wal_e.retries import retry, retry_with_count
@@ -26,10 +30,41 @@ _Key = collections.namedtuple('_Key', ['size'])
 WABS_CHUNK_SIZE = 4 * 1024 * 1024
 
 
-def uri_put_file(creds, uri, fp, content_encoding=None):
+def _pool_key(creds):
+    return ('wabs', creds.account_name, creds.account_key)
+
+
+def _connect(creds):
+    return BlobService(creds.account_name, creds.account_key, protocol='https')
+
+
+def _connection(creds):
+    """Check out a pooled connection for the duration of a with block"""
+    return pool.connection(_pool_key(creds), lambda: _connect(creds))
+
+
+def uri_put_file(creds, uri, fp, content_encoding=None, conn=None):
     assert fp.tell() == 0
+    return uri_put_stream(creds, uri, fp, content_encoding=content_encoding,
+                          conn=conn)
+
+
+def uri_put_stream(creds, uri, fp, content_encoding=None, conn=None):
+    """Upload from a file object read to its end, such as a pipe
+
+    The blob is assembled from blocks read one at a time, which are
+    held in memory while being sent, and committed only once the
+    stream has been read to its end.
+
+    """
     assert uri.startswith('wabs://')
 
+    if conn is None:
+        with _connection(creds) as conn:
+            return uri_put_stream(creds, uri, fp,
+                                  content_encoding=content_encoding,
+                                  conn=conn)
+
     def log_upload_failures_on_error(exc_tup, exc_processor_cxt):
         def standard_detail_message(prefix=''):
             return (prefix + '  There have been {n} attempts to upload  '
@@ -76,7 +111,6 @@ def uri_put_file(creds, uri, fp, content_encoding=None):
     if content_encoding is not None:
         kwargs['x_ms_blob_content_encoding'] = content_encoding
 
-    conn = BlobService(creds.account_name, creds.account_key, protocol='https')
     conn.put_blob(url_tup.netloc, url_tup.path, '', **kwargs)
 
     # WABS requires large files to be uploaded in 4MB chunks
@@ -102,7 +136,140 @@ def uri_put_file(creds, uri, fp, content_encoding=None):
     # To maintain consistency with the S3 version of this function we must
     # return an object with a certain set of attributes.  Currently, that set
     # of attributes consists of only 'size'
-    return _Key(size=len(data))
+    return _Key(size=length)
+
+
+def uri_stat(creds, uri, conn=None):
+    """Return the BlobStat of the blob at uri, or None if missing"""
+    assert uri.startswith('wabs://')
+    url_tup = urlparse(uri)
+
+    if conn is None:
+        with _connection(creds) as conn:
+            return uri_stat(creds, uri, conn=conn)
+
+    try:
+        props = conn.get_blob_properties(url_tup.netloc, url_tup.path)
+    except WindowsAzureMissingResourceError:
+        return None
+
+    # Blobs assembled from blocks have no Content-MD5 unless one was
+    # set explicitly.
+    content_md5 = props.get('content-md5')
+    if content_md5:
+        content_md5 = base64.b64decode(content_md5).encode('hex')
+
+    return BlobStat(size=int(props['content-length']), md5=content_md5 or None)
+
+
+def uri_get_tagged(creds, uri, conn=None):
+    """Return the contents of uri and their ETag, or None, None if missing
+
+    Only meant for small blobs, which are read in one request.
+
+    """
+    assert uri.startswith('wabs://')
+    url_tup = urlparse(uri)
+
+    if conn is None:
+        with _connection(creds) as conn:
+            return uri_get_tagged(creds, uri, conn=conn)
+
+    try:
+        blob = conn.get_blob(url_tup.netloc, url_tup.path)
+    except WindowsAzureMissingResourceError:
+        return None, None
+
+    return str(blob), blob.properties['etag']
+
+
+def uri_put_if_match(creds, uri, data, etag, conn=None):
+    """Write data to uri, if the blob there still has the ETag etag
+
+    With etag None, data is only written if there is no blob at uri.
+    Return whether data was written.
+
+    The API version used cannot make writes conditional, so an
+    existing blob is leased while its ETag is checked and it is
+    replaced, which other conditional writes cannot do meanwhile.
+    Nothing can be leased before the blob exists, so with etag None,
+    an empty blob is created instead of data, and False returned: the
+    caller is to read it, and try again.  Creating it may empty a blob
+    written meanwhile by another writer, so callers must take an empty
+    blob for a missing one, to be rebuilt.
+
+    """
+    assert uri.startswith('wabs://')
+    url_tup = urlparse(uri)
+    container, name = url_tup.netloc, url_tup.path
+
+    if conn is None:
+        with _connection(creds) as conn:
+            return uri_put_if_match(creds, uri, data, etag, conn=conn)
+
+    if etag is None:
+        if uri_stat(creds, uri, conn=conn) is None:
+            conn.put_blob(container, name, '', 'BlockBlob')
+
+        return False
+
+    try:
+        lease = conn.lease_blob(container, name, 'acquire',
+                                x_ms_lease_duration=15)
+    except WindowsAzureMissingResourceError:
+        return False
+    except WindowsAzureConflictError:
+        # Leased by another writer.
+        return False
+
+    lease_id = lease['x-ms-lease-id']
+    try:
+        props = conn.get_blob_properties(container, name)
+        if props['etag'] != etag:
+            return False
+
+        conn.put_blob(container, name, data, 'BlockBlob',
+                      x_ms_lease_id=lease_id)
+    finally:
+        conn.lease_blob(container, name, 'release', x_ms_lease_id=lease_id)
+
+    return True
+
+
+def uri_list(creds, uri, start_after=None, conn=None):
+    """Return the sorted names of blobs under the path of uri
+
+    With start_after, only names sorting after it are returned.  Blob
+    listings can only be resumed from the marker of a previous page,
+    not from a name, so the whole listing is still requested.
+
+    """
+    assert uri.startswith('wabs://')
+    url_tup = urlparse(uri)
+
+    if conn is None:
+        with _connection(creds) as conn:
+            return uri_list(creds, uri, start_after=start_after, conn=conn)
+
+    return [blob.name
+            for blob in list_blobs(conn, url_tup.netloc, url_tup.path)
+            if start_after is None or blob.name > start_after]
+
+
+def list_blobs(conn, container, prefix, delimiter=None):
+    """Yield the blobs under prefix, requesting a page ahead
+
+    With a delimiter, BlobPrefix objects are yielded for the common
+    prefixes of the blobs under prefix that contain it after prefix.
+
+    """
+    def get_page(marker):
+        blob_list = conn.list_blobs(container, prefix=prefix, marker=marker,
+                                    delimiter=delimiter)
+        return (list(blob_list.blobs) + list(blob_list.prefixes),
+                blob_list.next_marker or None)
+
+    return prefetch_pages(get_page)
 
 
 def uri_get_file(creds, uri, conn=None):
@@ -110,8 +277,8 @@ def uri_get_file(creds, uri, conn=None):
     url_tup = urlparse(uri)
 
     if conn is None:
-        conn = BlobService(creds.account_name, creds.account_key,
-                           protocol='https')
+        with _connection(creds) as conn:
+            return uri_get_file(creds, uri, conn=conn)
 
     # Determin the size of the target blob
     props = conn.get_blob_properties(url_tup.netloc, url_tup.path)
@@ -155,18 +322,21 @@ def uri_get_file(creds, uri, conn=None):
     return data
 
 
-def do_lzop_get(creds, url, path, decrypt, do_retry=True):
+def do_lzop_get(creds, url, path, decrypt, do_retry=True, raw=False):
     """
     Get and decompress a S3 URL
 
     This streams the content directly to lzop; the compressed version
     is never stored on disk.
 
+    With raw, the object is stored as it is instead: compressed, and
+    encrypted if it was.
+
     """
     assert url.endswith('.lzo'), 'Expect an lzop-compressed file'
     assert url.startswith('wabs://')
 
-    conn = BlobService(creds.account_name, creds.account_key, protocol='https')
+    conn = pool.checkout(_pool_key(creds), lambda: _connect(creds))
 
     def log_wal_fetch_failures_on_error(exc_tup, exc_processor_cxt):
         def standard_detail_message(prefix=''):
@@ -202,7 +372,8 @@ def do_lzop_get(creds, url, path, decrypt, do_retry=True):
 
     def download():
         with open(path, 'wb') as decomp_out:
-            with get_download_pipeline(PIPE, decomp_out, decrypt) as pl:
+            with get_download_pipeline(
+                    PIPE, decomp_out, decrypt and not raw, lzop=not raw) as pl:
                 g = gevent.spawn(write_and_return_error, url, conn, pl.stdin)
 
                 try:
@@ -235,7 +406,12 @@ def do_lzop_get(creds, url, path, decrypt, do_retry=True):
         download = retry(
             retry_with_count(log_wal_fetch_failures_on_error))(download)
 
-    return download()
+    ret = download()
+
+    # Only reached without errors, so the connection can be reused.
+    pool.checkin(_pool_key(creds), conn)
+
+    return ret
 
 
 def write_and_return_error(url, conn, stream):
@@ -0,0 +1,109 @@
+"""Forward wal-push and wal-fetch to a running "wal-e agent"
+
+Meant to be used as archive_command and restore_command, such as:
+
+    archive_command = 'wal-e-client wal-push %p'
+    restore_command = 'wal-e-client wal-fetch %f %p'
+
+with the socket given by --socket or WALE_AGENT_SOCKET.
+
+This module is deliberately limited to the standard library, so that
+it starts quickly.  If no agent can be reached, the request is run by
+an ordinary "wal-e" process instead, so that archiving and recovery
+keep working while the agent is down.
+
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--socket', default=os.getenv('WALE_AGENT_SOCKET'),
+        help=('Unix socket the agent listens on.  Can also be defined via '
+              'environment variable WALE_AGENT_SOCKET.'))
+
+    subparsers = parser.add_subparsers(title='subcommands',
+                                       dest='subcommand')
+
+    wal_push_parser = subparsers.add_parser(
+        'wal-push', help='push a WAL file through the agent')
+    wal_push_parser.add_argument('WAL_SEGMENT',
+                                 help='Path to a WAL segment to upload')
+
+    wal_fetch_parser = subparsers.add_parser(
+        'wal-fetch', help='fetch a WAL file through the agent')
+    wal_fetch_parser.add_argument('WAL_SEGMENT',
+                                  help='Name of the WAL segment to fetch')
+    wal_fetch_parser.add_argument('WAL_DESTINATION',
+                                  help='Path to download the WAL segment to')
+
+    return parser
+
+
+def request_for(args):
+    """Build an agent request, resolving paths against the cwd"""
+    if args.subcommand == 'wal-push':
+        return {'op': 'wal-push',
+                'path': os.path.abspath(args.WAL_SEGMENT)}
+    elif args.subcommand == 'wal-fetch':
+        return {'op': 'wal-fetch',
+                'segment': args.WAL_SEGMENT,
+                'destination': os.path.abspath(args.WAL_DESTINATION)}
+
+    assert False
+
+
+def send(socket_path, request):
+    """Send a request and return the status it was answered with"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        f = sock.makefile('r+b')
+        try:
+            f.write(json.dumps(request) + '\n')
+            f.flush()
+            response = f.readline()
+        finally:
+            f.close()
+    finally:
+        sock.close()
+
+    if not response:
+        raise socket.error('agent closed the connection without answering')
+
+    return json.loads(response)['status']
+
+
+def fallback(args):
+    """Run the request in a new wal-e process instead"""
+    if args.subcommand == 'wal-push':
+        argv = ['wal-e', 'wal-push', args.WAL_SEGMENT]
+    else:
+        argv = ['wal-e', 'wal-fetch', args.WAL_SEGMENT, args.WAL_DESTINATION]
+
+    os.execvp(argv[0], argv)
+
+
+def main():
+    args = build_parser().parse_args()
+
+    if args.socket is None:
+        fallback(args)
+
+    try:
+        status = send(args.socket, request_for(args))
+    except (socket.error, ValueError, KeyError), e:
+        print >>sys.stderr, ('wal-e-client: could not use agent at {0}: {1}; '
+                             'running wal-e instead'.format(args.socket, e))
+        fallback(args)
+
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -217,6 +217,13 @@ def build_parser():
         'Can also be defined via environment variable '
         'WALE_GPG_KEY_ID')
 
+    parser.add_argument(
+        '--catalog',
+        help='Path of a local SQLite catalog of the archive, kept up to '
+        'date by listing what changed, to list backups and plan deletions '
+        'from.  Can also be defined via environment variable '
+        'WALE_CATALOG.')
+
     parser.add_argument(
         '--terse', action='store_true',
         help='Only log messages as or more severe than a warning.')
@@ -280,6 +287,18 @@ def build_parser():
     wal_push_parser.add_argument(
         '--pool-size', '-p', type=int, default=8,
         help='Set the maximum number of concurrent transfers')
+    wal_push_parser.add_argument(
+        '--adaptive-pool-size', action='store_true', default=False,
+        help=('Choose the number of concurrent transfers, up to --pool-size, '
+              'from the segments ready and how recent uploads went'))
+    wal_push_parser.add_argument(
+        '--min-pool-size', type=int, default=1,
+        help=('Set the minimum number of concurrent transfers with '
+              '--adaptive-pool-size'))
+    wal_push_parser.add_argument(
+        '--clear-xlog-tail', action='store_true', default=False,
+        help=('Zero the unused tail of WAL segments before compression, '
+              'so that partially filled segments upload quickly'))
 
     # backup-fetch operator section
     backup_fetch_parser.add_argument('BACKUP_NAME',
@@ -298,6 +317,33 @@ def build_parser():
         type=str,
         default=None)
 
+    backup_fetch_parser.add_argument(
+        '--delta',
+        help=('Restore into an existing cluster directory, only writing '
+              'files that differ from the backup and removing files that '
+              'are not in it.  Files are compared by size and modification '
+              'time ("mtime", the default) or by content ("checksum").'),
+        nargs='?', const='mtime', choices=['mtime', 'checksum'],
+        default=None)
+
+    backup_fetch_parser.add_argument(
+        '--fetch-wal', metavar='EXTRA_SEGMENTS', type=int,
+        help=('Download the WAL segments written during the backup, and '
+              'EXTRA_SEGMENTS (default 0) segments after them, while the '
+              'backup is extracted.  They are used by wal-fetch instead '
+              'of being downloaded again.'),
+        nargs='?', const=0, default=None)
+
+    backup_fetch_parser.add_argument(
+        '--restore-only', metavar='SELECTOR', action='append',
+        help=('Only restore the contents of the selected databases, '
+              'given as a database OID, a tablespace as '
+              '"tablespace:OID", or a glob matched against paths '
+              'relative to the cluster directory.  May be given more '
+              'than once.  Other relation files are restored as empty '
+              'placeholders.'),
+        default=None)
+
     # backup-list operator section
     backup_list_parser.add_argument(
         'QUERY', nargs='?', default=None,
@@ -315,6 +361,17 @@ def build_parser():
     wal_fetch_parser.add_argument(
         '--prefetch', '-p', type=int, default=8,
         help='Set the maximum number of WAL segments to prefetch.')
+    wal_fetch_parser.add_argument(
+        '--wal-index-ttl', type=int, default=0, metavar='SECONDS',
+        help=('Report WAL files missing from a listing of the archive at '
+              'most this old as missing, without trying to download them'))
+    wal_fetch_parser.add_argument(
+        '--prefetch-budget', type=int, default=None, metavar='BYTES',
+        help='Limit the disk space taken by prefetched WAL segments')
+    wal_fetch_parser.add_argument(
+        '--prefetch-compressed', action='store_true', default=False,
+        help=('Keep prefetched WAL segments compressed until they are '
+              'needed, to save disk space'))
 
     wal_prefetch_parser = subparsers.add_parser('wal-prefetch',
                                                 help='Prefetch WAL')
@@ -323,6 +380,37 @@ def build_parser():
         help='Contains writable directory to place ".wal-e" directory in.')
     wal_prefetch_parser.add_argument('SEGMENT',
                                      help='Segment by name to download.')
+    wal_prefetch_parser.add_argument(
+        '--window', type=int, default=None,
+        help=('Keep this many segments after SEGMENT downloading, serving '
+              'wal-fetch until recovery has been idle for a while'))
+    wal_prefetch_parser.add_argument(
+        '--budget', type=int, default=None, metavar='BYTES',
+        help='Limit the disk space taken by prefetched segments (--window)')
+    wal_prefetch_parser.add_argument(
+        '--compressed', action='store_true', default=False,
+        help='Keep prefetched segments compressed until they are needed')
+
+    # agent operator section
+    agent_parser = subparsers.add_parser(
+        'agent', help=('serve wal-push and wal-fetch requests from '
+                       'wal-e-client over a Unix socket'))
+    agent_parser.add_argument(
+        'SOCKET_PATH', help='Path of the Unix socket to listen on')
+    agent_parser.add_argument(
+        '--pool-size', '-p', type=int, default=8,
+        help='Set the maximum number of concurrent WAL uploads')
+    agent_parser.add_argument(
+        '--prefetch', type=int, default=8,
+        help='Set the maximum number of WAL segments to prefetch.')
+    agent_parser.add_argument(
+        '--clear-xlog-tail', action='store_true', default=False,
+        help='Zero the unused tail of WAL segments before compression')
+    agent_parser.add_argument(
+        '--watch-xlog-dir', metavar='XLOG_DIR', default=None,
+        help=('Upload segments of this pg_xlog directory as soon as '
+              'Postgres marks them ready, rather than when they are '
+              'pushed'))
 
     # delete subparser section
     delete_parser = subparsers.add_parser(
@@ -334,6 +422,9 @@ def build_parser():
                                help=('Actually delete data.  '
                                      'By default, a dry run is performed.  '
                                      'Overridden by --dry-run.'))
+    delete_parser.add_argument(
+        '--pool-size', '-p', type=int, default=4,
+        help='Delete this many pages of up to 1000 keys concurrently')
     delete_subparsers = delete_parser.add_subparsers(
         title='delete subcommands',
         description=('All operators that may delete data are contained '
@@ -372,6 +463,15 @@ def build_parser():
         help=('Delete all data in the current WAL-E context.  '
               'Typically this is only appropriate when decommissioning an '
               'entire WAL-E archive.'))
+
+    # catalog-reconcile operator
+    catalog_reconcile_parser = subparsers.add_parser(
+        'catalog-reconcile',
+        help=('List the whole archive into the catalog again, picking up '
+              'changes made by other means than WAL-E'))
+    catalog_reconcile_parser.add_argument(
+        '--pool-size', '-p', type=int, default=4,
+        help='List WAL directories in this many ranges concurrently')
     return parser
 
 
@@ -438,6 +538,8 @@ def configure_backup_cxt(args):
     if gpg_key_id is not None:
         external_program_check([GPG_BIN])
 
+    catalog_path = args.catalog or os.getenv('WALE_CATALOG')
+
     # Enumeration of reading in configuration for all supported
     # backend data stores, yielding value adhering to the
     # 'operator.Backup' protocol.
@@ -449,7 +551,8 @@ def configure_backup_cxt(args):
 
         from wal_e.operator import s3_operator
 
-        return s3_operator.S3Backup(store, creds, gpg_key_id)
+        return s3_operator.S3Backup(store, creds, gpg_key_id,
+                                    catalog_path=catalog_path)
     elif store.is_wabs:
         account_name = args.wabs_account_name or os.getenv('WABS_ACCOUNT_NAME')
         if account_name is None:
@@ -468,7 +571,8 @@ def configure_backup_cxt(args):
 
         creds = wabs.Credentials(account_name, access_key)
 
-        return WABSBackup(store, creds, gpg_key_id)
+        return WABSBackup(store, creds, gpg_key_id,
+                          catalog_path=catalog_path)
     elif store.is_swift:
         from wal_e.blobstore import swift
         from wal_e.operator.swift_operator import SwiftBackup
@@ -481,7 +585,8 @@ def configure_backup_cxt(args):
             os.getenv('SWIFT_REGION'),
             os.getenv('SWIFT_ENDPOINT_TYPE', 'publicURL'),
         )
-        return SwiftBackup(store, creds, gpg_key_id)
+        return SwiftBackup(store, creds, gpg_key_id,
+                           catalog_path=catalog_path)
     else:
         raise UserCritical(
             msg='no unsupported blob stores should get here',
@@ -541,7 +646,10 @@ def main():
                 args.BACKUP_NAME,
                 blind_restore=args.blind_restore,
                 restore_spec=args.restore_spec,
-                pool_size=args.pool_size)
+                pool_size=args.pool_size,
+                delta=args.delta,
+                restore_only=args.restore_only,
+                fetch_wal=args.fetch_wal)
         elif subcommand == 'backup-list':
             backup_cxt.backup_list(query=args.QUERY, detail=args.detail)
         elif subcommand == 'backup-push':
@@ -573,16 +681,43 @@ def main():
             external_program_check([LZOP_BIN])
             res = backup_cxt.wal_restore(args.WAL_SEGMENT,
                                          args.WAL_DESTINATION,
-                                         args.prefetch)
+                                         args.prefetch,
+                                         index_ttl=args.wal_index_ttl,
+                                         prefetch_budget=args.prefetch_budget,
+                                         prefetch_compressed=(
+                                             args.prefetch_compressed))
             if not res:
                 sys.exit(1)
         elif subcommand == 'wal-prefetch':
             external_program_check([LZOP_BIN])
-            backup_cxt.wal_prefetch(args.BASE_DIRECTORY, args.SEGMENT)
+            if args.window is None:
+                backup_cxt.wal_prefetch(args.BASE_DIRECTORY, args.SEGMENT,
+                                        compressed=args.compressed)
+            else:
+                from wal_e import prefetcher
+
+                prefetcher.serve(backup_cxt.wal_prefetch,
+                                 args.BASE_DIRECTORY, args.SEGMENT,
+                                 args.window,
+                                 index=backup_cxt.wal_index(
+                                     args.BASE_DIRECTORY),
+                                 budget=args.budget,
+                                 compressed=args.compressed)
         elif subcommand == 'wal-push':
             external_program_check([LZOP_BIN])
             backup_cxt.wal_archive(args.WAL_SEGMENT,
-                                   concurrency=args.pool_size)
+                                   concurrency=args.pool_size,
+                                   clear_xlog_tail=args.clear_xlog_tail,
+                                   adaptive=args.adaptive_pool_size,
+                                   min_concurrency=args.min_pool_size)
+        elif subcommand == 'agent':
+            from wal_e.agent import Agent
+
+            external_program_check([LZOP_BIN])
+            Agent(backup_cxt, args.SOCKET_PATH, pool_size=args.pool_size,
+                  prefetch_max=args.prefetch,
+                  clear_xlog_tail=args.clear_xlog_tail,
+                  watch_xlog_dir=args.watch_xlog_dir).serve_forever()
         elif subcommand == 'delete':
             # Set up pruning precedence, optimizing for *not* deleting data
             #
@@ -597,32 +732,40 @@ def main():
                 logger.info(msg='performing dry run of data deletion')
                 is_dry_run_really = True
 
-                import boto.s3.key
-                import boto.s3.bucket
+                if backup_cxt.layout.is_s3:
+                    import boto.s3.key
+                    import boto.s3.bucket
 
-                # This is not necessary, but "just in case" to find bugs.
-                def just_error(*args, **kwargs):
-                    assert False, ('About to delete something in '
-                                   'dry-run mode.  Please report a bug.')
+                    # This is not necessary, but "just in case" to
+                    # find bugs.
+                    def just_error(*args, **kwargs):
+                        assert False, ('About to delete something in '
+                                       'dry-run mode.  Please report a bug.')
 
-                boto.s3.key.Key.delete = just_error
-                boto.s3.bucket.Bucket.delete_keys = just_error
+                    boto.s3.key.Key.delete = just_error
+                    boto.s3.bucket.Bucket.delete_keys = just_error
 
             # Handle the subcommands and route them to the right
             # implementations.
             if args.delete_subcommand == 'old-versions':
-                backup_cxt.delete_old_versions(is_dry_run_really)
+                backup_cxt.delete_old_versions(is_dry_run_really,
+                                               pool_size=args.pool_size)
             elif args.delete_subcommand == 'everything':
-                backup_cxt.delete_all(is_dry_run_really)
+                backup_cxt.delete_all(is_dry_run_really,
+                                      pool_size=args.pool_size)
             elif args.delete_subcommand == 'retain':
                 backup_cxt.delete_with_retention(is_dry_run_really,
-                                                 args.NUM_TO_RETAIN)
+                                                 args.NUM_TO_RETAIN,
+                                                 pool_size=args.pool_size)
             elif args.delete_subcommand == 'before':
                 segment_info = extract_segment(args.BEFORE_SEGMENT_EXCLUSIVE)
                 assert segment_info is not None
-                backup_cxt.delete_before(is_dry_run_really, segment_info)
+                backup_cxt.delete_before(is_dry_run_really, segment_info,
+                                         pool_size=args.pool_size)
             else:
                 assert False, 'Should be rejected by argument parsing.'
+        elif subcommand == 'catalog-reconcile':
+            backup_cxt.catalog_reconcile(pool_size=args.pool_size)
         else:
             logger.error(msg='subcommand not implemented',
                          detail=('The submitted subcommand was {0}.'
@@ -0,0 +1,102 @@
+"""A minimal binding of Linux's inotify, for use with gevent
+
+Only what is needed to follow files being created in a directory is
+provided.  It is implemented with ctypes to avoid a dependency on an
+extension module; on other platforms, available() is False and
+callers are expected to fall back to polling.
+
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+import gevent.socket
+
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+
+IN_NONBLOCK = 04000
+IN_CLOEXEC = 02000000
+
+# struct inotify_event, followed by a NUL-padded name of len bytes.
+_EVENT = struct.Struct('=iIII')
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                               use_errno=True)
+            libc.inotify_init1
+            libc.inotify_add_watch
+        except (OSError, AttributeError):
+            libc = False
+
+        _libc = libc
+
+    return _libc
+
+
+def available():
+    return bool(_load_libc())
+
+
+def _check(ret):
+    if ret < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+    return ret
+
+
+class Watch(object):
+    """Watch one directory for the events in mask"""
+
+    def __init__(self, dir_path, mask):
+        libc = _load_libc()
+        assert libc, 'inotify is not available'
+
+        self._fd = _check(libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        try:
+            _check(libc.inotify_add_watch(self._fd, dir_path, mask))
+        except:
+            os.close(self._fd)
+            raise
+
+    def fileno(self):
+        return self._fd
+
+    def read(self):
+        """Wait for events, then return them as (mask, name) pairs"""
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+                break
+            except EnvironmentError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    gevent.socket.wait_read(self._fd)
+                else:
+                    raise
+
+        events = []
+        offset = 0
+        while offset < len(buf):
+            _, mask, _, name_len = _EVENT.unpack_from(buf, offset)
+            offset += _EVENT.size
+            name = buf[offset:offset + name_len].rstrip('\0')
+            offset += name_len
+            events.append((mask, name))
+
+        return events
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
@@ -5,14 +5,23 @@ import functools
 import gevent
 import gevent.pool
 import itertools
+import tempfile
+import traceback
 
 from cStringIO import StringIO
 from wal_e import log_help
+from wal_e import prefetcher
 from wal_e import storage
 from wal_e import tar_partition
+from wal_e.blobstore import get_blobstore
 from wal_e.exception import UserException, UserCritical
+from wal_e.worker import backup_index
 from wal_e.worker import prefetch
-from wal_e.worker import (WalSegment,
+from wal_e.worker.catalog import Catalog
+from wal_e.worker.push_concurrency import AdaptiveConcurrency
+from wal_e.worker.wal_index import WalIndex
+from wal_e.worker import (ArchiveWatcher,
+                          WalSegment,
                           WalUploader,
                           PgBackupStatements,
                           PgControlDataParser,
@@ -20,7 +29,8 @@ from wal_e.worker import (WalSegment,
                           TarUploadPool,
                           WalTransferGroup,
                           uri_put_file,
-                          do_lzop_get)
+                          do_lzop_get,
+                          do_lzop_put)
 
 
 # File mode on directories created during restore process
@@ -33,15 +43,27 @@ logger = log_help.WalELogger(__name__)
 
 class Backup(object):
 
-    def __init__(self, layout, creds, gpg_key_id):
+    def __init__(self, layout, creds, gpg_key_id, catalog_path=None):
         self.layout = layout
         self.creds = creds
         self.gpg_key_id = gpg_key_id
+        self.catalog_path = catalog_path
         self.exceptions = []
 
     def new_connection(self):
         return self.cinfo.connect(self.creds)
 
+    def open_catalog(self):
+        """Open the local catalog of the archive, if one is configured"""
+        if self.catalog_path is None:
+            return None
+
+        return Catalog(self.catalog_path, self.layout)
+
+    def backup_index(self):
+        return backup_index.BackupIndex(get_blobstore(self.layout),
+                                        self.creds, self.layout)
+
     def backup_list(self, query, detail):
         """
         Lists base backups and basic information about them
@@ -68,7 +90,8 @@ class Backup(object):
         sys.stdout.flush()
 
     def database_fetch(self, pg_cluster_dir, backup_name,
-                       blind_restore, restore_spec, pool_size):
+                       blind_restore, restore_spec, pool_size, delta=None,
+                       restore_only=None, fetch_wal=None):
         if os.path.exists(os.path.join(pg_cluster_dir, 'postmaster.pid')):
             hint = ('Shut down postgres. If there is a stale lockfile, '
                     'then remove it after being very sure postgres is not '
@@ -78,6 +101,14 @@ class Backup(object):
                 detail='Found a postmaster.pid lockfile, and aborting',
                 hint=hint)
 
+        if delta is not None and restore_only:
+            raise UserException(
+                msg='delta and selective restores cannot be combined',
+                detail=('A selective restore replaces files that were not '
+                        'selected with empty placeholders, which would '
+                        'discard the existing copies a delta restore is '
+                        'meant to reuse.'))
+
         bl = self._backup_list(False)
         backups = list(bl.find_all(backup_name))
 
@@ -127,12 +158,30 @@ class Backup(object):
         if not blind_restore:
             self._verify_restore_paths(backup_info.spec)
 
+        if delta is not None:
+            # Compare against the files already in the restore
+            # target, rather than writing every member.
+            delta = tar_partition.DeltaRestore(
+                backup_info.spec['base_prefix'], compare=delta)
+
+        if restore_only:
+            selective = tar_partition.SelectiveRestore(restore_only)
+        else:
+            selective = None
+
         connections = []
         for i in xrange(pool_size):
             connections.append(self.new_connection())
 
-        partition_iter = self.worker.TarPartitionLister(
-            connections[0], self.layout, backup_info)
+        member_index = self._fetch_member_index(backup_info)
+        if member_index is None:
+            # Backups taken before member indexes were introduced.
+            partition_iter = self.worker.TarPartitionLister(
+                connections[0], self.layout, backup_info)
+        else:
+            partition_iter = self._plan_partitions(
+                member_index, backup_info.spec['base_prefix'],
+                delta, selective)
 
         assert len(connections) == pool_size
         fetchers = []
@@ -140,9 +189,22 @@ class Backup(object):
             fetchers.append(self.worker.BackupFetcher(
                 connections[i], self.layout, backup_info,
                 backup_info.spec['base_prefix'],
-                (self.gpg_key_id is not None)))
+                (self.gpg_key_id is not None),
+                delta=delta, selective=selective))
         assert len(fetchers) == pool_size
 
+        if fetch_wal is not None:
+            # Download the WAL needed to make the backup consistent
+            # while the partitions are extracted.  It is staged in
+            # the cluster directory, because pg_xlog is only known to
+            # exist (or be a symlink) once extraction is complete.
+            wal_staging = prefetch.Dirs(backup_info.spec['base_prefix'])
+            wal_pool = gevent.pool.Pool(size=pool_size)
+            for seg in self._backup_wal_segments(backup_info, fetch_wal):
+                wal_pool.spawn(
+                    self._exception_gather_guard(self.wal_prefetch),
+                    wal_staging.base, seg.name)
+
         p = gevent.pool.Pool(size=pool_size)
         fetcher_cycle = itertools.cycle(fetchers)
         for part_name in partition_iter:
@@ -153,6 +215,79 @@ class Backup(object):
 
         p.join(raise_error=True)
 
+        if fetch_wal is not None:
+            wal_pool.join(raise_error=True)
+            pg_xlog = os.path.join(backup_info.spec['base_prefix'], 'pg_xlog')
+            wal_staging.transfer(prefetch.Dirs(os.path.realpath(pg_xlog)))
+
+        # Only prune files once every partition has been restored,
+        # since until then it is not known what the backup contains.
+        if delta is not None and not self.exceptions:
+            delta.remove_extraneous()
+
+    def _backup_wal_segments(self, backup_info, extra):
+        """Yield the WAL segments a backup needs, and extra ones after"""
+        start = WalSegment(backup_info.wal_segment_backup_start)
+        stop = backup_info.wal_segment_backup_stop
+
+        for seg in itertools.chain([start], start.future_segment_stream()):
+            if seg.name > stop:
+                if extra <= 0:
+                    return
+
+                extra -= 1
+
+            yield seg
+
+    def _fetch_member_index(self, backup_info):
+        """Fetch the member index of a backup, if it has one"""
+        url = '{0}://{1}/{2}'.format(
+            self.layout.scheme, self.layout.store_name(),
+            self.layout.basebackup_member_index(backup_info))
+
+        with tempfile.NamedTemporaryFile() as tf:
+            if not do_lzop_get(self.creds, url, tf.name,
+                               self.gpg_key_id is not None):
+                logger.info(msg='backup has no member index',
+                            detail='All partitions will be fetched.')
+                return None
+
+            with open(tf.name) as f:
+                return tar_partition.MemberIndex.load(f)
+
+    def _plan_partitions(self, member_index, local_root, delta, selective):
+        """Choose the partitions that must be downloaded
+
+        Partitions whose members are all in place already (for delta
+        restores) or that only hold unselected files (for selective
+        restores) are skipped.
+
+        """
+        needed = []
+        for part_name in member_index.partition_names():
+            entries = member_index.entries(part_name)
+
+            if delta is not None:
+                for entry in entries:
+                    delta.note(entry)
+
+                if all(delta.unchanged_entry(entry) for entry in entries):
+                    continue
+
+            if selective is not None and selective.placeholders_only(entries):
+                selective.extract_placeholders(entries, local_root)
+                continue
+
+            needed.append(part_name)
+
+        logger.info(
+            msg='planned partitions to fetch from member index',
+            detail=('{0} of {1} partitions will be fetched.'
+                    .format(len(needed),
+                            len(member_index.partition_names()))))
+
+        return needed
+
     def database_backup(self, data_directory, *args, **kwargs):
         """Uploads a PostgreSQL file cluster to S3 or Windows Azure Blob
         Service
@@ -193,7 +328,7 @@ class Backup(object):
             ret_tuple = self._upload_pg_cluster_dir(
                 start_backup_info, data_directory, version=version, *args,
                 **kwargs)
-            spec, uploaded_to, expanded_size_bytes = ret_tuple
+            spec, uploaded_to, expanded_size_bytes, partitions = ret_tuple
             upload_good = True
         finally:
             if not upload_good:
@@ -239,18 +374,68 @@ class Backup(object):
             uri_put_file(self.creds,
                          uploaded_to + '_backup_stop_sentinel.json',
                          sentinel_content, content_encoding='application/json')
+
+            self._index_backup(start_backup_info, stop_backup_info,
+                               expanded_size_bytes, partitions)
         else:
             # NB: Other exceptions should be raised before this that
             # have more informative results, it is intended that this
             # exception never will get raised.
             raise UserCritical('could not complete backup process')
 
-    def wal_archive(self, wal_path, concurrency=1):
+    def _index_backup(self, start_backup_info, stop_backup_info,
+                      expanded_size_bytes, partitions):
+        # The backup is complete with its sentinel, so failing to
+        # index it is only worth a warning: the index is then marked
+        # stale, and backups are listed until it is rebuilt.
+        entry = {
+            'name': 'base_{file_name}_{file_offset}'.format(
+                **start_backup_info),
+            'last_modified': backup_index.last_modified_now(self.layout),
+            'expanded_size_bytes': expanded_size_bytes,
+            'wal_segment_backup_start': start_backup_info['file_name'],
+            'wal_segment_offset_backup_start':
+                start_backup_info['file_offset'],
+            'wal_segment_backup_stop': stop_backup_info['file_name'],
+            'wal_segment_offset_backup_stop': stop_backup_info['file_offset'],
+            'partitions': partitions}
+
+        def change(entries):
+            return [e for e in entries if e['name'] != entry['name']] + [
+                entry]
+
+        try:
+            index = self.backup_index()
+            index.update(change)
+
+            # A stale index leaves the backup out: rebuild it from a
+            # listing, which has the backup now that its sentinel is
+            # uploaded.
+            if index.backups() is None:
+                bl = self.worker.BackupList(self.new_connection(),
+                                            self.layout, False,
+                                            catalog=self.open_catalog())
+                index.rebuild([backup_index.backup_entry(info)
+                               for info in bl])
+        except Exception:
+            logger.warning(
+                msg='could not add the backup to the backup index',
+                detail=''.join(traceback.format_exception(*sys.exc_info())))
+
+    def wal_archive(self, wal_path, concurrency=1, clear_xlog_tail=False,
+                    adaptive=False, min_concurrency=1):
         """
         Uploads a WAL file to S3 or Windows Azure Blob Service
 
         This code is intended to typically be called from Postgres's
         archive_command feature.
+
+        With clear_xlog_tail, the unused tail of each segment is
+        zeroed before compression.
+
+        With adaptive, the number of concurrent uploads is chosen
+        between min_concurrency and concurrency, from the number of
+        segments ready and how previous uploads went.
         """
 
         # Upload the segment expressly indicated.  It's special
@@ -259,7 +444,28 @@ class Backup(object):
         # in archive_status.
         xlog_dir = os.path.dirname(wal_path)
         segment = WalSegment(wal_path, explicit=True)
-        uploader = WalUploader(self.layout, self.creds, self.gpg_key_id)
+        uploader = WalUploader(self.layout, self.creds, self.gpg_key_id,
+                               clear_xlog_tail=clear_xlog_tail)
+        seg_stream = WalSegment.from_ready_archive_status(xlog_dir)
+
+        controller = None
+        if adaptive:
+            if not 1 <= min_concurrency <= concurrency:
+                raise UserException(
+                    msg='invalid bounds on the number of concurrent uploads',
+                    detail=('The minimum was {0} and the maximum {1}.'
+                            .format(min_concurrency, concurrency)),
+                    hint=('Set --min-pool-size to at least 1 and at most '
+                          '--pool-size.'))
+
+            controller = AdaptiveConcurrency(xlog_dir, min_concurrency,
+                                             concurrency)
+            others = [other_segment for other_segment in seg_stream
+                      if other_segment.path != wal_path]
+            concurrency = controller.concurrency(len(others) + 1)
+            seg_stream = iter(others)
+            uploader = controller.measure(uploader)
+
         group = WalTransferGroup(uploader)
         group.start(segment)
 
@@ -267,7 +473,6 @@ class Backup(object):
         # concurrency by scanning the Postgres archive_status
         # directory.
         started = 1
-        seg_stream = WalSegment.from_ready_archive_status(xlog_dir)
         while started < concurrency:
             try:
                 other_segment = seg_stream.next()
@@ -279,9 +484,27 @@ class Backup(object):
                 started += 1
 
         # Wait for uploads to finish.
-        group.join()
+        try:
+            group.join()
+        finally:
+            if controller is not None:
+                controller.update()
+
+    def wal_archive_watcher(self, xlog_dir, concurrency,
+                            clear_xlog_tail=False):
+        """
+        Build an ArchiveWatcher uploading segments of xlog_dir
+
+        It uploads segments as soon as Postgres marks them ready in
+        archive_status, rather than when archive_command is run.
+        """
+        uploader = WalUploader(self.layout, self.creds, self.gpg_key_id,
+                               clear_xlog_tail=clear_xlog_tail)
+        return ArchiveWatcher(uploader, xlog_dir, concurrency)
 
-    def wal_restore(self, wal_name, wal_destination, prefetch_max):
+    def wal_restore(self, wal_name, wal_destination, prefetch_max,
+                    index_ttl=0, prefetch_budget=None,
+                    prefetch_compressed=False):
         """
         Downloads a WAL file from S3 or Windows Azure Blob Service
 
@@ -291,46 +514,67 @@ class Backup(object):
         NB: Postgres doesn't guarantee that wal_name ==
         basename(wal_path), so both are required.
 
+        With a positive index_ttl, WAL files missing from a listing
+        of the archive at most that many seconds old are reported
+        missing without trying to download them.
+
+        prefetch_budget and prefetch_compressed are passed to the
+        prefetcher when it is started; see wal_e.prefetcher.
+
         """
         url = '{0}://{1}/{2}'.format(
             self.layout.scheme, self.layout.store_name(),
             self.layout.wal_path(wal_name))
 
-        if prefetch_max > 0:
-            # Check for prefetch-hit.
-            base = os.path.dirname(os.path.realpath(wal_destination))
-            pd = prefetch.Dirs(base)
-            seg = WalSegment(wal_name)
-
-            started = start_prefetches(seg, pd, prefetch_max)
-            last_size = 0
-
-            while True:
-                if pd.contains(seg):
-                    pd.promote(seg, wal_destination)
-                    logger.info(
-                        msg='promoted prefetched wal segment',
-                        structured={'action': 'wal-fetch',
-                                    'key': url,
-                                    'seg': wal_name,
-                                    'prefix': self.layout.path_prefix})
-
-                    pd.clear_except(started)
-                    return True
-
-                # If there is a 'running' download, wait a bit for it
-                # to make progress or finish.  However, if it doesn't
-                # make progress in some amount of time, assume that
-                # the prefetch process has died and go on with the
-                # in-band downloading code.
-                sz = pd.running_size(seg)
-                if sz <= last_size:
-                    break
-
-                last_size = sz
-                gevent.sleep(0.5)
-
-            pd.clear_except(started)
+        base = os.path.dirname(os.path.realpath(wal_destination))
+        pd = prefetch.Dirs(base)
+        seg = WalSegment(wal_name)
+
+        if prefetch_max > 0 and prefetcher.available(pd):
+            # Check for prefetch-hit.  The prefetcher answers once
+            # any download of this segment in progress is complete.
+            prefetched = prefetcher.ask(pd, seg, prefetch_max)
+            if prefetched is None:
+                prefetcher.start(pd, seg, prefetch_max,
+                                 budget=prefetch_budget,
+                                 compressed=prefetch_compressed)
+                prefetched = pd.contains(seg)
+
+            if prefetched and pd.promote(
+                    seg, wal_destination,
+                    decrypt=self.gpg_key_id is not None):
+                logger.info(
+                    msg='promoted prefetched wal segment',
+                    structured={'action': 'wal-fetch',
+                                'key': url,
+                                'seg': wal_name,
+                                'prefix': self.layout.path_prefix})
+
+                return True
+        elif pd.contains(seg) and pd.promote(
+                seg, wal_destination, decrypt=self.gpg_key_id is not None):
+            # Segments can also have been fetched ahead of time by
+            # backup-fetch, even when prefetching is not enabled.
+            logger.info(
+                msg='promoted prefetched wal segment',
+                structured={'action': 'wal-fetch',
+                            'key': url,
+                            'seg': wal_name,
+                            'prefix': self.layout.path_prefix})
+
+            pd.clear_except([seg])
+            return True
+
+        if index_ttl > 0 and self.wal_index(base).missing(wal_name,
+                                                          index_ttl):
+            logger.info(
+                msg='wal file is not archived',
+                structured={'action': 'wal-fetch',
+                            'key': url,
+                            'seg': wal_name,
+                            'prefix': self.layout.path_prefix,
+                            'state': 'missing'})
+            return False
 
         logger.info(
             msg='begin wal restore',
@@ -353,14 +597,30 @@ class Backup(object):
 
         return ret
 
-    def wal_prefetch(self, base, segment_name):
+    def wal_index(self, base):
+        """
+        Build the WalIndex of archived WAL files, kept in base
+        """
+        wal_uri = '{0}://{1}/{2}'.format(
+            self.layout.scheme, self.layout.store_name(),
+            self.layout.wal_directory())
+        return WalIndex(base, get_blobstore(self.layout), self.creds,
+                        wal_uri)
+
+    def wal_prefetch(self, base, segment_name, compressed=False):
+        """
+        Download a WAL segment into the prefetch directories of base
+
+        With compressed, the segment is kept as it is stored until it
+        is promoted.
+        """
         url = '{0}://{1}/{2}'.format(
             self.layout.scheme, self.layout.store_name(),
             self.layout.wal_path(segment_name))
         pd = prefetch.Dirs(base)
         seg = WalSegment(segment_name)
         pd.create(seg)
-        with pd.download(seg) as d:
+        with pd.download(seg, compressed=compressed) as d:
             logger.info(
                 msg='begin wal restore',
                 structured={'action': 'wal-prefetch',
@@ -370,7 +630,9 @@ class Backup(object):
                             'state': 'begin'})
 
             ret = do_lzop_get(self.creds, url, d.dest,
-                              self.gpg_key_id is not None, do_retry=False)
+                              self.gpg_key_id is not None, do_retry=False,
+                              raw=compressed)
+            d.failed = not ret
 
             logger.info(
                 msg='complete wal restore',
@@ -382,30 +644,47 @@ class Backup(object):
 
             return ret
 
-    def delete_old_versions(self, dry_run):
+    def delete_old_versions(self, dry_run, pool_size=1):
         assert storage.CURRENT_VERSION not in storage.OBSOLETE_VERSIONS
 
         for obsolete_version in storage.OBSOLETE_VERSIONS:
-            self.delete_all(dry_run, self.layout)
+            self.delete_all(dry_run, pool_size)
 
-    def delete_all(self, dry_run):
-        conn = self.new_connection()
-        delete_cxt = self.worker.DeleteFromContext(conn, self.layout, dry_run)
+    def delete_all(self, dry_run, pool_size=1):
+        delete_cxt = self._delete_cxt(dry_run, pool_size)
         delete_cxt.delete_everything()
 
-    def delete_before(self, dry_run, segment_info):
-        conn = self.new_connection()
-        delete_cxt = self.worker.DeleteFromContext(conn, self.layout, dry_run)
+    def delete_before(self, dry_run, segment_info, pool_size=1):
+        delete_cxt = self._delete_cxt(dry_run, pool_size)
         delete_cxt.delete_before(segment_info)
 
-    def delete_with_retention(self, dry_run, num_to_retain):
-        conn = self.new_connection()
-        delete_cxt = self.worker.DeleteFromContext(conn, self.layout, dry_run)
+    def delete_with_retention(self, dry_run, num_to_retain, pool_size=1):
+        delete_cxt = self._delete_cxt(dry_run, pool_size)
         delete_cxt.delete_with_retention(num_to_retain)
 
+    def catalog_reconcile(self, pool_size=1):
+        """List the whole archive into the local catalog again"""
+        catalog = self.open_catalog()
+        if catalog is None:
+            raise UserException(
+                msg='no catalog to reconcile',
+                hint='Set the --catalog option or WALE_CATALOG.')
+
+        # Listing is all that is done, so no deleter is needed.
+        catalog.reconcile(self._delete_cxt(True, pool_size))
+
+    def _delete_cxt(self, dry_run, pool_size):
+        conn = self.new_connection()
+        return self.worker.DeleteFromContext(conn, self.layout, dry_run,
+                                             pool_size=pool_size,
+                                             catalog=self.open_catalog(),
+                                             index=self.backup_index())
+
     def _backup_list(self, detail):
         conn = self.new_connection()
-        bl = self.worker.BackupList(conn, self.layout, detail)
+        bl = self.worker.BackupList(conn, self.layout, detail,
+                                    catalog=self.open_catalog(),
+                                    index=self.backup_index())
         return bl
 
     def _upload_pg_cluster_dir(self, start_backup_info, pg_cluster_dir,
@@ -454,6 +733,7 @@ class Backup(object):
         assert per_process_limit > 0 or per_process_limit is None
 
         total_size = 0
+        partitions = 0
 
         # Make an attempt to upload extended version metadata
         extended_version_url = backup_prefix + '/extended_version.txt'
@@ -475,6 +755,7 @@ class Backup(object):
         # Enqueue uploads for parallel execution
         for tpart in parts:
             total_size += tpart.total_member_size
+            partitions += 1
 
             # 'put' can raise an exception for a just-failed upload,
             # aborting the process.
@@ -484,7 +765,22 @@ class Backup(object):
         # raised to signal failure of the upload.
         pool.join()
 
-        return spec, backup_prefix, total_size
+        # Upload the table of contents of the backup, which lets
+        # restores find members without reading every partition.
+        member_index_url = backup_prefix + '/member_index.json.lzo'
+        logger.info(
+            msg='start upload of backup member index',
+            detail=('Uploading to {member_index_url}.'
+                    .format(member_index_url=member_index_url)))
+        with tempfile.NamedTemporaryFile() as tf:
+            uploader.member_index.dump(tf)
+            tf.flush()
+            do_lzop_put(self.creds, member_index_url, tf.name,
+                        self.gpg_key_id)
+
+        logger.info(msg='backup member index upload complete')
+
+        return spec, backup_prefix, total_size, partitions
 
     def _exception_gather_guard(self, fn):
         """
@@ -540,27 +836,3 @@ class Backup(object):
                       'running backup-fetch, or use --blind-restore to '
                       'ignore symlinking. Alternatively supply a restore '
                       'spec to have WAL-E create tablespace symlinks for you'))
-
-
-def start_prefetches(seg, pd, how_many):
-    import daemon
-
-    split = sys.argv.index('wal-fetch')
-    if split < 0:
-        return
-
-    future = list(itertools.islice(seg.future_segment_stream(), how_many))
-
-    for fs in future:
-        if pd.is_running(fs) or pd.contains(fs):
-            # Skip when it appears another pre-fetch is already
-            # running or done.
-            continue
-        elif os.fork() == 0:
-            pd.create(fs)
-            with daemon.DaemonContext():
-                os.execvp(
-                    sys.argv[0],
-                    sys.argv[:split] + ['wal-prefetch'] + [pd.base, fs.name])
-
-    return future
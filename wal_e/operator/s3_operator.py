@@ -10,8 +10,9 @@ class S3Backup(Backup):
 
     """
 
-    def __init__(self, layout, creds, gpg_key_id):
-        super(S3Backup, self).__init__(layout, creds, gpg_key_id)
+    def __init__(self, layout, creds, gpg_key_id, catalog_path=None):
+        super(S3Backup, self).__init__(layout, creds, gpg_key_id,
+                                 catalog_path=catalog_path)
 
         # Create a CallingInfo that will figure out region and calling
         # format issues and cache some of the determinations, if
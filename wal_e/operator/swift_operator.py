@@ -8,7 +8,8 @@ class SwiftBackup(Backup):
     Aerforms OpenStack Swift uploads of PostgreSQL WAL files and clusters
     """
 
-    def __init__(self, layout, creds, gpg_key_id):
-        super(SwiftBackup, self).__init__(layout, creds, gpg_key_id)
+    def __init__(self, layout, creds, gpg_key_id, catalog_path=None):
+        super(SwiftBackup, self).__init__(layout, creds, gpg_key_id,
+                                 catalog_path=catalog_path)
         self.cinfo = calling_format
         self.worker = swift_worker
@@ -10,8 +10,9 @@ class WABSBackup(Backup):
     and clusters
 
     """
-    def __init__(self, layout, creds, gpg_key_id):
-        super(WABSBackup, self).__init__(layout, creds, gpg_key_id)
+    def __init__(self, layout, creds, gpg_key_id, catalog_path=None):
+        super(WABSBackup, self).__init__(layout, creds, gpg_key_id,
+                                 catalog_path=catalog_path)
         url_tup = urlparse(layout.prefix)
         container_name = url_tup.netloc
         self.cinfo = wabs.calling_format.from_store_name(container_name)
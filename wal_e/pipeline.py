@@ -58,6 +58,11 @@ class Pipeline(object):
     def abort(self):
         self._abort = True
 
+    def finish(self):
+        """Wait for all commands to exit, raising if any of them failed"""
+        for command in self.commands:
+            command.finish()
+
     def __enter__(self):
         # Ensure there is at least one step in the pipeline.
         #
@@ -111,8 +116,7 @@ class Pipeline(object):
                 for command in self.commands:
                     command.wait()
             else:
-                for command in self.commands:
-                    command.finish()
+                self.finish()
         except:
             if exc_type:
                 # Re-raise inner exception rather than complaints during
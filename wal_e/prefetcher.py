@@ -0,0 +1,191 @@
+"""One resident process prefetching WAL segments during recovery
+
+Rather than starting a wal-prefetch process for every upcoming
+segment each time Postgres runs restore_command, wal-fetch starts a
+single prefetcher for the recovery, listening on a Unix socket in the
+".wal-e" directory next to the segments.  It keeps a window of
+upcoming segments downloading over one set of connections, in the
+usual prefetch directories (see wal_e.worker.prefetch).
+
+wal-fetch then sends it one JSON object per line:
+
+    {"segment": "000000010000000000000002", "window": 8}
+
+where the window is the most segments to prefetch.  The prefetcher
+sizes its window within that from how fast replay asks for segments
+and how long they take to download, moves the window past the
+requested segment, waits for that segment if it is still
+downloading, and answers as soon as the download completes:
+
+    {"prefetched": true}
+
+When the answer is false, wal-fetch downloads the segment itself.
+A bound on the bytes taken by prefetched segments, and whether they
+are kept compressed, are given when the prefetcher is started.
+The prefetcher exits once no segment has been asked for in a while,
+e.g. at the end of recovery.
+
+"""
+import json
+import os
+import sys
+
+import gevent.event
+
+from gevent import socket
+from gevent.server import StreamServer
+
+from wal_e import log_help
+from wal_e.agent import bind_unix_socket, socket_path_fits
+from wal_e.exception import UserException
+from wal_e.worker import WalSegment
+from wal_e.worker import prefetch
+
+logger = log_help.WalELogger(__name__)
+
+# Seconds without requests after which the prefetcher exits.
+IDLE_TIMEOUT = 10 * 60
+
+
+class PrefetchServer(object):
+
+    def __init__(self, prefetcher):
+        self.prefetcher = prefetcher
+        self.activity = gevent.event.Event()
+
+    def serve(self, first=None, idle_timeout=IDLE_TIMEOUT):
+        """Serve requests, after prefetching from the segment first
+
+        The socket is bound before anything is prefetched, which may
+        start with listing the archive: wal-fetch processes meanwhile
+        wait for answers, rather than start other prefetchers.
+
+        """
+        pd = self.prefetcher.pd
+        if not available(pd):
+            return
+
+        pd.create()
+        try:
+            listener = bind_unix_socket(pd.socket_path)
+        except UserException:
+            # Another wal-fetch started a prefetcher first.
+            return
+        except socket.error as e:
+            logger.warning(msg='could not listen for wal-fetch requests',
+                           detail=('Binding {0} failed: {1}.'
+                                   .format(pd.socket_path, e)))
+            return
+
+        server = StreamServer(listener, self.handle)
+        server.start()
+
+        try:
+            if first is not None:
+                self.prefetcher.advance(first)
+
+            while self.activity.wait(timeout=idle_timeout):
+                self.activity.clear()
+        finally:
+            server.stop()
+            self.prefetcher.stop()
+            os.unlink(pd.socket_path)
+
+    def handle(self, sock, address):
+        f = sock.makefile('r+b')
+
+        try:
+            for line in f:
+                self.activity.set()
+                request = json.loads(line)
+                segment = WalSegment(request['segment'])
+                self.prefetcher.max_window = request.get(
+                    'window', self.prefetcher.max_window)
+
+                self.prefetcher.advance(segment)
+                prefetched = self.prefetcher.wait(segment)
+
+                f.write(json.dumps({'prefetched': prefetched}) + '\n')
+                f.flush()
+        except socket.error:
+            # wal-fetch went away, e.g. because Postgres was stopped.
+            pass
+        except (ValueError, KeyError):
+            logger.warning(msg='prefetcher received a malformed request',
+                           detail='The request was {0!r}.'.format(line))
+        finally:
+            f.close()
+            sock.close()
+
+
+def serve(fetch, base, segment_name, window, index=None, budget=None,
+          compressed=False):
+    """Prefetch after segment_name, then serve wal-fetch requests"""
+    prefetcher = prefetch.Prefetcher(fetch, base, window, index=index,
+                                     budget=budget, compressed=compressed)
+    PrefetchServer(prefetcher).serve(WalSegment(segment_name))
+
+
+def available(pd):
+    """Check if a prefetcher can listen next to the segments of pd
+
+    Unix socket paths are short, so a deep data directory can leave
+    no room for one, in which case prefetching is disabled with a
+    warning.
+
+    """
+    if socket_path_fits(pd.socket_path):
+        return True
+
+    logger.warning(
+        msg='cannot prefetch WAL: the prefetcher socket path is too long',
+        detail=('{0} is longer than a Unix socket path can be.'
+                .format(pd.socket_path)),
+        hint='Move the data directory to a shorter path to prefetch WAL.')
+    return False
+
+
+def ask(pd, segment, window):
+    """Ask the prefetcher for segment
+
+    Return whether it was prefetched, or None if no prefetcher could
+    be reached.
+
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(pd.socket_path)
+        f = sock.makefile('r+b')
+        try:
+            f.write(json.dumps({'segment': segment.name,
+                                'window': window}) + '\n')
+            f.flush()
+            return json.loads(f.readline())['prefetched']
+        finally:
+            f.close()
+    except (socket.error, ValueError, KeyError):
+        return None
+    finally:
+        sock.close()
+
+
+def start(pd, segment, window, budget=None, compressed=False):
+    """Start a prefetcher in the background for this wal-fetch"""
+    import daemon
+
+    if 'wal-fetch' not in sys.argv:
+        return
+
+    split = sys.argv.index('wal-fetch')
+    options = ['--window', str(window)]
+    if budget is not None:
+        options.extend(['--budget', str(budget)])
+    if compressed:
+        options.append('--compressed')
+
+    if os.fork() == 0:
+        with daemon.DaemonContext():
+            os.execvp(
+                sys.argv[0],
+                sys.argv[:split] + ['wal-prefetch'] + options +
+                [pd.base, segment.name])
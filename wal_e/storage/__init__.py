@@ -3,6 +3,7 @@ from wal_e.storage.base import SUPPORTED_STORE_SCHEMES
 from wal_e.storage.base import CURRENT_VERSION
 from wal_e.storage.base import SEGMENT_REGEXP
 from wal_e.storage.base import SEGMENT_READY_REGEXP
+from wal_e.storage.base import HISTORY_REGEXP
 from wal_e.storage.base import BASE_BACKUP_REGEXP
 from wal_e.storage.base import COMPLETE_BASE_BACKUP_REGEXP
 from wal_e.storage.base import VOLUME_REGEXP
@@ -18,6 +19,7 @@ __all__ = [
     'CURRENT_VERSION',
     'SEGMENT_REGEXP',
     'SEGMENT_READY_REGEXP',
+    'HISTORY_REGEXP',
     'BASE_BACKUP_REGEXP',
     'COMPLETE_BASE_BACKUP_REGEXP',
     'VOLUME_REGEXP',
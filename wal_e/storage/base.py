@@ -21,6 +21,8 @@ SEGMENT_REGEXP = (r'(?P<filename>(?P<tli>[0-9A-F]{8,8})(?P<log>[0-9A-F]{8,8})'
 
 SEGMENT_READY_REGEXP = SEGMENT_REGEXP + r'\.ready'
 
+HISTORY_REGEXP = r'(?P<filename>(?P<tli>[0-9A-F]{8,8})\.history)$'
+
 BASE_BACKUP_REGEXP = (r'base_' + SEGMENT_REGEXP + r'_(?P<offset>[0-9A-F]{8})')
 
 COMPLETE_BASE_BACKUP_REGEXP = (
@@ -285,11 +287,20 @@ class StorageLayout(object):
         return (self.basebackup_directory(backup_info) +
                 'tar_partitions/')
 
+    def basebackup_member_index(self, backup_info):
+        self._error_on_unexpected_version()
+        return (self.basebackup_directory(backup_info) +
+                'member_index.json.lzo')
+
     def basebackup_tar_partition(self, backup_info, part_name):
         self._error_on_unexpected_version()
         return (self.basebackup_tar_partition_directory(backup_info) +
                 part_name)
 
+    def backup_index(self):
+        return (self._api_path_prefix + 'backup_index_' + self.VERSION +
+                '.json')
+
     def wal_directory(self):
         return self._api_path_prefix + 'wal_' + self.VERSION + '/'
 
@@ -310,6 +321,11 @@ class StorageLayout(object):
             return key.last_modified
         return key.properties.last_modified
 
+    def key_size(self, key):
+        if hasattr(key, 'size'):
+            return key.size
+        return key.properties.content_length
+
 
 def get_backup_info(layout, **kwargs):
     kwargs['layout'] = layout
@@ -42,7 +42,11 @@ process considerably more complicated.
 """
 import collections
 import errno
+import fnmatch
+import json
 import os
+import shutil
+import stat
 import tarfile
 
 from wal_e import log_help
@@ -134,6 +138,11 @@ class TarBadPathError(Exception):
 ExtendedTarInfo = collections.namedtuple('ExtendedTarInfo',
                                          'submitted_path tarinfo')
 
+# A member as recorded in a MemberIndex.  "offset" is the position of
+# the member's data in the uncompressed tar stream of its partition.
+MemberEntry = collections.namedtuple(
+    'MemberEntry', 'name type offset size mode mtime linkname')
+
 # 1.5 GiB is 1610612736 bytes, and Postgres allocates 1 GiB files as a
 # nominal maximum.  This must be greater than that.
 PARTITION_MAX_SZ = 1610612736
@@ -179,23 +188,24 @@ def _fsync_files(filenames):
             os.close(fd)
 
 
-def cat_extract(tar, member, targetpath):
-    """Extract a regular file member using cat for async-like I/O
+def _make_upperdirs(targetpath, known_dirs=None):
+    """Create the directories above targetpath, if necessary
 
-    Mostly adapted from tarfile.py.
+    known_dirs is an optional set of directories that are already
+    known to exist.  It is consulted and extended to avoid repeating
+    stat() calls for every member of directories with many small
+    files.
 
     """
-    assert member.isreg()
+    upperdirs = os.path.dirname(targetpath)
 
-    # Fetch the TarInfo object for the given name and build the
-    # destination pathname, replacing forward slashes to platform
-    # specific separators.
-    targetpath = targetpath.rstrip("/")
-    targetpath = targetpath.replace("/", os.sep)
+    if not upperdirs:
+        return
 
-    # Create all upper directories.
-    upperdirs = os.path.dirname(targetpath)
-    if upperdirs and not os.path.exists(upperdirs):
+    if known_dirs is not None and upperdirs in known_dirs:
+        return
+
+    if not os.path.exists(upperdirs):
         try:
             # Create directories that are not part of the archive with
             # default permissions.
@@ -209,20 +219,536 @@ def cat_extract(tar, member, targetpath):
             else:
                 raise
 
+    if known_dirs is not None:
+        known_dirs.add(upperdirs)
+
+
+def _apply_metadata(tar, member, targetpath):
+    tar.chown(member, targetpath)
+    tar.chmod(member, targetpath)
+    tar.utime(member, targetpath)
+
+
+def cat_extract(tar, member, targetpath, known_dirs=None, deferred=None):
+    """Extract a regular file member using cat for async-like I/O
+
+    Mostly adapted from tarfile.py.
+
+    If deferred is passed, the (member, targetpath) pair is appended
+    to it rather than having ownership, mode and times applied
+    immediately.
+
+    """
+    assert member.isreg()
+
+    # Fetch the TarInfo object for the given name and build the
+    # destination pathname, replacing forward slashes to platform
+    # specific separators.
+    targetpath = targetpath.rstrip("/")
+    targetpath = targetpath.replace("/", os.sep)
+
+    # Create all upper directories.
+    _make_upperdirs(targetpath, known_dirs)
+
     with open(targetpath, 'wb') as dest:
         with pipeline.get_cat_pipeline(pipeline.PIPE, dest) as pl:
             fp = tar.extractfile(member)
             copyfileobj.copyfileobj(fp, pl.stdin)
 
-    tar.chown(member, targetpath)
-    tar.chmod(member, targetpath)
-    tar.utime(member, targetpath)
+    if deferred is None:
+        _apply_metadata(tar, member, targetpath)
+    else:
+        deferred.append((member, targetpath))
+
+
+def small_extract(tar, member, targetpath, known_dirs, deferred):
+    """Extract a small regular file member with a single write
+
+    Small files are common in Postgres clusters (catalogs, free space
+    and visibility maps), and for those the per-file overhead of
+    tarfile.extract dominates the cost of the data itself.
+
+    The metadata is not applied here, but appended to deferred for
+    application in a batch.
+
+    """
+    assert member.isreg()
+
+    targetpath = targetpath.rstrip("/")
+    targetpath = targetpath.replace("/", os.sep)
+
+    _make_upperdirs(targetpath, known_dirs)
+
+    data = tar.extractfile(member).read()
+    with open(targetpath, 'wb') as dest:
+        dest.write(data)
+
+    deferred.append((member, targetpath))
+
+
+def sparse_extract(member, targetpath, known_dirs, deferred):
+    """Create a zero-filled, sparse stand-in for a regular file member
+
+    Used for relation files that were excluded from a selective
+    restore: recovery may still replay WAL records that touch them,
+    and that fails if the files are missing altogether.
+
+    """
+    assert member.isreg()
+
+    targetpath = targetpath.rstrip("/")
+    targetpath = targetpath.replace("/", os.sep)
+
+    _make_upperdirs(targetpath, known_dirs)
+
+    with open(targetpath, 'wb') as dest:
+        dest.truncate(member.size)
+
+    deferred.append((member, targetpath))
+
+
+def dir_extract(tar, member, targetpath, known_dirs, deferred_dirs):
+    """Create a directory member, deferring its metadata
+
+    Directory metadata must be applied after all members inside of
+    it have been extracted, otherwise the modification time is lost,
+    and restrictive modes can prevent the creation of its contents.
+
+    """
+    assert member.isdir()
+
+    targetpath = targetpath.rstrip("/")
+    targetpath = targetpath.replace("/", os.sep)
+
+    if targetpath not in known_dirs:
+        _make_upperdirs(targetpath, known_dirs)
+
+        try:
+            # Use a safe mode for the directory, the real mode is set
+            # with the rest of the deferred metadata.
+            os.mkdir(targetpath, 0700)
+        except EnvironmentError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        known_dirs.add(targetpath)
+
+    deferred_dirs.append((member, targetpath))
+
+
+class DeltaRestore(object):
+    """Restore into an existing cluster directory, writing only changes
+
+    Members are compared against the files already in place, either
+    by size and modification time ("mtime") or by content
+    ("checksum").  Content comparison rewrites only the chunks of a
+    file that differ.  The names of all members are recorded, so that
+    once every partition has been extracted, files that are not part
+    of the backup can be removed.
+
+    Files that are never part of a backup (such as configuration
+    files and WAL) are left alone.
+
+    """
+
+    COMPARE_MODES = ('mtime', 'checksum')
+
+    def __init__(self, local_root, compare='mtime'):
+        assert compare in self.COMPARE_MODES
+
+        self.local_root = os.path.realpath(local_root)
+        self.compare = compare
+        self.seen = set()
+
+    def _same_size_and_mtime(self, member, st):
+        return st.st_size == member.size and int(st.st_mtime) == member.mtime
+
+    def _patch_in_place(self, tar, member, targetpath):
+        """Rewrite only the differing chunks of targetpath
+
+        Returns True if any bytes had to be written.
+
+        """
+        bufsize = pipebuf.PIPE_BUF_BYTES
+        modified = False
+        src = tar.extractfile(member)
+
+        with open(targetpath, 'r+b') as dest:
+            remaining = member.size
+            while remaining > 0:
+                buf = src.read(min(bufsize, remaining))
+                if not buf:
+                    raise IOError('end of file reached')
+
+                pos = dest.tell()
+                if dest.read(len(buf)) != buf:
+                    dest.seek(pos)
+                    dest.write(buf)
+                    modified = True
+
+                remaining -= len(buf)
+
+            if os.fstat(dest.fileno()).st_size != member.size:
+                dest.truncate(member.size)
+                modified = True
+
+        return modified
+
+    def note(self, member):
+        self.seen.add(os.path.normpath(member.name))
+
+    def unchanged_entry(self, entry):
+        """Check if a MemberEntry is already in place, without its data
+
+        Only possible when comparing by size and modification time.
+
+        """
+        if self.compare != 'mtime':
+            return False
+
+        path = os.path.join(self.local_root, entry.name)
+
+        try:
+            st = os.lstat(path)
+        except EnvironmentError as e:
+            if e.errno == errno.ENOENT:
+                return False
+
+            raise
+
+        if entry.type == tarfile.DIRTYPE:
+            return stat.S_ISDIR(st.st_mode)
+        elif entry.type == tarfile.SYMTYPE:
+            return (stat.S_ISLNK(st.st_mode) and
+                    os.readlink(path) == entry.linkname)
+        elif entry.type in tarfile.REGULAR_TYPES:
+            return (stat.S_ISREG(st.st_mode) and
+                    self._same_size_and_mtime(entry, st))
+
+        return False
+
+    def extract(self, tar, member, targetpath):
+        """Try to satisfy a member from what is already on disk
+
+        Returns None if the member must be extracted normally,
+        'unchanged' if nothing had to be written, and 'patched' if the
+        file was corrected in place.
+
+        """
+        try:
+            st = os.lstat(targetpath)
+        except EnvironmentError as e:
+            if e.errno == errno.ENOENT:
+                return None
+
+            raise
+
+        if member.issym():
+            if (stat.S_ISLNK(st.st_mode) and
+                    os.readlink(targetpath) == member.linkname):
+                return 'unchanged'
+
+            self._remove(targetpath, st)
+            return None
+
+        if member.isdir():
+            if not stat.S_ISDIR(st.st_mode):
+                self._remove(targetpath, st)
+
+            return None
+
+        if not member.isreg():
+            return None
+
+        if not stat.S_ISREG(st.st_mode):
+            self._remove(targetpath, st)
+            return None
+
+        if self.compare == 'mtime':
+            if self._same_size_and_mtime(member, st):
+                return 'unchanged'
+
+            return None
+        elif self.compare == 'checksum':
+            if self._patch_in_place(tar, member, targetpath):
+                return 'patched'
+
+            return 'unchanged'
+
+        assert False
+
+    def _remove(self, targetpath, st):
+        """Make way for a member of another type than what is on disk
+
+        Extraction would otherwise write through a symlink, possibly
+        outside of the cluster directory, or fail on a directory.
+
+        """
+        if stat.S_ISDIR(st.st_mode):
+            shutil.rmtree(targetpath)
+        else:
+            os.unlink(targetpath)
+
+    def _exempt(self, relpath):
+        """Check if a path is never part of a backup
+
+        Mirrors the exclusions made by partition().
+
+        """
+        parts = relpath.split(os.path.sep)
+
+        if len(parts) == 1 and (parts[0] in PG_CONF or
+                                parts[0] in ('postmaster.pid',
+                                             'postmaster.opts')):
+            return True
+
+        if parts[0] == 'pg_xlog':
+            return True
+
+        for part in parts[:-1]:
+            if part in ('pgsql_tmp', 'pg_stat_tmp', '.wal-e'):
+                return True
+
+        return False
+
+    def remove_extraneous(self):
+        """Remove files and directories that are not in the backup
+
+        Must only be called after all partitions have been extracted
+        successfully.
+
+        """
+        removed = 0
+
+        walker = os.walk(self.local_root, topdown=False, followlinks=True)
+        for root, dirnames, filenames in walker:
+            relroot = os.path.relpath(root, self.local_root)
+            if relroot == os.curdir:
+                relroot = ''
+
+            for filename in filenames:
+                relpath = os.path.join(relroot, filename)
+                if relpath in self.seen or self._exempt(relpath):
+                    continue
+
+                os.unlink(os.path.join(root, filename))
+                removed += 1
+
+            for dirname in dirnames:
+                relpath = os.path.join(relroot, dirname)
+                path = os.path.join(root, dirname)
+                if (relpath in self.seen or self._exempt(relpath + os.sep) or
+                        os.path.islink(path) or os.listdir(path)):
+                    continue
+
+                os.rmdir(path)
+                removed += 1
+
+        logger.info(msg='removed files not present in the backup',
+                    detail='{0} files and directories were removed.'
+                    .format(removed))
+
+
+class SelectiveRestore(object):
+    """Restore only some databases, tablespaces or paths of a backup
+
+    Selectors are database OIDs (e.g. "16385"), tablespace OIDs
+    prefixed with "tablespace:" (e.g. "tablespace:16390") or globs
+    matched against member names (e.g. "base/16385/1259*").
+
+    Only the contents of databases are filtered: files outside of
+    "base" and "pg_tblspc" (the global catalog, pg_clog, pg_control
+    and so on) and the system databases are always restored, as
+    recovery cannot proceed without them.
+
+    """
+
+    # Postgres' FirstNormalObjectId: OIDs below it are assigned at
+    # initdb time, e.g. to template1, template0 and postgres.
+    FIRST_NORMAL_OID = 16384
+
+    def __init__(self, selectors):
+        self.databases = set()
+        self.tablespaces = set()
+        self.globs = []
+
+        for selector in selectors:
+            if selector.isdigit():
+                self.databases.add(selector)
+            elif selector.startswith('tablespace:'):
+                oid = selector[len('tablespace:'):]
+                if not oid.isdigit():
+                    raise UserException(
+                        msg='invalid tablespace selector',
+                        detail='"{0}" is not a tablespace OID.'.format(oid),
+                        hint=('Tablespaces are selected by OID, as in '
+                              'the names of the links in pg_tblspc.'))
+
+                self.tablespaces.add(oid)
+            else:
+                self.globs.append(selector)
+
+    def _wanted_database(self, oid):
+        return oid in self.databases or int(oid) < self.FIRST_NORMAL_OID
+
+    def wants(self, name):
+        """Check if the member of this name is to be restored"""
+        name = os.path.normpath(name)
+        for glob in self.globs:
+            if fnmatch.fnmatch(name, glob):
+                return True
+
+        parts = name.split(os.path.sep)
+
+        if parts[0] == 'base':
+            # "base" itself or a database directory's contents.
+            if len(parts) < 3 or not parts[1].isdigit():
+                return True
+
+            return self._wanted_database(parts[1])
+        elif parts[0] == 'pg_tblspc':
+            # Tablespace contents are laid out as
+            # pg_tblspc/<tablespace>/<version dir>/<database>/...
+            if len(parts) < 5 or parts[1] in self.tablespaces:
+                return True
+
+            if not parts[3].isdigit():
+                return True
+
+            return self._wanted_database(parts[3])
+
+        return True
+
+    def placeholders_only(self, entries):
+        """Check if a partition only holds unselected files
+
+        Such a partition need not be downloaded: its files can be
+        created from its MemberEntry values with extract_placeholders.
+
+        """
+        for entry in entries:
+            if entry.type == tarfile.DIRTYPE:
+                continue
+            elif entry.type not in tarfile.REGULAR_TYPES:
+                return False
+            elif self.wants(entry.name):
+                return False
+
+        return True
+
+    def extract_placeholders(self, entries, dest_path):
+        """Create the members of a placeholders_only partition"""
+        dest_path = os.path.realpath(dest_path)
+        known_dirs = set([dest_path])
+        dirs = []
+
+        for entry in entries:
+            targetpath = os.path.join(dest_path, entry.name)
+
+            if entry.type == tarfile.DIRTYPE:
+                targetpath = targetpath.rstrip('/')
+                _make_upperdirs(targetpath, known_dirs)
+                try:
+                    os.mkdir(targetpath, 0700)
+                except EnvironmentError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+
+                known_dirs.add(targetpath)
+                dirs.append((entry, targetpath))
+            else:
+                _make_upperdirs(targetpath, known_dirs)
+                with open(targetpath, 'wb') as dest:
+                    dest.truncate(entry.size)
+
+                os.chmod(targetpath, entry.mode)
+                os.utime(targetpath, (entry.mtime, entry.mtime))
+
+        dirs.sort(key=lambda pair: pair[1], reverse=True)
+        for entry, targetpath in dirs:
+            os.chmod(targetpath, entry.mode)
+            os.utime(targetpath, (entry.mtime, entry.mtime))
+
+
+class MemberIndex(object):
+    """Table of contents of a base backup
+
+    Maps every member to the partition holding it, along with the
+    offset of its data in the uncompressed partition and its size.
+    The compressed size of every partition is recorded as well, so
+    that a restore can be planned without listing the partitions,
+    and partitions that are not needed can be skipped.
+
+    """
+
+    VERSION = 1
+
+    def __init__(self):
+        # Partition name => (compressed size, [MemberEntry, ...])
+        self.partitions = {}
+
+    def add_partition(self, name, compressed_size, entries):
+        self.partitions[name] = (compressed_size, list(entries))
+
+    def partition_names(self):
+        return sorted(self.partitions)
+
+    def compressed_size(self, name):
+        return self.partitions[name][0]
+
+    def entries(self, name):
+        return self.partitions[name][1]
+
+    def find(self, member_name):
+        """Locate a member by name
+
+        Returns a tuple of the partition name and the MemberEntry, or
+        None if there is no such member.
+
+        """
+        member_name = os.path.normpath(member_name)
+        for name in self.partition_names():
+            for entry in self.entries(name):
+                if os.path.normpath(entry.name) == member_name:
+                    return name, entry
+
+        return None
+
+    def dump(self, fp):
+        json.dump({'version': self.VERSION,
+                   'partitions': [{'name': name,
+                                   'size': self.compressed_size(name),
+                                   'members': [list(entry) for entry in
+                                               self.entries(name)]}
+                                  for name in self.partition_names()]},
+                  fp, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, fp):
+        doc = json.load(fp)
+        if doc.get('version') != cls.VERSION:
+            raise UserException(
+                msg='unsupported backup member index version',
+                detail=('The index has version {0}, but only version {1} '
+                        'is supported.'.format(doc.get('version'),
+                                               cls.VERSION)))
+
+        index = cls()
+        for part in doc['partitions']:
+            index.add_partition(
+                part['name'], part['size'],
+                (MemberEntry(*member) for member in part['members']))
+
+        return index
 
 
 class TarPartition(list):
 
     def __init__(self, name, *args, **kwargs):
         self.name = name
+
+        # MemberEntry values for the members written by tarfile_write.
+        self.member_entries = []
         list.__init__(self, *args, **kwargs)
 
     @staticmethod
@@ -246,12 +772,16 @@ class TarPartition(list):
                 raise
 
     @staticmethod
-    def tarfile_extract(fileobj, dest_path):
+    def tarfile_extract(fileobj, dest_path, delta=None, selective=None):
         """Extract a tarfile described by a file object to a specified path.
 
         Args:
             fileobj (file): File object wrapping the target tarfile.
             dest_path (str): Path to extract the contents of the tarfile to.
+            delta (DeltaRestore): Optional, to only write members
+                that differ from the files already in dest_path.
+            selective (SelectiveRestore): Optional, to replace files
+                that are not selected by sparse placeholders.
         """
         # Though this method doesn't fit cleanly into the TarPartition object,
         # tarballs are only ever extracted for partitions so the logic jives
@@ -265,6 +795,24 @@ class TarPartition(list):
         # list of files that need fsyncing
         extracted_files = []
 
+        # Directories known to exist, to avoid stat()-ing the parent
+        # directory of every member.
+        known_dirs = set([dest_path])
+
+        # File and directory metadata (ownership, mode and times) is
+        # applied in batches rather than member-by-member.
+        deferred = []
+        deferred_dirs = []
+
+        def flush_deferred():
+            for member, targetpath in deferred:
+                _apply_metadata(tar, member, targetpath)
+
+            del deferred[:]
+
+            _fsync_files(extracted_files)
+            del extracted_files[:]
+
         # Iterate through each member of the tarfile individually. We must
         # approach it this way because we are dealing with a pipe and the
         # getmembers() method will consume it before we extract any data.
@@ -272,8 +820,31 @@ class TarPartition(list):
             assert not member.name.startswith('/')
             relpath = os.path.join(dest_path, member.name)
 
-            if member.isreg() and member.size >= pipebuf.PIPE_BUF_BYTES:
-                cat_extract(tar, member, relpath)
+            if delta is not None:
+                delta.note(member)
+                state = delta.extract(tar, member, relpath)
+
+                if state is not None:
+                    if member.isreg():
+                        deferred.append((member, relpath))
+
+                    if state == 'patched':
+                        extracted_files.append(os.path.realpath(relpath))
+
+                    continue
+
+            if (selective is not None and member.isreg() and
+                    not selective.wants(member.name)):
+                sparse_extract(member, relpath, known_dirs, deferred)
+                continue
+
+            if member.isreg():
+                if member.size >= pipebuf.PIPE_BUF_BYTES:
+                    cat_extract(tar, member, relpath, known_dirs, deferred)
+                else:
+                    small_extract(tar, member, relpath, known_dirs, deferred)
+            elif member.isdir():
+                dir_extract(tar, member, relpath, known_dirs, deferred_dirs)
             else:
                 tar.extract(member, path=dest_path)
 
@@ -289,10 +860,16 @@ class TarPartition(list):
             # avoid accumulating an unbounded list of strings which
             # could be quite large for a large database
             if len(extracted_files) > 1000:
-                _fsync_files(extracted_files)
-                del extracted_files[:]
+                flush_deferred()
+
         tar.close()
-        _fsync_files(extracted_files)
+        flush_deferred()
+
+        # Apply directory metadata deepest-first, so that setting the
+        # times of a child directory does not disturb its parent's.
+        deferred_dirs.sort(key=lambda pair: pair[1], reverse=True)
+        for member, targetpath in deferred_dirs:
+            _apply_metadata(tar, member, targetpath)
 
     def tarfile_write(self, fileobj):
         tar = None
@@ -300,13 +877,37 @@ class TarPartition(list):
             tar = tarfile.open(fileobj=fileobj, mode='w|',
                                bufsize=pipebuf.PIPE_BUF_BYTES)
 
+            del self.member_entries[:]
+
             for et_info in self:
+                start = tar.offset
+
                 # Treat files specially because they may grow, shrink,
                 # or may be unlinked in the meanwhile.
                 if et_info.tarinfo.isfile():
                     self._padded_tar_add(tar, et_info)
                 else:
                     tar.addfile(et_info.tarinfo)
+
+                if tar.offset == start:
+                    # The file was unlinked, and nothing was written.
+                    continue
+
+                # The member's data, padded to a whole number of
+                # blocks, is the last thing written.
+                tarinfo = et_info.tarinfo
+                blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+                if remainder:
+                    blocks += 1
+
+                self.member_entries.append(MemberEntry(
+                    name=tarinfo.name,
+                    type=tarinfo.type,
+                    offset=tar.offset - blocks * tarfile.BLOCKSIZE,
+                    size=tarinfo.size,
+                    mode=tarinfo.mode,
+                    mtime=int(tarinfo.mtime),
+                    linkname=tarinfo.linkname))
         finally:
             if tar is not None:
                 tar.close()
@@ -0,0 +1,143 @@
+"""
+Clearing the unused tail of WAL segments before they are archived.
+
+Postgres recycles old segment files instead of creating new ones, and
+archive_timeout or pg_switch_xlog make it switch to a new segment long
+before one is filled.  The part of an archived segment past the last
+WAL page written for it therefore holds zeros or, more often, stale
+pages from whatever segment the file was recycled from.  Stale pages
+do not compress, so a mostly idle cluster uploads close to 16MiB per
+segment.
+
+Like pg_clearxlogtail, this module only works at the level of page
+headers: every WAL page records the WAL position it was written for,
+and the first page that does not carry the right position (or the
+right magic number) ends the valid WAL in the segment.  Recovery stops
+reading at such a page, so replacing it and everything after it with
+zeros does not change what is replayed, while the segment keeps its
+full size.
+
+Segments that cannot be understood, such as history files or
+segments from unknown versions of Postgres, are left untouched.
+
+"""
+import re
+import struct
+
+from os import path
+
+from wal_e import storage
+
+# xlp_info flag set on the first page of a segment, which carries the
+# system identifier and segment and page sizes.
+XLP_LONG_HEADER = 0x0002
+
+# Postgres 9.3 replaced the (xlogid, xrecoff) pair of 32-bit integers
+# used for WAL positions by a single 64-bit integer, and raised the
+# page magic number to 0xD075 at the same time.
+FLAT_PAGEADDR_MAGIC = 0xD075
+
+# Page headers, in native byte order as written by Postgres:
+#
+#   magic, info, timeline, page address
+#
+# and for the first page of a segment, also:
+#
+#   [remaining length,] system identifier, segment size, page size
+_SHORT_HEADER = struct.Struct('=HHIQ')
+_LONG_HEADER = struct.Struct('=HHIQI4xQII')
+_OLD_SHORT_HEADER = struct.Struct('=HHIII')
+_OLD_LONG_HEADER = struct.Struct('=HHIIIQII')
+
+# Segments are written out in chunks of this size.
+_CHUNK_SIZE = 65536
+_ZEROS = '\0' * _CHUNK_SIZE
+
+
+def segment_start(segment_name, segment_size):
+    """Return the WAL position a segment starts at, or None
+
+    None is returned if segment_name is not the name of a segment.
+
+    """
+    match = re.match(storage.SEGMENT_REGEXP + '$', segment_name)
+    if match is None:
+        return None
+
+    gd = match.groupdict()
+    return (int(gd['log'], 16) << 32) + int(gd['seg'], 16) * segment_size
+
+
+def _page_address(header, magic):
+    if magic >= FLAT_PAGEADDR_MAGIC:
+        _, _, _, pageaddr = _SHORT_HEADER.unpack_from(header)
+        return pageaddr
+    else:
+        _, _, _, xlogid, xrecoff = _OLD_SHORT_HEADER.unpack_from(header)
+        return (xlogid << 32) | xrecoff
+
+
+def valid_length(data, segment_name):
+    """Return the number of bytes of valid WAL at the start of data
+
+    This is always a multiple of the WAL page size.  None is returned
+    if data does not look like the segment called segment_name.
+
+    """
+    if len(data) < _LONG_HEADER.size:
+        return None
+
+    magic, info = struct.unpack_from('=HH', data)
+    if not info & XLP_LONG_HEADER:
+        return None
+
+    if magic >= FLAT_PAGEADDR_MAGIC:
+        fields = _LONG_HEADER.unpack_from(data)
+    else:
+        fields = _OLD_LONG_HEADER.unpack_from(data)
+
+    segment_size, page_size = fields[-2:]
+
+    if (segment_size != len(data) or page_size < _LONG_HEADER.size or
+            page_size & (page_size - 1) or segment_size % page_size):
+        return None
+
+    start = segment_start(segment_name, segment_size)
+    if start is None:
+        return None
+
+    if _page_address(data, magic) != start:
+        return None
+
+    for offset in xrange(page_size, segment_size, page_size):
+        page_magic, = struct.unpack_from('=H', data, offset)
+        if (page_magic != magic or
+                _page_address(buffer(data, offset), magic) != start + offset):
+            return offset
+
+    return segment_size
+
+
+def write_cleared(seg_path, fp):
+    """Write the segment at seg_path to fp, with its tail zeroed
+
+    Returns the number of bytes of valid WAL written, or None if the
+    segment was written unchanged because it could not be understood.
+
+    """
+    with open(seg_path, 'rb') as f:
+        data = f.read()
+
+    valid = valid_length(data, path.basename(seg_path))
+
+    end = len(data) if valid is None else valid
+    for offset in xrange(0, end, _CHUNK_SIZE):
+        fp.write(buffer(data, offset, min(_CHUNK_SIZE, end - offset)))
+
+    remaining = len(data) - end
+    while remaining > 0:
+        n = min(remaining, _CHUNK_SIZE)
+        fp.write(buffer(_ZEROS, 0, n))
+        remaining -= n
+
+    return valid
@@ -1,5 +1,6 @@
 from wal_e.worker.pg import PgBackupStatements
 from wal_e.worker.pg import PgControlDataParser
+from wal_e.worker.pg.archive_watch import ArchiveWatcher
 from wal_e.worker.pg.wal_transfer import WalSegment
 from wal_e.worker.pg.wal_transfer import WalTransferGroup
 from wal_e.worker.upload import PartitionUploader
@@ -10,6 +11,7 @@ from wal_e.worker.worker_util import do_lzop_put
 from wal_e.worker.worker_util import uri_put_file
 
 __all__ = [
+    'ArchiveWatcher',
     'PartitionUploader',
     'PgBackupStatements',
     'PgControlDataParser',
@@ -0,0 +1,188 @@
+"""Keep an index of the base backups of an archive in the archive
+
+Finding the base backups of an archive means listing the base backups
+directory for the sentinel of each backup, and then getting each
+sentinel for the details of the backup, one request after the other.
+Instead, backup-push and delete keep one object at the root of the
+prefix describing all backups:
+
+    PREFIX/backup_index_005.json
+
+    {"format": 1,
+     "generation": 12,
+     "listed_at": 1469004800.0,
+     "backups": [{"name": "base_000000010000000000000002_00000028",
+                  "last_modified": "2016-07-20T08:53:20.000Z",
+                  "wal_segment_backup_start": "000000010000000000000002",
+                  "wal_segment_offset_backup_start": "00000028",
+                  "wal_segment_backup_stop": "000000010000000000000002",
+                  "wal_segment_offset_backup_stop": "000000F8",
+                  "expanded_size_bytes": 23498402,
+                  "partitions": 1}]}
+
+Writers read the index, change it, and write it back only if nobody
+wrote it meanwhile, trying again otherwise.  Each write increments the
+generation, so that the content, and thus the ETag, always changes.
+
+Readers only trust the index if it was rebuilt from a listing less
+than REBUILD_INTERVAL seconds ago, which catches changes made by
+other means than WAL-E.  Otherwise, they list the archive.  Only
+commands that write to the archive anyway, backup-push and delete,
+then rebuild the index from the listing, unless it was written
+meanwhile: a writer may have added or removed a backup after the
+listing.  An index that is missing, or stale, is still written to by
+writers, for that reason, but the backups they add or remove are left
+out until the next rebuild.
+
+"""
+import datetime
+import json
+import time
+
+from cStringIO import StringIO
+
+from wal_e.storage import SegmentNumber
+from wal_e.storage.base import BackupInfo
+
+# Version of the format of the index.
+INDEX_FORMAT = 1
+
+# Seconds after which the index is rebuilt from a listing.
+REBUILD_INTERVAL = 24 * 60 * 60
+
+# Conditional writes attempted before giving up and marking the index
+# stale.
+MAX_ATTEMPTS = 5
+
+# The format of modification times in the listings of each store.
+LAST_MODIFIED_FORMATS = {
+    's3': '%Y-%m-%dT%H:%M:%S.000Z',
+    'wabs': '%a, %d %b %Y %H:%M:%S GMT',
+    'swift': '%Y-%m-%dT%H:%M:%S.%f',
+}
+
+
+def backup_entry(backup_info, partitions=None):
+    """Return the entry of the index describing a BackupInfo"""
+    entry = dict((field, getattr(backup_info, field))
+                 for field in BackupInfo._fields)
+    entry['partitions'] = partitions
+    return entry
+
+
+def entry_segment_number(entry):
+    """Return the SegmentNumber a backup starts at"""
+    start = entry['wal_segment_backup_start']
+    return SegmentNumber(log=start[8:16], seg=start[16:24])
+
+
+def last_modified_now(layout):
+    """Return the current time as listings of layout's store give it"""
+    return datetime.datetime.utcnow().strftime(
+        LAST_MODIFIED_FORMATS[layout.scheme])
+
+
+class BackupIndex(object):
+
+    def __init__(self, blobstore, creds, layout):
+        self.blobstore = blobstore
+        self.creds = creds
+        self.layout = layout
+        self.uri = '{scheme}://{bucket}/{path}'.format(
+            scheme=layout.scheme, bucket=layout.store_name(),
+            path=layout.backup_index())
+
+        # The ETag and generation of the index when last read, for
+        # rebuild.
+        self.etag = None
+        self.generation = 0
+
+    def _read(self):
+        # Return the index and its ETag; the index is None if missing
+        # or unreadable.
+        data, etag = self.blobstore.uri_get_tagged(self.creds, self.uri)
+        if data is None:
+            return None, None
+
+        # WABS creates an empty index before writing one.
+        try:
+            index = json.loads(data)
+        except ValueError:
+            return None, etag
+
+        if index.get('format') != INDEX_FORMAT:
+            return None, etag
+
+        return index, etag
+
+    def _fresh(self, index):
+        return (index is not None and index.get('listed_at') is not None
+                and time.time() - index['listed_at'] < REBUILD_INTERVAL)
+
+    def _write(self, index, etag):
+        return self.blobstore.uri_put_if_match(
+            self.creds, self.uri, json.dumps(index, sort_keys=True), etag)
+
+    def backups(self):
+        """Return the entries of the backups, or None to list instead"""
+        index, self.etag = self._read()
+        self.generation = (index or {}).get('generation', 0)
+        if not self._fresh(index):
+            return None
+
+        return index['backups']
+
+    def rebuild(self, entries):
+        """Replace the index read last with the backups listed since
+
+        Return whether the index was replaced, which it is not if it
+        was written since it was read.
+
+        """
+        return self._write(
+            {'format': INDEX_FORMAT,
+             'generation': self.generation + 1,
+             'listed_at': time.time(),
+             'backups': sorted(entries, key=lambda e: e['name'])},
+            self.etag)
+
+    def update(self, change):
+        """Apply change to the entries of the backups
+
+        change is called with the list of entries, and returns the new
+        list.  Should the index keep being written by others, or the
+        writes fail, it is marked stale before giving up.
+
+        """
+        try:
+            for attempt in xrange(MAX_ATTEMPTS):
+                index, etag = self._read()
+                if index is None:
+                    index = {'format': INDEX_FORMAT, 'generation': 0,
+                             'listed_at': None, 'backups': []}
+                elif self._fresh(index):
+                    index['backups'] = sorted(change(index['backups']),
+                                              key=lambda e: e['name'])
+
+                # Stale indexes are written too, without the change:
+                # the write prevents rebuilding them from a listing
+                # made before the change.
+                index['generation'] += 1
+                if self._write(index, etag):
+                    return
+        except Exception:
+            self.invalidate()
+            raise
+
+        self.invalidate()
+
+    def invalidate(self):
+        """Mark the index stale, so that readers list backups instead"""
+        index, _ = self._read()
+        stale = {'format': INDEX_FORMAT,
+                 'generation': (index or {}).get('generation', 0) + 1,
+                 'listed_at': None,
+                 'backups': []}
+        self.blobstore.uri_put_file(self.creds, self.uri,
+                                    StringIO(json.dumps(stale)),
+                                    content_encoding='application/json')
@@ -1,10 +1,14 @@
 import gevent
 import re
+import sys
+import traceback
 
 from gevent import queue
 from wal_e import exception
 from wal_e import log_help
 from wal_e import storage
+from wal_e.worker import backup_index
+from wal_e.worker import sharded_list
 
 logger = log_help.WalELogger(__name__)
 
@@ -14,19 +18,24 @@ generic_weird_key_hint_message = ('This means an unexpected key was found in '
 
 
 class _Deleter(object):
-    def __init__(self):
+    def __init__(self, concurrency=1):
         # Allow enqueuing of several API calls worth of work, which
         # right now allow 1000 key deletions per job.
         self.PAGINATION_MAX = 1000
-        self._q = queue.JoinableQueue(self.PAGINATION_MAX * 10)
-        self._worker = gevent.spawn(self._work)
+        self._q = queue.JoinableQueue(self.PAGINATION_MAX * 10 *
+                                      concurrency)
+
+        # Each worker deletes a page at a time, so that up to
+        # concurrency pages are being deleted at once.
+        self._workers = [gevent.spawn(self._work)
+                         for i in xrange(concurrency)]
         self._parent_greenlet = gevent.getcurrent()
         self.closing = False
 
     def close(self):
         self.closing = True
         self._q.join()
-        self._worker.kill(block=True)
+        gevent.killall(self._workers, block=True)
 
     def delete(self, key):
         if self.closing:
@@ -44,12 +53,6 @@ class _Deleter(object):
                 # times.
                 page = self._cut_batch()
 
-                # If nothing was enqueued, yield and wait around a bit
-                # before looking for work again.
-                if not page:
-                    gevent.sleep(1)
-                    continue
-
                 # However, in event of success, the jobs are not
                 # considered done until the _delete_batch returns
                 # successfully.  In event an exception is raised, it
@@ -76,13 +79,13 @@ class _Deleter(object):
             gevent.kill(self._parent_greenlet, e)
 
     def _cut_batch(self):
-        # Attempt to obtain as much work as possible, up to the
-        # maximum able to be processed by S3 at one time,
-        # PAGINATION_MAX.
-        page = []
+        # Wait for work to arrive, then attempt to obtain as much work
+        # as possible, up to the maximum able to be processed by S3 at
+        # one time, PAGINATION_MAX.
+        page = [self._q.get()]
 
         try:
-            for i in xrange(self.PAGINATION_MAX):
+            for i in xrange(self.PAGINATION_MAX - 1):
                 page.append(self._q.get_nowait())
         except queue.Empty:
             pass
@@ -98,10 +101,12 @@ class _Deleter(object):
 
 class _BackupList(object):
 
-    def __init__(self, conn, layout, detail):
+    def __init__(self, conn, layout, detail, catalog=None, index=None):
         self.conn = conn
         self.layout = layout
         self.detail = detail
+        self.catalog = catalog
+        self.index = index
 
     def find_all(self, query):
         """A procedure to assist in finding or detailing specific backups
@@ -140,66 +145,199 @@ class _BackupList(object):
     def _backup_list(self):
         raise NotImplementedError()
 
+    def _list_level(self, prefix):
+        raise NotImplementedError()
+
+    def _make_key(self, name, size, last_modified):
+        raise NotImplementedError()
+
+    def _level(self, prefix):
+        # Like _list_level, going through the catalog if there is one.
+        if self.catalog is None:
+            return self._list_level(prefix)
+
+        self.catalog.sync_basebackups(self)
+        rows, directories = self.catalog.level(prefix)
+        return [self._make_key(*row) for row in rows], directories
+
     def __iter__(self):
+        if self.index is not None:
+            entries = self.index.backups()
+            if entries is not None:
+                for entry in entries:
+                    yield self._indexed_backup(entry)
+                return
+
+        # Listing backups is read-only: only commands that write to
+        # the archive anyway rebuild a stale index.
+        for info in self._listed_backups():
+            yield info
+
+    def _indexed_backup(self, entry):
+        info = storage.get_backup_info(
+            self.layout,
+            **dict((field, entry.get(field))
+                   for field in storage.base.BackupInfo._fields))
+
+        # Backups indexed from a listing are described by their names
+        # alone.
+        if self.detail and info.wal_segment_backup_stop is None:
+            try:
+                info.load_detail(self.conn)
+            except gevent.Timeout:
+                pass
+
+        return info
+
+    def _listed_backups(self):
 
         # Try to identify the sentinel file.  This is sort of a drag, the
         # storage format should be changed to put them in their own leaf
         # directory.
         #
         # TODO: change storage format
-        sentinel_depth = self.layout.basebackups().count('/')
+        #
+        # Sentinel files are the only keys directly in the base backups
+        # directory, so they are listed without the contents of the
+        # backup directories next to them.
         matcher = re.compile(storage.COMPLETE_BASE_BACKUP_REGEXP).match
 
-        for key in self._backup_list(self.layout.basebackups()):
+        keys, _ = self._level(self.layout.basebackups())
+        for key in keys:
             key_name = self.layout.key_name(key)
-            # Use key depth vs. base and regexp matching to find
-            # sentinel files.
-            key_depth = key_name.count('/')
-
-            if key_depth == sentinel_depth:
-                backup_sentinel_name = key_name.rsplit('/', 1)[-1]
-                match = matcher(backup_sentinel_name)
-                if match:
-                    # TODO: It's necessary to use the name of the file to
-                    # get the beginning wal segment information, whereas
-                    # the ending information is encoded into the file
-                    # itself.  Perhaps later on it should all be encoded
-                    # into the name when the sentinel files are broken out
-                    # into their own directory, so that S3 listing gets
-                    # all commonly useful information without doing a
-                    # request-per.
-                    groups = match.groupdict()
-
-                    info = storage.get_backup_info(
-                        self.layout,
-                        name='base_{filename}_{offset}'.format(**groups),
-                        last_modified=self.layout.key_last_modified(key),
-                        wal_segment_backup_start=groups['filename'],
-                        wal_segment_offset_backup_start=groups['offset'])
-
-                    if self.detail:
-                        try:
-                            # This costs one web request
-                            info.load_detail(self.conn)
-                        except gevent.Timeout:
-                            pass
-
-                    yield info
+
+            backup_sentinel_name = key_name.rsplit('/', 1)[-1]
+            match = matcher(backup_sentinel_name)
+            if match:
+                # TODO: It's necessary to use the name of the file to
+                # get the beginning wal segment information, whereas
+                # the ending information is encoded into the file
+                # itself.  Perhaps later on it should all be encoded
+                # into the name when the sentinel files are broken out
+                # into their own directory, so that S3 listing gets
+                # all commonly useful information without doing a
+                # request-per.
+                groups = match.groupdict()
+
+                info = storage.get_backup_info(
+                    self.layout,
+                    name='base_{filename}_{offset}'.format(**groups),
+                    last_modified=self.layout.key_last_modified(key),
+                    wal_segment_backup_start=groups['filename'],
+                    wal_segment_offset_backup_start=groups['offset'])
+
+                if self.detail:
+                    try:
+                        # This costs one web request
+                        info.load_detail(self.conn)
+                    except gevent.Timeout:
+                        pass
+
+                yield info
 
 
 class _DeleteFromContext(object):
 
-    def __init__(self, conn, layout, dry_run):
+    # Whether the store can list keys between two keys, as needed to
+    # list the WAL directory in concurrent ranges; see
+    # wal_e.worker.sharded_list.
+    can_list_ranges = False
+
+    def __init__(self, conn, layout, dry_run, pool_size=1, catalog=None,
+                 index=None):
         self.conn = conn
         self.dry_run = dry_run
         self.layout = layout
+        self.pool_size = pool_size
+        self.catalog = catalog
+        self.index = index
         self.deleter = None  # Must be set by subclass
 
+        # Which backups to keep in the backup index, once deletion is
+        # done.
+        self._keep_indexed = None
+
+        # Names of the keys deleted, to be removed from the catalog
+        # once they are.
+        self._deleted = []
+        self._catalog_synced = False
+
         assert self.dry_run in (True, False)
 
     def _container_name(self, key):
         pass
 
+    def _backup_list(self, prefix):
+        raise NotImplementedError()
+
+    def _list_level(self, prefix):
+        raise NotImplementedError()
+
+    def _probe(self, prefix):
+        raise NotImplementedError()
+
+    def _list_range(self, prefix, start_after, end_before):
+        raise NotImplementedError()
+
+    def _make_key(self, name, size, last_modified):
+        raise NotImplementedError()
+
+    def _sync_catalog(self):
+        if not self._catalog_synced:
+            self.catalog.sync_basebackups(self)
+            self.catalog.sync_wal(self)
+            self._catalog_synced = True
+
+    def _catalog_keys(self, rows):
+        for name, size, last_modified in rows:
+            yield self._make_key(name, size, last_modified)
+
+    def _level(self, prefix):
+        # Like _list_level, going through the catalog if there is one.
+        if self.catalog is None:
+            return self._list_level(prefix)
+
+        self._sync_catalog()
+        rows, directories = self.catalog.level(prefix)
+        return list(self._catalog_keys(rows)), directories
+
+    def _keys(self, prefix):
+        # Like _backup_list, going through the catalog if there is one.
+        if self.catalog is None:
+            return self._backup_list(prefix=prefix)
+
+        self._sync_catalog()
+        self.catalog.sync_contents(self, prefix)
+        return self._catalog_keys(self.catalog.keys(prefix))
+
+    def _wal_list(self, horizon=None):
+        """List the WAL directory, from the catalog if there is one
+
+        With a horizon SegmentNumber, WAL files at or after it on
+        their timeline may be left out.
+
+        """
+        if self.catalog is None:
+            return self._remote_wal_list(horizon=horizon)
+
+        self._sync_catalog()
+        return self._catalog_keys(self.catalog.wal_keys(horizon=horizon))
+
+    def _remote_wal_list(self, horizon=None):
+        """List the WAL directory in the store
+
+        With a horizon SegmentNumber, WAL files at or after it on
+        their timeline may be left out.
+
+        """
+        prefix = self.layout.wal_directory()
+        if not self.can_list_ranges:
+            return self._backup_list(prefix=prefix)
+
+        return sharded_list.list_sharded(self._probe, self._list_range,
+                                         prefix, self.pool_size,
+                                         horizon=horizon)
+
     def _maybe_delete_key(self, key, type_of_thing):
         key_name = self.layout.key_name(key)
         url = '{scheme}://{bucket}/{name}'.format(
@@ -212,6 +350,8 @@ class _DeleteFromContext(object):
         if self.dry_run is False:
             logger.info(**log_message)
             self.deleter.delete(key)
+            if self.catalog is not None:
+                self._deleted.append(key_name)
         elif self.dry_run is True:
             log_message['hint'] = ('This is only a dry run -- no actual data '
                                    'is being deleted')
@@ -219,6 +359,20 @@ class _DeleteFromContext(object):
         else:
             assert False
 
+    def _forget_backups(self, keep):
+        # Remove the backups to be deleted from the backup index
+        # before deleting them, so that the index never lists deleted
+        # backups, and once more after, in case it was rebuilt from a
+        # listing made meanwhile.
+        if self.index is None or self.dry_run:
+            return
+
+        def change(entries):
+            return [entry for entry in entries if keep(entry)]
+
+        self.index.update(change)
+        self._keep_indexed = change
+
     def _groupdict_to_segment_number(self, d):
         return storage.base.SegmentNumber(log=d['log'], seg=d['seg'])
 
@@ -229,102 +383,96 @@ class _DeleteFromContext(object):
             self._maybe_delete_key(key, type_of_thing)
 
     def _delete_base_backups_before(self, segment_info):
+        self._forget_backups(
+            lambda entry: (backup_index.entry_segment_number(entry)
+                           .as_an_integer >= segment_info.as_an_integer))
+
         base_backup_sentinel_depth = self.layout.basebackups().count('/') + 1
         version_depth = base_backup_sentinel_depth + 1
         volume_backup_depth = version_depth + 1
 
         # The base-backup sweep, deleting bulk data and metadata, but
-        # not any wal files.
-        for key in self._backup_list(prefix=self.layout.basebackups()):
+        # not any wal files.  Only the sentinel files and the names of
+        # the backup directories are listed at first: the contents of
+        # a backup directory are only listed to delete them.
+        sentinels, directories = self._level(self.layout.basebackups())
+
+        for key in sentinels:
             key_name = self.layout.key_name(key)
             url = '{scheme}://{bucket}/{name}'.format(
                 scheme=self.layout.scheme, bucket=self._container_name(key),
                 name=key_name)
-            key_parts = key_name.split('/')
-            key_depth = len(key_parts)
 
-            if key_depth not in (base_backup_sentinel_depth, version_depth,
-                                 volume_backup_depth):
-                # Check depth (in terms of number of
-                # slashes/delimiters in the key); if there exists a
-                # key with an unexpected depth relative to the
-                # context, complain a little bit and move on.
+            # This is a key at the base-backup-sentinel file depth, so
+            # check to see if it matches the known form.
+            match = re.match(storage.COMPLETE_BASE_BACKUP_REGEXP,
+                             key_name.rsplit('/', 1)[-1])
+            if match is None:
+                # This key was at the level for a base backup
+                # sentinel, but doesn't match the known pattern.
+                # Complain about this, and move on.
                 logger.warning(
                     msg="skipping non-qualifying key in 'delete before'",
-                    detail=(
-                        'The unexpected key is "{0}", and it appears to be '
-                        'at an unexpected depth.'.format(url)),
+                    detail=('The unexpected key is "{0}", and it appears '
+                            'not to match the base-backup sentinel '
+                            'pattern.'.format(url)),
                     hint=generic_weird_key_hint_message)
-            elif key_depth == base_backup_sentinel_depth:
-                # This is a key at the base-backup-sentinel file
-                # depth, so check to see if it matches the known form.
-                match = re.match(storage.COMPLETE_BASE_BACKUP_REGEXP,
-                                 key_parts[-1])
-                if match is None:
-                    # This key was at the level for a base backup
-                    # sentinel, but doesn't match the known pattern.
-                    # Complain about this, and move on.
-                    logger.warning(
-                        msg="skipping non-qualifying key in 'delete before'",
-                        detail=('The unexpected key is "{0}", and it appears '
-                                'not to match the base-backup sentinel '
-                                'pattern.'.format(url)),
-                        hint=generic_weird_key_hint_message)
-                else:
-                    # This branch actually might delete some data: the
-                    # key is at the right level, and matches the right
-                    # form.  The last check is to make sure it's in
-                    # the range of things to delete, and if that is
-                    # the case, attempt deletion.
-                    assert match is not None
-                    scanned_sn = \
-                        self._groupdict_to_segment_number(match.groupdict())
-                    self._delete_if_before(segment_info, scanned_sn, key,
-                                        'a base backup sentinel file')
-            elif key_depth == version_depth:
-                match = re.match(
-                    storage.BASE_BACKUP_REGEXP, key_parts[-2])
+            else:
+                # This branch actually might delete some data: the
+                # key is at the right level, and matches the right
+                # form.  The last check is to make sure it's in the
+                # range of things to delete, and if that is the case,
+                # attempt deletion.
+                scanned_sn = \
+                    self._groupdict_to_segment_number(match.groupdict())
+                self._delete_if_before(segment_info, scanned_sn, key,
+                                       'a base backup sentinel file')
 
-                if match is None or key_parts[-1] != 'extended_version.txt':
-                    logger.warning(
-                        msg="skipping non-qualifying key in 'delete before'",
-                        detail=('The unexpected key is "{0}", and it appears '
-                                'not to match the extended-version backup '
-                                'pattern.'.format(url)),
-                        hint=generic_weird_key_hint_message)
+        for directory in directories:
+            match = re.match(storage.BASE_BACKUP_REGEXP,
+                             directory.rstrip('/').rsplit('/', 1)[-1])
+            if match is None:
+                logger.warning(
+                    msg="skipping non-qualifying directory in 'delete before'",
+                    detail=('The unexpected directory is "{0}://{1}/{2}", '
+                            'and it appears not to match the base-backup '
+                            'pattern.'.format(self.layout.scheme,
+                                              self.layout.store_name(),
+                                              directory)),
+                    hint=generic_weird_key_hint_message)
+                continue
+
+            scanned_sn = self._groupdict_to_segment_number(match.groupdict())
+            if scanned_sn.as_an_integer >= segment_info.as_an_integer:
+                continue
+
+            for key in self._keys(directory):
+                key_name = self.layout.key_name(key)
+                url = '{scheme}://{bucket}/{name}'.format(
+                    scheme=self.layout.scheme,
+                    bucket=self._container_name(key),
+                    name=key_name)
+                key_parts = key_name.split('/')
+                key_depth = len(key_parts)
+
+                if (key_depth == version_depth and
+                        key_parts[-1] == 'extended_version.txt'):
+                    self._maybe_delete_key(key,
+                                           'a extended version metadata file')
+                elif (key_depth == volume_backup_depth and
+                        key_parts[-2] == 'tar_partitions'):
+                    self._maybe_delete_key(key, 'a base backup volume')
                 else:
-                    assert match is not None
-                    scanned_sn = \
-                        self._groupdict_to_segment_number(match.groupdict())
-                    self._delete_if_before(segment_info, scanned_sn, key,
-                                        'a extended version metadata file')
-            elif key_depth == volume_backup_depth:
-                # This has the depth of a base-backup volume, so try
-                # to match the expected pattern and delete it if the
-                # pattern matches and the base backup part qualifies
-                # properly.
-                assert len(key_parts) >= 2, ('must be a logical result of the '
-                                             's3 storage layout')
-
-                match = re.match(
-                    storage.BASE_BACKUP_REGEXP, key_parts[-3])
-
-                if match is None or key_parts[-2] != 'tar_partitions':
+                    # Check depth (in terms of number of
+                    # slashes/delimiters in the key) and form; if
+                    # there exists an unexpected key in the backup,
+                    # complain a little bit and move on.
                     logger.warning(
                         msg="skipping non-qualifying key in 'delete before'",
-                        detail=(
-                            'The unexpected key is "{0}", and it appears '
-                            'not to match the base-backup partition pattern.'
-                            .format(url)),
+                        detail=('The unexpected key is "{0}", and it appears '
+                                'not to match the base-backup pattern.'
+                                .format(url)),
                         hint=generic_weird_key_hint_message)
-                else:
-                    assert match is not None
-                    scanned_sn = \
-                        self._groupdict_to_segment_number(match.groupdict())
-                    self._delete_if_before(segment_info, scanned_sn, key,
-                                        'a base backup volume')
-            else:
-                assert False
 
     def _delete_wals_before(self, segment_info):
         """
@@ -333,7 +481,7 @@ class _DeleteFromContext(object):
         Doesn't delete any base-backup data.
         """
         wal_key_depth = self.layout.wal_directory().count('/') + 1
-        for key in self._backup_list(prefix=self.layout.wal_directory()):
+        for key in self._wal_list(horizon=segment_info):
             key_name = self.layout.key_name(key)
             bucket = self._container_name(key)
             url = '{scm}://{bucket}/{name}'.format(scm=self.layout.scheme,
@@ -392,6 +540,18 @@ class _DeleteFromContext(object):
             else:
                 assert False
 
+    def _close(self):
+        if self.deleter:
+            self.deleter.close()
+
+        if self._deleted:
+            self.catalog.remove(self._deleted)
+            self._deleted = []
+
+        if self._keep_indexed is not None:
+            self.index.update(self._keep_indexed)
+            self._keep_indexed = None
+
     def delete_everything(self):
         """Delete everything in a storage layout
 
@@ -405,14 +565,15 @@ class _DeleteFromContext(object):
           database, for example)
 
         """
-        for k in self._backup_list(prefix=self.layout.basebackups()):
+        self._forget_backups(lambda entry: False)
+
+        for k in self._keys(self.layout.basebackups()):
             self._maybe_delete_key(k, 'part of a base backup')
 
-        for k in self._backup_list(prefix=self.layout.wal_directory()):
+        for k in self._wal_list():
             self._maybe_delete_key(k, 'part of wal logs')
 
-        if self.deleter:
-            self.deleter.close()
+        self._close()
 
     def delete_before(self, segment_info):
         """
@@ -429,47 +590,85 @@ class _DeleteFromContext(object):
         # This will delete all WAL segments before segment_info.
         self._delete_wals_before(segment_info)
 
-        if self.deleter:
-            self.deleter.close()
-
-    def delete_with_retention(self, num_to_retain):
-        """
-        Retain the num_to_retain most recent backups and delete all data
-        before them.
-
-        """
-        base_backup_sentinel_depth = self.layout.basebackups().count('/') + 1
-
-        # Sweep over base backup files, collecting sentinel files from
-        # completed backups.
+        self._close()
+
+    def _completed_backups(self):
+        # Return the segment number and sentinel URL of each completed
+        # backup, from the backup index if it can be trusted.
+        entries = None
+        if self.index is not None:
+            entries = self.index.backups()
+
+        if entries is not None:
+            return [dict(scanned_sn=backup_index.entry_segment_number(entry),
+                         url='{scheme}://{bucket}/{name}'.format(
+                             scheme=self.layout.scheme,
+                             bucket=self.layout.store_name(),
+                             name=(self.layout.basebackups() + entry['name'] +
+                                   '_backup_stop_sentinel.json')))
+                    for entry in entries]
+
+        # Sweep over the sentinel files of completed backups, which
+        # are the only keys directly in the base backups directory.
         completed_basebackups = []
-        for key in self._backup_list(prefix=self.layout.basebackups()):
+        listed = []
+        sentinels, _ = self._level(self.layout.basebackups())
+        for key in sentinels:
 
             key_name = self.layout.key_name(key)
             key_parts = key_name.split('/')
-            key_depth = len(key_parts)
             url = '{scheme}://{bucket}/{name}'.format(
                 scheme=self.layout.scheme,
                 bucket=self._container_name(key),
                 name=key_name)
 
-            if key_depth == base_backup_sentinel_depth:
-                # This is a key at the depth of a base-backup-sentinel file.
-                # Check to see if it matches the known form.
-                match = re.match(storage.COMPLETE_BASE_BACKUP_REGEXP,
-                                 key_parts[-1])
+            # Check to see if it matches the known form of a
+            # base-backup-sentinel file.
+            match = re.match(storage.COMPLETE_BASE_BACKUP_REGEXP,
+                             key_parts[-1])
+
+            # If this isn't a base-backup-sentinel file, just ignore it.
+            if match is None:
+                continue
+
+            # This key corresponds to a base-backup-sentinel file and
+            # represents a completed backup. Grab its segment number.
+            scanned_sn = \
+                self._groupdict_to_segment_number(match.groupdict())
+            completed_basebackups.append(dict(
+                scanned_sn=scanned_sn,
+                url=url))
+
+            groups = match.groupdict()
+            listed.append(backup_index.backup_entry(storage.get_backup_info(
+                self.layout,
+                name='base_{filename}_{offset}'.format(**groups),
+                last_modified=self.layout.key_last_modified(key),
+                wal_segment_backup_start=groups['filename'],
+                wal_segment_offset_backup_start=groups['offset'])))
+
+        if self.index is not None and not self.dry_run:
+            self._rebuild_index(listed)
+
+        return completed_basebackups
+
+    def _rebuild_index(self, listed):
+        # Only a missed opportunity: backups are listed until the
+        # index is rebuilt.
+        try:
+            self.index.rebuild(listed)
+        except Exception:
+            logger.warning(
+                msg='could not rebuild the backup index',
+                detail=''.join(traceback.format_exception(*sys.exc_info())))
 
-                # If this isn't a base-backup-sentinel file, just ignore it.
-                if match is None:
-                    continue
+    def delete_with_retention(self, num_to_retain):
+        """
+        Retain the num_to_retain most recent backups and delete all data
+        before them.
 
-                # This key corresponds to a base-backup-sentinel file and
-                # represents a completed backup. Grab its segment number.
-                scanned_sn = \
-                    self._groupdict_to_segment_number(match.groupdict())
-                completed_basebackups.append(dict(
-                    scanned_sn=scanned_sn,
-                    url=url))
+        """
+        completed_basebackups = self._completed_backups()
 
         # Sort the base backups from newest to oldest.
         basebackups = sorted(
@@ -507,5 +706,4 @@ class _DeleteFromContext(object):
             self._delete_base_backups_before(last_retained['scanned_sn'])
             self._delete_wals_before(last_retained['scanned_sn'])
 
-        if self.deleter:
-            self.deleter.close()
+        self._close()
@@ -0,0 +1,295 @@
+"""Keep a local catalog of the keys in an archive
+
+Deleting old backups, and finding the latest one, needs to know what
+is in the archive.  Listing it again every time takes minutes for
+archives of millions of WAL files, although little changes between
+two runs: some segments are archived, a backup is pushed, and old
+ones are deleted.
+
+The catalog is a SQLite database of the names, sizes and modification
+times of the keys of one archive, along with the segment number
+parsed from the names of WAL files and backup sentinels.  It is
+brought up to date before use, listing only what may have changed:
+
+* the sentinels and directory names of the base backups directory,
+  which are few;
+
+* the contents of the backup directories not known to be complete,
+  i.e. without a sentinel when they were last listed, as completed
+  backups do not change;
+
+* the WAL files that sort after the last one seen, as WAL files are
+  named in the order they are written.
+
+Files archived out of that order, for instance by an old primary
+after a failover, are only picked up by a complete listing, which is
+done every RECONCILE_INTERVAL seconds, or on demand.  Keys deleted by
+WAL-E are removed from the catalog as they are deleted.
+
+"""
+import re
+import sqlite3
+import time
+
+from wal_e import storage
+
+# Seconds after which the WAL directory is listed completely again.
+RECONCILE_INTERVAL = 24 * 60 * 60
+
+# Seconds to wait for other processes using the catalog.
+LOCK_TIMEOUT = 10 * 60
+
+# Rows inserted per statement.
+INSERT_BATCH = 1000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS keys (
+    name TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    size INTEGER,
+    last_modified TEXT,
+    segment INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS keys_directory ON keys (directory);
+
+CREATE TABLE IF NOT EXISTS directories (
+    name TEXT PRIMARY KEY,
+    parent TEXT NOT NULL,
+    complete INTEGER NOT NULL
+);
+'''
+
+
+class CatalogKey(object):
+    def __init__(self, name, size, last_modified):
+        self.name = name
+        self.size = size
+        self.last_modified = last_modified
+
+
+def segment_number(key_name):
+    """Return the segment number of a WAL file or backup sentinel
+
+    The number is that of SegmentNumber.as_an_integer, naive of the
+    timeline, or None for other keys.
+
+    """
+    name = key_name.rsplit('/', 1)[-1]
+    match = (re.match(storage.SEGMENT_REGEXP, name) or
+             re.match(storage.COMPLETE_BASE_BACKUP_REGEXP, name))
+    if match is None:
+        return None
+
+    return storage.SegmentNumber(log=match.group('log'),
+                                 seg=match.group('seg')).as_an_integer
+
+
+def _prefix_end(prefix):
+    # The smallest name after all names starting with prefix.
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
+def _batches(iterable):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == INSERT_BATCH:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+class Catalog(object):
+
+    def __init__(self, catalog_path, layout):
+        self.layout = layout
+        self.db = sqlite3.connect(catalog_path, timeout=LOCK_TIMEOUT)
+        self.db.executescript(SCHEMA)
+
+        # A catalog of another archive is of no use.
+        if self._get('prefix') != layout.prefix:
+            with self.db:
+                for table in ('meta', 'keys', 'directories'):
+                    self.db.execute('DELETE FROM ' + table)
+                self._set('prefix', layout.prefix)
+
+    def close(self):
+        self.db.close()
+
+    def _get(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                              (key,)).fetchone()
+        return row and row[0]
+
+    def _set(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                        (key, value))
+
+    def _row(self, key):
+        name = self.layout.key_name(key)
+        return (name,
+                name.rsplit('/', 1)[0] + '/',
+                self.layout.key_size(key),
+                self.layout.key_last_modified(key),
+                segment_number(name))
+
+    def _insert(self, keys):
+        # Insert keys, returning the largest name inserted.
+        last = None
+        for batch in _batches(self._row(key) for key in keys):
+            self.db.executemany(
+                'INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?, ?)', batch)
+            last = max(last, max(row[0] for row in batch))
+
+        return last
+
+    def _delete_under(self, prefix):
+        self.db.execute('DELETE FROM keys WHERE name >= ? AND name < ?',
+                        (prefix, _prefix_end(prefix)))
+
+    def level(self, prefix):
+        """Return the keys directly under prefix, and the directories
+
+        Keys are (name, size, last_modified) rows.  Only the
+        directories of base backups are known.
+
+        """
+        rows = self.db.execute(
+            'SELECT name, size, last_modified FROM keys '
+            'WHERE directory = ? ORDER BY name', (prefix,)).fetchall()
+        directories = [name for name, in self.db.execute(
+            'SELECT name FROM directories WHERE parent = ? ORDER BY name',
+            (prefix,))]
+
+        return rows, directories
+
+    def keys(self, prefix):
+        """Yield the (name, size, last_modified) of keys under prefix"""
+        return self.db.execute(
+            'SELECT name, size, last_modified FROM keys '
+            'WHERE name >= ? AND name < ? ORDER BY name',
+            (prefix, _prefix_end(prefix)))
+
+    def wal_keys(self, horizon=None):
+        """Yield the keys of the WAL directory
+
+        With a horizon SegmentNumber, WAL files and backup history
+        files at or after it on their timeline are left out.
+
+        """
+        prefix = self.layout.wal_directory()
+        if horizon is None:
+            return self.keys(prefix)
+
+        return self.db.execute(
+            'SELECT name, size, last_modified FROM keys '
+            'WHERE name >= ? AND name < ? '
+            'AND (segment IS NULL OR segment < ?)',
+            (prefix, _prefix_end(prefix), horizon.as_an_integer))
+
+    def remove(self, names):
+        """Forget deleted keys"""
+        with self.db:
+            for batch in _batches((name,) for name in names):
+                self.db.executemany('DELETE FROM keys WHERE name = ?', batch)
+
+    def sync_basebackups(self, source):
+        """List the sentinels and directories of the base backups
+
+        source is a _BackupList or _DeleteFromContext listing the
+        archive.  The contents of backups that are gone are
+        forgotten.
+
+        """
+        prefix = self.layout.basebackups()
+        sentinels, directories = source._list_level(prefix)
+
+        with self.db:
+            self.db.execute('DELETE FROM keys WHERE directory = ?',
+                            (prefix,))
+            self._insert(sentinels)
+
+            known = set(name for name, in self.db.execute(
+                'SELECT name FROM directories WHERE parent = ?', (prefix,)))
+            for name in known - set(directories):
+                self.db.execute('DELETE FROM directories WHERE name = ?',
+                                (name,))
+                self._delete_under(name)
+
+            self.db.executemany(
+                'INSERT INTO directories VALUES (?, ?, 0)',
+                [(name, prefix) for name in directories
+                 if name not in known])
+
+    def sync_contents(self, source, prefix):
+        """List the incomplete backup directories under prefix
+
+        prefix may also be the directory of a backup itself.
+
+        """
+        incomplete = self.db.execute(
+            'SELECT name, parent FROM directories '
+            'WHERE complete = 0 AND name >= ? AND name < ?',
+            (prefix, _prefix_end(prefix))).fetchall()
+
+        for name, parent in incomplete:
+            # A backup is complete once its sentinel is uploaded,
+            # which is after all of its other keys.
+            sentinel = name.rstrip('/') + '_backup_stop_sentinel.json'
+            complete = self.db.execute(
+                'SELECT 1 FROM keys WHERE name = ?',
+                (sentinel,)).fetchone() is not None
+
+            keys = list(source._backup_list(prefix=name))
+            with self.db:
+                self._delete_under(name)
+                self._insert(keys)
+                self.db.execute(
+                    'UPDATE directories SET complete = ? WHERE name = ?',
+                    (int(complete), name))
+
+    def sync_wal(self, source, full=False):
+        """List the WAL files archived since the last listing
+
+        source is a _DeleteFromContext.  The whole directory is
+        listed if full is set, or when due.
+
+        """
+        prefix = self.layout.wal_directory()
+        last_key = self._get('wal_last_key')
+        reconciled_at = float(self._get('wal_reconciled_at') or 0)
+        now = time.time()
+
+        full = (full or last_key is None or not source.can_list_ranges or
+                now - reconciled_at > RECONCILE_INTERVAL)
+        # The listing is done before the transaction, which would
+        # otherwise lock others out of the catalog for its duration.
+        if full:
+            keys = list(source._remote_wal_list())
+        else:
+            keys = list(source._list_range(prefix, last_key, None))
+
+        with self.db:
+            if full:
+                self._delete_under(prefix)
+                self._set('wal_reconciled_at', repr(now))
+                last_key = None
+
+            self._set('wal_last_key', max(last_key, self._insert(keys)))
+
+    def reconcile(self, source):
+        """List the whole archive again"""
+        with self.db:
+            self.db.execute('UPDATE directories SET complete = 0')
+
+        self.sync_basebackups(source)
+        self.sync_contents(source, self.layout.basebackups())
+        self.sync_wal(source, full=True)
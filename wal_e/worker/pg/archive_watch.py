@@ -0,0 +1,250 @@
+"""Continuous archiving of segments as Postgres marks them ready
+
+Parallel wal-push finds segments to upload alongside the one it was
+asked for by listing and sorting archive_status on every invocation,
+which gets expensive exactly when archiving falls behind and .ready
+files pile up.  ArchiveWatcher lists the directory once, then follows
+new .ready files with inotify (or, where that is not available, by
+listing it again every so often), keeping the segments in a heap
+ordered by name.
+
+Segments are uploaded in the background as soon as they are ready
+and marked .done, so that Postgres never asks for most of them.  A
+segment Postgres does ask for (see archive) is uploaded once, by
+whichever of the two gets to it first.
+
+"""
+import collections
+import heapq
+import os
+import re
+import sys
+import traceback
+
+import gevent
+import gevent.event
+import gevent.pool
+
+from os import path
+
+from wal_e import inotify
+from wal_e import log_help
+from wal_e import storage
+from wal_e.worker.pg.wal_transfer import WalSegment
+
+logger = log_help.WalELogger(__name__)
+
+# Seconds between listings of archive_status without inotify.
+POLL_INTERVAL = 5
+
+# Seconds to wait before retrying a failed upload.
+RETRY_DELAY = 10
+
+# Number of archived segment names remembered, to answer requests for
+# segments that were uploaded just before Postgres asked for them.
+RECENTLY_DONE_MAX = 1024
+
+
+class ReadyQueue(object):
+    """Names of segments marked ready, earliest first, without repeats"""
+
+    def __init__(self):
+        self._heap = []
+        self._queued = set()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, name):
+        return name in self._queued
+
+    def add(self, name):
+        if name not in self._queued:
+            self._queued.add(name)
+            heapq.heappush(self._heap, name)
+
+    def pop(self):
+        name = heapq.heappop(self._heap)
+        self._queued.remove(name)
+        return name
+
+    def discard(self, name):
+        if name in self._queued:
+            self._queued.remove(name)
+            self._heap.remove(name)
+            heapq.heapify(self._heap)
+
+
+def ready_segment_name(status_name):
+    """Return the segment a status file marks ready, or None"""
+    match = re.match(storage.SEGMENT_READY_REGEXP + '$', status_name)
+    if match is None:
+        return None
+
+    return match.group('filename')
+
+
+class ArchiveWatcher(object):
+
+    def __init__(self, uploader, xlog_dir, concurrency):
+        self.uploader = uploader
+        self.xlog_dir = xlog_dir
+        self.status_dir = path.join(xlog_dir, 'archive_status')
+
+        self.queue = ReadyQueue()
+        self.pool = gevent.pool.Pool(size=concurrency)
+
+        # Segment name => Greenlet uploading it.
+        self.uploading = {}
+
+        # Segments asked for by Postgres, which also marks them done.
+        self.explicit = set()
+
+        self.recently_done = set()
+        self._recently_done_order = collections.deque()
+
+        self._wakeup = gevent.event.Event()
+
+    def run(self):
+        """Watch archive_status and upload segments, forever"""
+        gevent.spawn(self._follow).link_exception(self._follow_failed)
+
+        while True:
+            self._wakeup.clear()
+            self._start_uploads()
+            self._wakeup.wait()
+
+    def _follow(self):
+        if not inotify.available():
+            logger.info(
+                msg='inotify is not available, polling archive_status',
+                detail=('archive_status will be listed every {0} seconds.'
+                        .format(POLL_INTERVAL)))
+            return self._poll()
+
+        watch = inotify.Watch(self.status_dir,
+                              inotify.IN_CREATE | inotify.IN_MOVED_TO)
+        try:
+            # Only list the directory once the watch is in place, so
+            # that no segment is missed in between.
+            self.rescan()
+
+            while True:
+                for mask, name in watch.read():
+                    if mask & inotify.IN_Q_OVERFLOW:
+                        self.rescan()
+                    else:
+                        self._ready(name)
+        finally:
+            watch.close()
+
+    def _poll(self):
+        while True:
+            self.rescan()
+            gevent.sleep(POLL_INTERVAL)
+
+    def _follow_failed(self, g):
+        # Without following archive_status, segments would silently
+        # stop being uploaded: fall back to polling instead.
+        logger.warning(
+            msg='could not watch archive_status, polling it instead',
+            detail='The error was: {0!r}.'.format(g.exception))
+        gevent.spawn(self._poll)
+
+    def rescan(self):
+        for status_name in os.listdir(self.status_dir):
+            self._ready(status_name)
+
+    def _ready(self, status_name):
+        name = ready_segment_name(status_name)
+        if (name is not None and name not in self.uploading and
+                name not in self.recently_done):
+            self.queue.add(name)
+            self._wakeup.set()
+
+    def _start_uploads(self):
+        # As many uploads run as there are segments waiting, up to
+        # the size of the pool.
+        while self.queue and self.pool.free_count() > 0:
+            self._start(self.queue.pop(), self.pool.spawn)
+
+    def _start(self, name, spawn):
+        g = spawn(self._upload, name)
+        self.uploading[name] = g
+        g.link(lambda g: self._finished(name))
+        return g
+
+    def _finished(self, name):
+        self.uploading.pop(name, None)
+        self._wakeup.set()
+
+    def _status_path(self, name):
+        return path.join(self.status_dir, name + '.ready')
+
+    def _upload(self, name):
+        segment = WalSegment(path.join(self.xlog_dir, name))
+
+        try:
+            self.uploader(segment)
+
+            if name not in self.explicit:
+                segment.mark_done()
+        except Exception:
+            if name in self.explicit:
+                raise
+
+            if not path.exists(self._status_path(name)):
+                # Postgres has archived the segment by itself in the
+                # meantime, and may have recycled it already.
+                return
+
+            logger.warning(
+                msg='could not archive a ready segment, retrying later',
+                detail=''.join(traceback.format_exception(*sys.exc_info())))
+            gevent.spawn_later(RETRY_DELAY, self._ready, name + '.ready')
+            return
+
+        self._remember_done(name)
+
+    def _remember_done(self, name):
+        self.recently_done.add(name)
+        self._recently_done_order.append(name)
+        if len(self._recently_done_order) > RECENTLY_DONE_MAX:
+            self.recently_done.discard(self._recently_done_order.popleft())
+
+    def archive(self, wal_path):
+        """Archive a segment Postgres asked for, waiting until it is
+
+        Rather than uploading it a second time, wait for an upload of
+        the segment that is already running, and start the upload
+        right away if it is only queued.
+
+        """
+        name = path.basename(wal_path)
+
+        watched = (path.dirname(path.realpath(wal_path)) ==
+                   path.realpath(self.xlog_dir))
+        if not watched or ready_segment_name(name + '.ready') is None:
+            # Not a segment in the watched directory, e.g. a history
+            # file: upload it as usual.
+            self.uploader(WalSegment(wal_path, explicit=True))
+            return
+
+        if name in self.recently_done:
+            return
+
+        self.explicit.add(name)
+        try:
+            g = self.uploading.get(name)
+            if g is None:
+                self.queue.discard(name)
+
+                # Postgres waits on this segment, so it does not wait
+                # for a free slot in the pool.
+                g = self._start(name, gevent.spawn)
+
+            # Uploads of explicit segments raise their errors, to be
+            # reported to Postgres.
+            g.get()
+        finally:
+            self.explicit.discard(name)
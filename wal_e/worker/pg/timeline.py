@@ -0,0 +1,72 @@
+"""Follow Postgres timeline history files
+
+When a server is promoted, it starts a new timeline, and writes a
+history file, e.g. "00000002.history", listing the timelines it
+descends from and where it switched away from each:
+
+    1	0/3000090	no recovery target specified
+
+Recovery following that timeline reads the segments before the
+switch point from timeline 1, and from the segment containing the
+switch point on, from timeline 2.
+
+"""
+import re
+
+from wal_e import storage
+
+# Lines of history files: parent timeline, switch point, and a
+# reason, which is free text.
+HISTORY_LINE_REGEXP = (r'\s*(?P<tli>\d+)\s+(?P<hi>[0-9A-Fa-f]+)/'
+                       r'(?P<lo>[0-9A-Fa-f]+)')
+
+
+def lsn_segment_number(hi, lo):
+    """Return the SegmentNumber of the segment holding an LSN"""
+    return storage.SegmentNumber(log='{0:08X}'.format(hi),
+                                 seg='{0:08X}'.format(lo >> 24))
+
+
+class TimelineHistory(object):
+
+    def __init__(self, tli, switches):
+        """Describe timeline tli
+
+        switches is a list of (tli, SegmentNumber) of the ancestor
+        timelines, and the segment holding the point where each was
+        switched away from, oldest first.
+
+        """
+        self.tli = tli
+        self.switches = switches
+
+    @classmethod
+    def parse(cls, tli, text):
+        switches = []
+        for line in text.splitlines():
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+
+            match = re.match(HISTORY_LINE_REGEXP, line)
+            if match is None:
+                raise ValueError('unexpected timeline history line {0!r}'
+                                 .format(line))
+
+            switches.append(
+                (int(match.group('tli')),
+                 lsn_segment_number(int(match.group('hi'), 16),
+                                    int(match.group('lo'), 16))))
+
+        return cls(tli, switches)
+
+    def includes(self, tli):
+        """Check if tli is this timeline or one of its ancestors"""
+        return tli == self.tli or any(t == tli for t, _ in self.switches)
+
+    def tli_for(self, segment_number):
+        """Return the timeline recovery reads segment_number from"""
+        for tli, switch in self.switches:
+            if segment_number.as_an_integer < switch.as_an_integer:
+                return tli
+
+        return self.tli
@@ -15,6 +15,10 @@ class WalSegment(object):
         self.explicit = explicit
         self.name = path.basename(self.path)
 
+        # The bytes sent to the store by the last upload, or None if
+        # it was skipped.
+        self.uploaded_bytes = None
+
         # If possible, extract TLI and SegmentNumber information.
         # Cases where this is not possible include a .history file.
         self.tli = None
@@ -86,7 +90,14 @@ class WalSegment(object):
 
                 yield WalSegment(seg_path, explicit=False)
 
-    def future_segment_stream(self):
+    def future_segment_stream(self, history=None):
+        """Project the segments following this one
+
+        They are on the same timeline, unless the TimelineHistory of
+        a later timeline that descends from it is given, in which
+        case they follow it across its switch points.
+
+        """
         sn = self.segment_number
 
         if sn is None:
@@ -94,11 +105,18 @@ class WalSegment(object):
             # actually a .history file or something like that.
             return
 
+        if history is not None and not history.includes(int(self.tli, 16)):
+            history = None
+
         while True:
             sn = sn.next_larger()
+
+            tli = self.tli
+            if history is not None:
+                tli = max(tli, '{0:08X}'.format(history.tli_for(sn)))
+
             segment = self.__class__(
-                path.join(path.dirname(self.path),
-                          self.tli + sn.log + sn.seg))
+                path.join(path.dirname(self.path), tli + sn.log + sn.seg))
             yield segment
 
 
@@ -10,17 +10,56 @@ segments in advance.
 """
 
 import errno
+import itertools
+import math
 import os
 import re
 import shutil
+import sys
 import tempfile
+import time
+import traceback
+
+import gevent
 
 from os import path
 from wal_e import log_help
 from wal_e import storage
+from wal_e.pipeline import get_download_pipeline
+from wal_e.worker.pg.timeline import TimelineHistory
 
 logger = log_help.WalELogger(__name__)
 
+# Seconds a download may go without progress before it is no longer
+# waited for.
+STALL_TIMEOUT = 5
+
+# Seconds for which a listing of the archive is trusted to tell that
+# upcoming segments are not archived yet.
+INDEX_MAX_AGE = 10
+
+# Size of WAL segments as Postgres is built by default, assumed for
+# downloads in flight.
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+# Segments prefetched before anything is known about replay.
+INITIAL_WINDOW = 8
+
+# Weight of the latest observation in the smoothed interval between
+# requests and download time.
+SMOOTHING = 0.3
+
+# How many times over the window should cover the download time, to
+# absorb variation.
+HEADROOM = 2
+
+
+def smooth(average, observed):
+    if average is None:
+        return observed
+
+    return average + SMOOTHING * (observed - average)
+
 
 class AtomicDownload(object):
     """Provide a temporary file for downloading exactly one segment.
@@ -28,9 +67,10 @@ class AtomicDownload(object):
     This moves the temp file on success and does cleanup.
 
     """
-    def __init__(self, prefetch_dir, segment):
+    def __init__(self, prefetch_dir, segment, compressed=False):
         self.prefetch_dir = prefetch_dir
         self.segment = segment
+        self.compressed = compressed
         self.failed = None
 
     @property
@@ -45,7 +85,7 @@ class AtomicDownload(object):
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         try:
-            if exc_type is None:
+            if exc_type is None and not self.failed:
                 # Success.  Mark the segment as complete.
                 #
                 # In event of a crash, this os.link() without an fsync
@@ -53,8 +93,8 @@ class AtomicDownload(object):
                 # but given Postgres retries corrupt archive logs
                 # (because it itself makes no provisions to sync
                 # them), that is assumed to be acceptable.
-                os.link(self.tf.name, path.join(
-                    self.prefetch_dir.prefetched_dir, self.segment.name))
+                os.link(self.tf.name, self.prefetch_dir.complete_path(
+                    self.segment, self.compressed))
         finally:
             shutil.rmtree(self.prefetch_dir.seg_dir(self.segment))
 
@@ -78,17 +118,22 @@ class Dirs(object):
     sub-directory has directories with the in-progress WAL segment and
     a temporary file with the partial contents.
 
+    Complete segments can also be kept as they are stored, compressed
+    (and encrypted), as e.g. "000000070000EBC00000006C.lzo", and are
+    only decompressed when promoted.
+
     """
 
     def __init__(self, base):
         self.base = base
         self.prefetched_dir = path.join(base, '.wal-e', 'prefetch')
         self.running = path.join(self.prefetched_dir, 'running')
+        self.socket_path = path.join(base, '.wal-e', 'prefetch.sock')
 
     def seg_dir(self, segment):
         return path.join(self.running, segment.name)
 
-    def create(self, segment):
+    def create(self, segment=None):
         """A best-effort attempt to create directories.
 
         Warnings are issued to the user if those directories could not
@@ -125,7 +170,8 @@ class Dirs(object):
         for d in [self.prefetched_dir, self.running]:
             ok &= lackadaisical_mkdir(d)
 
-        lackadaisical_mkdir(self.seg_dir(segment))
+        if segment is not None:
+            lackadaisical_mkdir(self.seg_dir(segment))
 
     def clear(self):
         def warn_on_cant_remove(function, path, excinfo):
@@ -140,11 +186,28 @@ class Dirs(object):
         shutil.rmtree(self.prefetched_dir, False, warn_on_cant_remove)
 
     def clear_except(self, retained_segments):
+        """Remove segments that are neither retained nor still ahead
+
+        Segments sorting after all retained segments are kept: they
+        can only have been fetched in anticipation of being needed
+        later, e.g. by backup-fetch.  With no retained segments,
+        everything is removed.
+
+        """
         sn = set(s.name for s in retained_segments)
+        horizon = max(sn) if sn else None
+
+        def stale(n):
+            match = re.match(storage.SEGMENT_REGEXP, n)
+            if match is None:
+                return False
+
+            n = match.group('filename')
+            return n not in sn and (horizon is None or n < horizon)
 
         try:
             for n in os.listdir(self.running):
-                if n not in sn and re.match(storage.SEGMENT_REGEXP, n):
+                if stale(n):
                     try:
                         shutil.rmtree(path.join(self.running, n))
                     except EnvironmentError as e:
@@ -156,7 +219,7 @@ class Dirs(object):
 
         try:
             for n in os.listdir(self.prefetched_dir):
-                if n not in sn and re.match(storage.SEGMENT_REGEXP, n):
+                if stale(n):
                     try:
                         os.remove(path.join(self.prefetched_dir, n))
                     except EnvironmentError as e:
@@ -166,8 +229,16 @@ class Dirs(object):
             if e.errno != errno.ENOENT:
                 raise
 
+    def complete_path(self, segment, compressed=False):
+        name = segment.name
+        if compressed:
+            name += '.lzo'
+
+        return path.join(self.prefetched_dir, name)
+
     def contains(self, segment):
-        return path.isfile(path.join(self.prefetched_dir, segment.name))
+        return (path.isfile(self.complete_path(segment)) or
+                path.isfile(self.complete_path(segment, compressed=True)))
 
     def is_running(self, segment):
         return path.isdir(self.seg_dir(segment))
@@ -186,9 +257,327 @@ class Dirs(object):
 
             raise
 
-    def promote(self, segment, destination):
-        source = path.join(self.prefetched_dir, segment.name)
-        os.rename(source, destination)
+    def promote(self, segment, destination, decrypt=False):
+        """Move a prefetched segment to destination
+
+        Return whether it was.  Segments kept as they are stored are
+        decompressed, and decrypted, into place first.  Should that
+        fail, the prefetched segment is removed, so that it is
+        downloaded again instead.
+
+        """
+        source = self.complete_path(segment)
+        if path.isfile(source):
+            os.rename(source, destination)
+            return True
+
+        source = self.complete_path(segment, compressed=True)
+        tf = tempfile.NamedTemporaryFile(dir=path.dirname(destination),
+                                         delete=False)
+        try:
+            with open(source, 'rb') as compressed:
+                with tf:
+                    with get_download_pipeline(compressed, tf, decrypt):
+                        pass
+
+            os.rename(tf.name, destination)
+        except Exception:
+            logger.warning(
+                msg='could not decompress prefetched wal segment',
+                detail=''.join(traceback.format_exception(*sys.exc_info())),
+                hint='The segment is downloaded again instead.')
+
+            for p in (tf.name, source):
+                try:
+                    os.unlink(p)
+                except EnvironmentError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+            return False
+
+        os.unlink(source)
+        return True
+
+    def download(self, segment, compressed=False):
+        return AtomicDownload(self, segment, compressed=compressed)
+
+    def _complete_segments(self):
+        """Return (name, path, stat) of the complete segments"""
+        try:
+            names = os.listdir(self.prefetched_dir)
+        except EnvironmentError as e:
+            if e.errno == errno.ENOENT:
+                return []
+
+            raise
+
+        segments = []
+        for n in names:
+            match = re.match(storage.SEGMENT_REGEXP, n)
+            if match is None:
+                continue
+
+            p = path.join(self.prefetched_dir, n)
+            try:
+                segments.append((match.group('filename'), p, os.stat(p)))
+            except EnvironmentError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        return segments
+
+    def complete_size(self):
+        """Return the bytes taken by complete segments"""
+        return sum(st.st_size for _, _, st in self._complete_segments())
+
+    def evict(self, budget, position):
+        """Remove complete segments until they fit in budget bytes
+
+        Segments preceding the replay position go first, least
+        recently prefetched first, then segments furthest ahead of
+        it.
+
+        """
+        segments = self._complete_segments()
+        used = sum(st.st_size for _, _, st in segments)
+
+        behind = sorted((entry for entry in segments
+                         if entry[0] < position.name),
+                        key=lambda entry: entry[2].st_mtime)
+        ahead = sorted(((name, p, st) for name, p, st in segments
+                        if name >= position.name),
+                       key=lambda entry: entry[:2], reverse=True)
+
+        for name, p, st in behind + ahead:
+            if used <= budget:
+                break
+
+            try:
+                os.remove(p)
+            except EnvironmentError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+            used -= st.st_size
+            logger.info(
+                msg='evicted prefetched segment',
+                detail=('Segment {0} was removed to keep prefetched '
+                        'segments within {1} bytes.'.format(name, budget)))
+
+    def transfer(self, other):
+        """Move all completed segments into another Dirs, then clear"""
+        try:
+            names = os.listdir(self.prefetched_dir)
+        except EnvironmentError as e:
+            if e.errno == errno.ENOENT:
+                return
+
+            raise
+
+        moved = [n for n in names if re.match(storage.SEGMENT_REGEXP, n)]
+        if moved:
+            other.create()
+            for n in moved:
+                shutil.move(path.join(self.prefetched_dir, n),
+                            path.join(other.prefetched_dir, n))
+
+        self.clear()
+
+
+class Prefetcher(object):
+    """Keep a window of upcoming segments downloading in greenlets
+
+    Downloads are done by calling fetch with the base directory, a
+    segment name and whether to keep it compressed, into the same
+    directories as used by separate wal-prefetch processes.  Segments
+    beyond the last one archived are not tried when an index of the
+    archive is given.
+
+    History files Postgres asks for are downloaded too, and followed:
+    upcoming segments are projected across the switch points of the
+    latest timeline that descends from the one being replayed.
+
+    With a budget, downloads are only started while the complete
+    segments, plus a full segment for each download in flight, fit
+    in it.
+
+    """
+
+    def __init__(self, fetch, base, max_window, index=None, budget=None,
+                 compressed=False):
+        self.fetch = fetch
+        self.pd = Dirs(base)
+        self.max_window = max_window
+        self.window = min(max_window, INITIAL_WINDOW)
+        self.compressed = compressed
+
+        # TimelineHistory of the latest timeline whose history file
+        # was asked for.
+        self.history = None
+
+        # A WalIndex, to skip segments that are not archived (yet).
+        self.index = index
+
+        # Bytes prefetched segments may take, if limited.
+        self.budget = budget
+
+        # Smoothed seconds between requests, i.e. replay time per
+        # segment, and seconds to download a segment.
+        self.interval = None
+        self.download_time = None
+        self.last_request = None
+
+        # Segment name => Greenlet downloading it.
+        self.downloads = {}
+
+    def advance(self, segment):
+        """Download the window of segments following segment
+
+        Prefetched segments that precede segment are removed: replay
+        has gone past them.
+
+        """
+        if segment.segment_number is None:
+            self._fetch_history(segment)
+            return []
+
+        now = time.time()
+        if self.last_request is not None:
+            self.interval = smooth(self.interval, now - self.last_request)
+        self.last_request = now
+
+        self.resize(starved=segment.name in self.downloads)
+
+        future = list(itertools.islice(
+            segment.future_segment_stream(history=self.history),
+            self.window))
+        self.pd.clear_except([segment] + future)
+
+        for fs in future:
+            if fs.name in self.downloads or self.pd.contains(fs):
+                continue
+
+            if self.index is not None and self.index.missing(
+                    fs.name, INDEX_MAX_AGE):
+                continue
+
+            if not self._within_budget(len(self.downloads) + 1):
+                # Later segments are further ahead, hence less useful.
+                break
+
+            self.pd.create(fs)
+            self.downloads[fs.name] = gevent.spawn(
+                self._download, fs.name, self.compressed)
+
+        if self.budget is not None:
+            self.pd.evict(
+                self.budget - len(self.downloads) * SEGMENT_SIZE, segment)
+
+        return future
+
+    def _fetch_history(self, segment):
+        """Download a history file Postgres is about to ask for"""
+        if (not re.match(storage.HISTORY_REGEXP, segment.name) or
+                segment.name in self.downloads or
+                self.pd.contains(segment)):
+            return
+
+        if self.index is not None and self.index.missing(segment.name,
+                                                         INDEX_MAX_AGE):
+            return
+
+        # History files are kept decompressed, to be read.
+        self.pd.create(segment)
+        self.downloads[segment.name] = gevent.spawn(
+            self._download, segment.name, False)
+
+    def _follow_history(self, segment_name):
+        tli = int(segment_name[:8], 16)
+        if self.history is not None and self.history.tli >= tli:
+            return
+
+        with open(path.join(self.pd.prefetched_dir, segment_name)) as f:
+            self.history = TimelineHistory.parse(tli, f.read())
+
+        logger.info(
+            msg='prefetching along a new timeline',
+            detail=('Segments are projected along timeline {0}, which '
+                    'switched away from timelines {1}.'
+                    .format(tli, ', '.join(str(t) for t, _ in
+                                           self.history.switches))))
+
+    def _within_budget(self, downloads):
+        if self.budget is None:
+            return True
+
+        return (self.pd.complete_size() + downloads * SEGMENT_SIZE <=
+                self.budget)
+
+    def resize(self, starved):
+        """Size the window so that downloads keep ahead of replay
+
+        A segment requested w segments ahead is needed about w
+        intervals later, so the window has to span the download time.
+        It grows regardless when replay is starved, i.e. asks for a
+        segment that is still downloading, and never exceeds
+        max_window, which bounds the disk used.
+
+        """
+        target = self.window
+        if self.interval is not None and self.download_time is not None:
+            target = int(math.ceil(HEADROOM * self.download_time /
+                                   max(self.interval, 0.001)))
+
+        if starved:
+            target = max(target, self.window + 1)
+
+        self.window = max(1, min(self.max_window, target))
+
+    def wait(self, segment):
+        """Wait for segment, if it is downloading, and check for it
+
+        A download that stops making progress is not waited for.
+
+        """
+        last_size = -1
+        while True:
+            g = self.downloads.get(segment.name)
+            if g is None:
+                break
+
+            g.join(timeout=STALL_TIMEOUT)
+            if g.ready():
+                break
+
+            size = self.pd.running_size(segment)
+            if size <= last_size:
+                break
+
+            last_size = size
+
+        return self.pd.contains(segment)
+
+    def _download(self, segment_name, compressed):
+        start = time.time()
+        try:
+            if not self.fetch(self.pd.base, segment_name,
+                              compressed=compressed):
+                return
+
+            if re.match(storage.HISTORY_REGEXP, segment_name):
+                self._follow_history(segment_name)
+            else:
+                self.download_time = smooth(self.download_time,
+                                            time.time() - start)
+        except Exception:
+            # Prefetching is only an optimization: wal-fetch downloads
+            # the segment itself if it is missing.
+            logger.warning(
+                msg='could not prefetch a segment',
+                detail=''.join(traceback.format_exception(*sys.exc_info())))
+        finally:
+            self.downloads.pop(segment_name, None)
 
-    def download(self, segment):
-        return AtomicDownload(self, segment)
+    def stop(self):
+        gevent.killall(self.downloads.values(), block=True, timeout=60)
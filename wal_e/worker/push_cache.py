@@ -0,0 +1,179 @@
+"""Keep the compressed form of recently pushed WAL segments
+
+When wal-push fails after its upload went through, for instance while
+marking parallel uploads .done or because the response to the upload
+was lost, Postgres runs it again for the same segment.  Compressing
+and uploading the segment again is wasted work, and gets in the way
+exactly when archiving is struggling.
+
+Compressed segments are therefore written to a ".wal-e/push"
+directory next to the segments, rather than to an anonymous temporary
+file, along with what they were made from:
+
+.wal-e
+    push
+        000000070000EBC00000006C.json
+        000000070000EBC00000006C.lzo
+
+When the same segment (by name, size and modification time) is pushed
+again with the same options, its compressed form is reused, and the
+upload is skipped entirely if the store already has an object of the
+same size and digest.  Compressed output is not reproducible (gpg in
+particular is randomized), which is why it has to be kept.
+
+"""
+import contextlib
+import errno
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from os import path
+
+# Compressed segments kept, by name: comfortably more than the
+# segments a parallel wal-push uploads at once.
+MAX_ENTRIES = 32
+
+# Seconds after which files that are not part of an entry are removed.
+STALE_AGE = 60 * 60
+
+
+class _DigestingWriter(object):
+    """Write to a file, keeping track of the size and MD5 written"""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.size = 0
+        self.digest = hashlib.md5()
+
+    def write(self, data):
+        self.fp.write(data)
+        self.size += len(data)
+        self.digest.update(data)
+
+    def flush(self):
+        self.fp.flush()
+
+
+class PushCache(object):
+
+    def __init__(self, xlog_dir):
+        self.push_dir = path.join(xlog_dir, '.wal-e', 'push')
+
+    def _data_path(self, name):
+        return path.join(self.push_dir, name + '.lzo')
+
+    def _meta_path(self, name):
+        return path.join(self.push_dir, name + '.json')
+
+    @staticmethod
+    def fingerprint(seg_path, **options):
+        """Describe a segment file and the options to compress it"""
+        st = os.stat(seg_path)
+        return dict(options, size=st.st_size, mtime=st.st_mtime)
+
+    def lookup(self, name, fingerprint):
+        """Return the cache entry for a segment, if still current
+
+        The entry is a dictionary with the path, size and MD5 digest
+        of the compressed segment.
+
+        """
+        try:
+            with open(self._meta_path(name)) as f:
+                meta = json.load(f)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        except ValueError:
+            return None
+
+        if (meta.get('fingerprint') != fingerprint or
+                not path.exists(self._data_path(name))):
+            return None
+
+        return {'path': self._data_path(name),
+                'size': meta['size'],
+                'md5': meta['md5']}
+
+    @contextlib.contextmanager
+    def writing(self, name, fingerprint):
+        """Make a cache entry of what is written in a with block
+
+        The entry only comes into existence if the block completes:
+        the compressed segment is moved into place before the
+        description of it.
+
+        """
+        try:
+            os.makedirs(self.push_dir)
+        except EnvironmentError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self.discard(name)
+
+        with tempfile.NamedTemporaryFile(dir=self.push_dir,
+                                         delete=False) as tf:
+            writer = _DigestingWriter(tf)
+            try:
+                yield writer
+            except:
+                os.unlink(tf.name)
+                raise
+
+        meta = {'fingerprint': fingerprint,
+                'size': writer.size,
+                'md5': writer.digest.hexdigest()}
+
+        os.rename(tf.name, self._data_path(name))
+        with tempfile.NamedTemporaryFile(dir=self.push_dir,
+                                         delete=False) as tf:
+            json.dump(meta, tf)
+        os.rename(tf.name, self._meta_path(name))
+
+        self.prune()
+
+    def discard(self, name):
+        for p in (self._meta_path(name), self._data_path(name)):
+            try:
+                os.unlink(p)
+            except EnvironmentError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def prune(self, keep=MAX_ENTRIES):
+        """Remove all but the latest segments, and leftover files"""
+        names = sorted(path.splitext(entry)[0]
+                       for entry in os.listdir(self.push_dir)
+                       if entry.endswith('.json'))
+
+        for name in names[:-keep]:
+            self.discard(name)
+
+        # Temporary files and compressed segments without a
+        # description are left behind by crashes, unless they are
+        # still being written.
+        kept = set(names[-keep:])
+        for entry in os.listdir(self.push_dir):
+            if path.splitext(entry)[0] in kept:
+                continue
+
+            entry_path = path.join(self.push_dir, entry)
+            try:
+                if time.time() - path.getmtime(entry_path) > STALE_AGE:
+                    os.unlink(entry_path)
+            except EnvironmentError as e:
+                # Another wal-push may have removed it first.
+                if e.errno != errno.ENOENT:
+                    raise
+
+    @staticmethod
+    def intact(entry, blob_stat):
+        """Check that a stored object matches a cache entry"""
+        return (blob_stat is not None and
+                blob_stat.size == entry['size'] and
+                blob_stat.md5 in (None, entry['md5']))
@@ -0,0 +1,179 @@
+"""Choose how many segments wal-push uploads at once
+
+A fixed --pool-size is too high when archiving is caught up and too
+low when a burst of WAL arrives.  With --adaptive-pool-size, wal-push
+instead keeps a concurrency limit between invocations, in
+".wal-e/push-concurrency.json" next to the segments, and adjusts it
+after every invocation, much like TCP congestion control:
+
+* The limit grows by one when it held back uploads (there were more
+  segments ready than the limit) and uploads went as fast as before.
+
+* It shrinks by one when uploads running side by side became much
+  slower than uploads usually are, which means the link is saturated.
+
+* It is halved when an upload fails or the store asks to slow down.
+
+The number of uploads started is the smaller of the limit and the
+number of segments ready, and always within the bounds given by the
+user.
+
+"""
+import errno
+import json
+import os
+import tempfile
+import time
+
+from os import path
+from wal_e import log_help
+
+logger = log_help.WalELogger(__name__)
+
+# Uploads slower than this fraction of the usual upload rate mean the
+# link is saturated.
+SATURATION_RATIO = 0.5
+
+# How quickly the usual upload rate forgets a fast upload, per
+# invocation.
+RATE_DECAY = 0.95
+
+# HTTP statuses used by the stores to ask clients to slow down.
+THROTTLING_STATUSES = frozenset([429, 498, 503])
+
+
+def is_throttling(exc):
+    """Check if an exception is the store asking to slow down"""
+    status = getattr(exc, 'status', None) or getattr(exc, 'http_status', None)
+    return (status in THROTTLING_STATUSES or
+            getattr(exc, 'error_code', None) == 'SlowDown')
+
+
+class AdaptiveConcurrency(object):
+
+    def __init__(self, xlog_dir, min_size, max_size):
+        assert 1 <= min_size <= max_size
+        self.state_path = path.join(xlog_dir, '.wal-e',
+                                    'push-concurrency.json')
+        self.min_size = min_size
+        self.max_size = max_size
+
+        # Until anything is known, behave like a fixed pool size.
+        self.limit = max_size
+        self.usual_rate = None
+
+        # Set by concurrency(), for update().
+        self.backlog = 0
+        self.started = 0
+
+        self.rates = []
+        self.failures = 0
+        self.throttled = 0
+
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            self.limit = int(state['limit'])
+            self.usual_rate = state['usual_upload_rate']
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except (ValueError, KeyError, TypeError):
+            # Start over from a damaged state file.
+            pass
+
+        self.limit = self._clamp(self.limit)
+
+    def _clamp(self, n):
+        return max(self.min_size, min(self.max_size, n))
+
+    def concurrency(self, backlog):
+        """Return how many uploads to run for backlog ready segments"""
+        self.backlog = backlog
+        self.started = max(1, min(self.limit, backlog))
+        return self.started
+
+    def measure(self, transferer):
+        """Wrap a transferer to record how each transfer went
+
+        Only the bytes actually uploaded count: segments found
+        already archived upload nothing, and would otherwise make
+        uploads seem faster than they are.
+
+        """
+        def measured(segment):
+            start = time.time()
+            try:
+                result = transferer(segment)
+            except Exception as e:
+                self.record_failure(e)
+                raise
+
+            if segment.uploaded_bytes:
+                self.record(segment.uploaded_bytes, time.time() - start)
+
+            return result
+
+        return measured
+
+    def record(self, nbytes, seconds):
+        """Record an upload that succeeded"""
+        if seconds > 0:
+            self.rates.append(nbytes / float(seconds))
+
+    def record_failure(self, exc):
+        if is_throttling(exc):
+            self.throttled += 1
+        else:
+            self.failures += 1
+
+    def update(self):
+        """Adjust the limit to what was recorded, and save it"""
+        old_limit = self.limit
+
+        rate = None
+        if self.rates:
+            rate = sum(self.rates) / len(self.rates)
+
+        if self.failures or self.throttled:
+            self.limit = self._clamp(self.limit // 2)
+        elif rate is not None and self.usual_rate is not None and (
+                rate < SATURATION_RATIO * self.usual_rate):
+            self.limit = self._clamp(self.limit - 1)
+        elif self.backlog > self.started:
+            self.limit = self._clamp(self.limit + 1)
+
+        # The usual rate follows increases immediately, and decays
+        # slowly, so that it tracks the rate of uncontended uploads.
+        if rate is not None:
+            if self.usual_rate is None:
+                self.usual_rate = rate
+            else:
+                self.usual_rate = max(rate, self.usual_rate * RATE_DECAY)
+
+        if self.limit != old_limit:
+            logger.info(
+                msg='adjusted wal-push concurrency',
+                detail=('The limit went from {0} to {1} after {2} uploads '
+                        'with {3} failed and {4} throttled, and {5} segments '
+                        'ready.'.format(old_limit, self.limit,
+                                        len(self.rates), self.failures,
+                                        self.throttled, self.backlog)))
+
+        self._save()
+
+    def _save(self):
+        state_dir = path.dirname(self.state_path)
+        try:
+            os.makedirs(state_dir)
+        except EnvironmentError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        with tempfile.NamedTemporaryFile(dir=state_dir, delete=False) as tf:
+            json.dump({'limit': self.limit,
+                       'usual_upload_rate': self.usual_rate}, tf)
+        os.rename(tf.name, self.state_path)
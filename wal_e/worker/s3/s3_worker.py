@@ -6,8 +6,12 @@ with the intention that they are used in gevent greenlets.
 
 """
 import gevent
+import itertools
 import re
 
+from boto.s3.key import Key
+from boto.s3.prefix import Prefix
+
 from wal_e import log_help
 from wal_e import storage
 from wal_e.blobstore import s3
@@ -26,6 +30,29 @@ def get_bucket(conn, name):
     return conn.get_bucket(name, validate=False)
 
 
+def _list_level(conn, layout, prefix):
+    # Return the keys directly under prefix, and the names of the
+    # directories under it, without listing their contents.
+    bucket = get_bucket(conn, layout.store_name())
+    keys = []
+    directories = []
+    for item in s3.list_keys(bucket, prefix, delimiter='/'):
+        if isinstance(item, Prefix):
+            directories.append(item.name)
+        else:
+            keys.append(item)
+
+    return keys, directories
+
+
+def _make_key(conn, layout, name, size, last_modified):
+    # Build a key as listed, from a row of the catalog.
+    key = Key(get_bucket(conn, layout.store_name()), name)
+    key.size = size
+    key.last_modified = last_modified
+    return key
+
+
 class TarPartitionLister(object):
     def __init__(self, s3_conn, layout, backup_info):
         self.s3_conn = s3_conn
@@ -37,7 +64,7 @@ class TarPartitionLister(object):
             self.backup_info)
 
         bucket = get_bucket(self.s3_conn, self.layout.store_name())
-        for key in bucket.list(prefix=prefix):
+        for key in s3.list_keys(bucket, prefix):
             url = 's3://{bucket}/{name}'.format(bucket=key.bucket.name,
                                                 name=key.name)
             key_last_part = key.name.rsplit('/', 1)[-1]
@@ -53,13 +80,16 @@ class TarPartitionLister(object):
 
 
 class BackupFetcher(object):
-    def __init__(self, s3_conn, layout, backup_info, local_root, decrypt):
+    def __init__(self, s3_conn, layout, backup_info, local_root, decrypt,
+                 delta=None, selective=None):
         self.s3_conn = s3_conn
         self.layout = layout
         self.local_root = local_root
         self.backup_info = backup_info
         self.bucket = get_bucket(self.s3_conn, self.layout.store_name())
         self.decrypt = decrypt
+        self.delta = delta
+        self.selective = selective
 
     @retry()
     def fetch_partition(self, partition_name):
@@ -75,7 +105,9 @@ class BackupFetcher(object):
         key = self.bucket.get_key(part_abs_name)
         with get_download_pipeline(PIPE, PIPE, self.decrypt) as pl:
             g = gevent.spawn(s3.write_and_return_error, key, pl.stdin)
-            TarPartition.tarfile_extract(pl.stdout, self.local_root)
+            TarPartition.tarfile_extract(pl.stdout, self.local_root,
+                                         delta=self.delta,
+                                         selective=self.selective)
 
             # Raise any exceptions guarded by write_and_return_error.
             exc = g.get()
@@ -90,16 +122,28 @@ class BackupList(_BackupList):
 
     def _backup_list(self, prefix):
         bucket = get_bucket(self.conn, self.layout.store_name())
-        return bucket.list(prefix=prefix)
+        return s3.list_keys(bucket, prefix)
+
+    def _list_level(self, prefix):
+        return _list_level(self.conn, self.layout, prefix)
+
+    def _make_key(self, name, size, last_modified):
+        return _make_key(self.conn, self.layout, name, size, last_modified)
 
 
 class DeleteFromContext(_DeleteFromContext):
 
-    def __init__(self, s3_conn, layout, dry_run):
-        super(DeleteFromContext, self).__init__(s3_conn, layout, dry_run)
+    can_list_ranges = True
+
+    def __init__(self, s3_conn, layout, dry_run, pool_size=1,
+                 catalog=None, index=None):
+        super(DeleteFromContext, self).__init__(s3_conn, layout, dry_run,
+                                                pool_size=pool_size,
+                                                catalog=catalog,
+                                                index=index)
 
         if not dry_run:
-            self.deleter = Deleter()
+            self.deleter = Deleter(concurrency=pool_size)
         else:
             self.deleter = None
 
@@ -108,4 +152,22 @@ class DeleteFromContext(_DeleteFromContext):
 
     def _backup_list(self, prefix):
         bucket = get_bucket(self.conn, self.layout.store_name())
-        return bucket.list(prefix=prefix)
+        return s3.list_keys(bucket, prefix)
+
+    def _list_level(self, prefix):
+        return _list_level(self.conn, self.layout, prefix)
+
+    def _make_key(self, name, size, last_modified):
+        return _make_key(self.conn, self.layout, name, size, last_modified)
+
+    def _probe(self, prefix):
+        bucket = get_bucket(self.conn, self.layout.store_name())
+        return len(bucket.get_all_keys(prefix=prefix, max_keys=1)) > 0
+
+    def _list_range(self, prefix, start_after, end_before):
+        bucket = get_bucket(self.conn, self.layout.store_name())
+        keys = s3.list_keys(bucket, prefix, marker=start_after)
+        if end_before is None:
+            return keys
+
+        return itertools.takewhile(lambda key: key.name < end_before, keys)
@@ -0,0 +1,153 @@
+"""List directories of many WAL files with concurrent requests
+
+Listing a WAL directory page by page takes one request per thousand
+keys, one after the other, which adds up to tens of minutes for
+archives of millions of segments.  WAL file names start with the
+timeline and log number as fixed-width hexadecimal digits, e.g.
+
+    000000010000002D000000A6.lzo
+    00000002.history
+
+so the directory can instead be split into ranges of names, listed at
+the same time.  Where to split is found by checking which
+hexadecimal prefixes have any keys at all, one digit more at a time
+and all prefixes of a digit at once: always down to timelines, and
+then into the log number until there are enough ranges to keep every
+worker busy.
+
+Ranges start at these prefixes and end at the next one, so that
+every key is listed, whatever its name.  When only WAL files before
+a segment are wanted, the ranges of each timeline end at that
+segment, and the rest is not listed at all.
+
+"""
+import sys
+
+import gevent
+import gevent.pool
+
+from gevent import queue
+
+# Hexadecimal digits as used in WAL file names.
+HEX_DIGITS = '0123456789ABCDEF'
+
+# Number of digits of the timeline, at the start of WAL file names.
+TLI_DIGITS = 8
+
+# Prefixes are never longer than the timeline and all but the last
+# digit of the log number, i.e. ranges are at least 16 logs wide.
+MAX_PREFIX_DIGITS = TLI_DIGITS + 7
+
+# Ranges per worker, so that workers done with short ranges can go on
+# with others.
+RANGES_PER_WORKER = 4
+
+# Prefixes checked at once.
+PROBE_CONCURRENCY = 16
+
+# Keys listed ahead of the caller.
+QUEUE_SIZE = 10000
+
+
+def _above_horizon(name, horizon):
+    # Whether all WAL files starting with name are at or after the
+    # horizon segment on their timeline.
+    if horizon is None or len(name) <= TLI_DIGITS:
+        return False
+
+    cut = horizon.log + horizon.seg
+    return name[TLI_DIGITS:] > cut[:len(name) - TLI_DIGITS]
+
+
+def range_starts(probe, prefix, ranges, horizon=None):
+    """Find the names after prefix to start ranges at
+
+    probe is called with a prefix, and returns whether any key starts
+    with it.  Prefixes of WAL files at or after the horizon
+    SegmentNumber on their timeline are not looked into.
+
+    """
+    frontier = ['']
+    pool = gevent.pool.Pool(PROBE_CONCURRENCY)
+
+    while frontier and len(frontier[0]) < MAX_PREFIX_DIGITS and (
+            len(frontier[0]) < TLI_DIGITS or len(frontier) < ranges):
+        children = [name + digit
+                    for name in frontier
+                    for digit in HEX_DIGITS
+                    if not _above_horizon(name + digit, horizon)]
+        found = pool.map(lambda name: probe(prefix + name), children)
+        frontier = [name for name, f in zip(children, found) if f]
+
+    return frontier
+
+
+def split_ranges(starts, horizon=None):
+    """Return (start, end) of the ranges, None being unbounded
+
+    Ranges of a timeline ending at the horizon SegmentNumber, and
+    what is after it up to the next range start, are left out.
+
+    """
+    bounds = set(starts)
+    if horizon is not None:
+        cut = horizon.log + horizon.seg
+        bounds.update(s[:TLI_DIGITS] + cut for s in starts)
+
+    bounds = sorted(bounds)
+    ranges = zip([None] + bounds, bounds + [None])
+
+    if horizon is not None:
+        ranges = [(start, end) for start, end in ranges
+                  if start is None or start[TLI_DIGITS:] < cut]
+
+    return ranges
+
+
+def list_sharded(probe, list_range, prefix, concurrency, horizon=None):
+    """Yield the keys under prefix, listing ranges concurrently
+
+    list_range is called with the prefix, and the key to list after
+    and the key to list up to (exclusive), either of which may be
+    None, and returns an iterable of keys.  Keys are yielded as
+    listed, not in order.
+
+    """
+    starts = range_starts(probe, prefix, concurrency * RANGES_PER_WORKER,
+                          horizon=horizon)
+
+    keys = queue.Queue(QUEUE_SIZE)
+    done = object()
+    failed = []
+    pool = gevent.pool.Pool(concurrency)
+
+    def list_one(start, end):
+        for key in list_range(prefix,
+                              start and prefix + start,
+                              end and prefix + end):
+            keys.put(key)
+
+    def feed():
+        try:
+            listers = [pool.spawn(list_one, start, end)
+                       for start, end in split_ranges(starts, horizon)]
+            gevent.joinall(listers, raise_error=True)
+        except Exception:
+            failed.append(sys.exc_info())
+
+        keys.put(done)
+
+    feeder = gevent.spawn(feed)
+    try:
+        while True:
+            key = keys.get()
+            if key is done:
+                break
+
+            yield key
+
+        if failed:
+            raise failed[0][0], failed[0][1], failed[0][2]
+    finally:
+        feeder.kill()
+        pool.kill()
@@ -1,25 +1,101 @@
+import inspect
+import json
+import urllib
+
+from gevent import queue
 from swiftclient.exceptions import ClientException
 
+from wal_e import exception
 from wal_e import retries
+from wal_e.blobstore import swift
 from wal_e.worker.base import _Deleter
 
 
+def _client_supports_bulk_delete(conn):
+    # Asking for the capabilities of the cluster, and posting a body to
+    # the account, both need a more recent client than the oldest one
+    # supported.
+    if not hasattr(conn, 'get_capabilities'):
+        return False
+
+    args = inspect.getargspec(conn.post_account).args
+    return 'query_string' in args and 'data' in args
+
+
 class Deleter(_Deleter):
-    def __init__(self, swift_conn, container):
-        super(Deleter, self).__init__()
+    def __init__(self, swift_conn, container, concurrency=1):
+        super(Deleter, self).__init__(concurrency=concurrency)
         self.swift_conn = swift_conn
         self.container = container
 
-    @retries.retry()
+        # Workers delete pages at the same time, so each takes a
+        # connection of its own.
+        self._conns = queue.Queue()
+        for i in xrange(concurrency):
+            self._conns.put(swift.clone_connection(swift_conn))
+
+        # Whether the cluster runs the bulk-delete middleware, found
+        # out on the first page.
+        self.bulk_delete = None
+
+    def _supports_bulk_delete(self, conn):
+        if self.bulk_delete is None:
+            capabilities = {}
+            if _client_supports_bulk_delete(conn):
+                try:
+                    capabilities = conn.get_capabilities()
+                except ClientException:
+                    # Clusters that do not publish their capabilities
+                    # are unlikely to run the middleware either.
+                    pass
+
+            self.bulk_delete = 'bulk_delete' in capabilities
+
+        return self.bulk_delete
+
     def _delete_batch(self, page):
-        # swiftclient doesn't expose mass-delete yet (the raw API supports it
-        # when a particular middleware is installed), so we delete one at a
-        # time.
+        conn = self._conns.get()
+        try:
+            self._delete_batch_over(conn, page)
+        finally:
+            self._conns.put(conn)
+
+    @retries.retry()
+    def _delete_batch_over(self, conn, page):
+        if self._supports_bulk_delete(conn):
+            self._bulk_delete(conn, page)
+            return
+
+        # Without the bulk-delete middleware, we delete one at a time.
         for blob in page:
             try:
-                self.swift_conn.delete_object(self.container, blob.name)
+                conn.delete_object(self.container, blob.name)
             except ClientException as e:
                 # Swallow HTTP 404's they indicate the file doesn't exist, and
                 # that's fine, we were just going to delete it anyways
                 if e.http_status != 404:
                     raise
+
+    def _bulk_delete(self, conn, page):
+        names = []
+        for blob in page:
+            name = u'{0}/{1}'.format(self.container, blob.name)
+            names.append(urllib.quote(name.encode('utf-8')))
+
+        _, body = conn.post_account(
+            headers={'Accept': 'application/json',
+                     'Content-Type': 'text/plain'},
+            query_string='bulk-delete',
+            data='\n'.join(names))
+
+        # The middleware answers 200 OK as soon as it starts, and
+        # reports the outcome in the body.  Objects that were not
+        # found do not count as errors.
+        result = json.loads(body)
+        if (result.get('Errors') or
+                not result.get('Response Status', '').startswith('2')):
+            raise exception.UserException(
+                msg='could not delete some objects',
+                detail=('The bulk delete reported {0}: {1!r}.'
+                        .format(result.get('Response Status'),
+                                result['Errors'][:10])))
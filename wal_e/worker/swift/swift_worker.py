@@ -17,6 +17,27 @@ from wal_e.worker.swift.swift_deleter import Deleter
 logger = log_help.WalELogger(__name__)
 
 
+def _list_level(conn, layout, prefix):
+    # Return the objects directly under prefix, and the names of the
+    # directories under it, without listing their contents.
+    keys = []
+    directories = []
+    for obj in swift.list_objects(conn, layout.store_name(), '/' + prefix,
+                                  delimiter='/'):
+        if 'subdir' in obj:
+            directories.append(obj['subdir'].lstrip('/'))
+        else:
+            keys.append(swift.SwiftKey(obj['name'], obj['bytes'],
+                                       obj['last_modified']))
+
+    return keys, directories
+
+
+def _make_key(conn, layout, name, size, last_modified):
+    # Build an object as listed, from a row of the catalog.
+    return swift.SwiftKey('/' + name, size, last_modified)
+
+
 class TarPartitionLister(object):
     def __init__(self, swift_conn, layout, backup_info):
         self.swift_conn = swift_conn
@@ -27,10 +48,8 @@ class TarPartitionLister(object):
         prefix = self.layout.basebackup_tar_partition_directory(
             self.backup_info)
 
-        _, object_list = self.swift_conn.get_container(
-            self.layout.store_name(), prefix='/' + prefix
-        )
-        for obj in object_list:
+        for obj in swift.list_objects(self.swift_conn,
+                                      self.layout.store_name(), '/' + prefix):
             url = 'swift://{container}/{name}'.format(
                 container=self.layout.store_name(), name=obj['name'])
             name_last_part = obj['name'].rsplit('/', 1)[-1]
@@ -46,12 +65,15 @@ class TarPartitionLister(object):
 
 
 class BackupFetcher(object):
-    def __init__(self, swift_conn, layout, backup_info, local_root, decrypt):
+    def __init__(self, swift_conn, layout, backup_info, local_root, decrypt,
+                 delta=None, selective=None):
         self.swift_conn = swift_conn
         self.layout = layout
         self.local_root = local_root
         self.backup_info = backup_info
         self.decrypt = decrypt
+        self.delta = delta
+        self.selective = selective
 
     @retry()
     def fetch_partition(self, partition_name):
@@ -70,7 +92,9 @@ class BackupFetcher(object):
         with get_download_pipeline(PIPE, PIPE, self.decrypt) as pl:
             g = gevent.spawn(swift.write_and_return_error,
                              url, self.swift_conn, pl.stdin)
-            TarPartition.tarfile_extract(pl.stdout, self.local_root)
+            TarPartition.tarfile_extract(pl.stdout, self.local_root,
+                                         delta=self.delta,
+                                         selective=self.selective)
 
             # Raise any exceptions guarded by write_and_return_error.
             exc = g.get()
@@ -84,21 +108,33 @@ class BackupList(_BackupList):
         return self.conn.get_object(self.layout.store_name(), blob['name'])
 
     def _backup_list(self, prefix):
-        _, object_list = self.conn.get_container(self.layout.store_name(),
-                                                 prefix='/' + prefix)
-        return [
+        return (
             swift.SwiftKey(obj['name'], obj['bytes'], obj['last_modified'])
-            for obj in object_list
-        ]
+            for obj in swift.list_objects(self.conn, self.layout.store_name(),
+                                          '/' + prefix)
+        )
+
+    def _list_level(self, prefix):
+        return _list_level(self.conn, self.layout, prefix)
+
+    def _make_key(self, name, size, last_modified):
+        return _make_key(self.conn, self.layout, name, size, last_modified)
 
 
 class DeleteFromContext(_DeleteFromContext):
 
-    def __init__(self, wabs_conn, layout, dry_run):
-        super(DeleteFromContext, self).__init__(wabs_conn, layout, dry_run)
+    can_list_ranges = True
+
+    def __init__(self, wabs_conn, layout, dry_run, pool_size=1,
+                 catalog=None, index=None):
+        super(DeleteFromContext, self).__init__(wabs_conn, layout, dry_run,
+                                                pool_size=pool_size,
+                                                catalog=catalog,
+                                                index=index)
 
         if not dry_run:
-            self.deleter = Deleter(self.conn, self.layout.store_name())
+            self.deleter = Deleter(self.conn, self.layout.store_name(),
+                                   concurrency=pool_size)
         else:
             self.deleter = None
 
@@ -106,9 +142,33 @@ class DeleteFromContext(_DeleteFromContext):
         return self.layout.store_name()
 
     def _backup_list(self, prefix):
-        _, object_list = self.conn.get_container(self.layout.store_name(),
-                                                 prefix='/' + prefix)
-        return [
+        return (
             swift.SwiftKey(obj['name'], obj['bytes'], obj['last_modified'])
-            for obj in object_list
-        ]
+            for obj in swift.list_objects(self.conn, self.layout.store_name(),
+                                          '/' + prefix)
+        )
+
+    def _list_level(self, prefix):
+        return _list_level(self.conn, self.layout, prefix)
+
+    def _make_key(self, name, size, last_modified):
+        return _make_key(self.conn, self.layout, name, size, last_modified)
+
+    def _probe(self, prefix):
+        # Prefixes are probed concurrently, each over its own
+        # connection.
+        conn = swift.clone_connection(self.conn)
+        _, object_list = conn.get_container(self.layout.store_name(),
+                                            prefix='/' + prefix, limit=1)
+        return len(object_list) > 0
+
+    def _list_range(self, prefix, start_after, end_before):
+        # Ranges are listed concurrently too: list_objects requests
+        # pages over a copy of the connection.
+        return (
+            swift.SwiftKey(obj['name'], obj['bytes'], obj['last_modified'])
+            for obj in swift.list_objects(
+                self.conn, self.layout.store_name(), '/' + prefix,
+                marker=start_after and '/' + start_after,
+                end_marker=end_before and '/' + end_before)
+        )
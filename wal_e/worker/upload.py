@@ -1,26 +1,45 @@
+import os
 import socket
+import sys
 import tempfile
 import time
 
-import boto.exception
-
 from wal_e import log_help
 from wal_e import pipebuf
 from wal_e import pipeline
 from wal_e import storage
+from wal_e import tar_partition
 from wal_e.blobstore import get_blobstore
 from wal_e.piper import PIPE
 from wal_e.retries import retry, retry_with_count
-from wal_e.worker.worker_util import do_lzop_put, format_kib_per_second
+from wal_e.worker.push_cache import PushCache
+from wal_e.worker.worker_util import format_kib_per_second
+from wal_e.worker.worker_util import lzop_stream
+from wal_e.worker.worker_util import timed_put_file
 
 logger = log_help.WalELogger(__name__)
 
 
+def _is_request_time_skewed(typ, value):
+    """Check for S3's RequestTimeTooSkewed error
+
+    boto is only imported once an S3 store is used, so that other
+    stores and commands do not pay for it: if it has not been
+    imported, the error cannot have come from it.
+
+    """
+    boto_exception = sys.modules.get('boto.exception')
+    return (boto_exception is not None and
+            issubclass(typ, boto_exception.S3ResponseError) and
+            value.error_code == 'RequestTimeTooSkewed')
+
+
 class WalUploader(object):
-    def __init__(self, layout, creds, gpg_key_id):
+    def __init__(self, layout, creds, gpg_key_id, clear_xlog_tail=False):
         self.layout = layout
         self.creds = creds
         self.gpg_key_id = gpg_key_id
+        self.clear_xlog_tail = clear_xlog_tail
         self.blobstore = get_blobstore(layout)
 
     def __call__(self, segment):
@@ -38,9 +57,50 @@ class WalUploader(object):
                                 'prefix': self.layout.path_prefix,
                                 'state': 'begin'})
 
+        # A segment pushed again, e.g. because the previous wal-push
+        # failed after uploading it, is compressed only once, and is
+        # not uploaded again if the store already has it intact.
+        segment.uploaded_bytes = None
+        cache = PushCache(os.path.dirname(segment.path))
+        fingerprint = cache.fingerprint(segment.path,
+                                        gpg_key_id=self.gpg_key_id,
+                                        clear_xlog_tail=self.clear_xlog_tail)
+        entry = cache.lookup(segment.name, fingerprint)
+
+        if entry is not None and cache.intact(
+                entry, self.blobstore.uri_stat(self.creds, url)):
+            logger.info(msg='file is already archived, skipping upload',
+                        detail=('"{url}" matches the earlier compressed '
+                                'form of "{wal_path}".'
+                                .format(url=url, wal_path=segment.path)),
+                        structured={'action': 'push-wal',
+                                    'key': url,
+                                    'seg': segment.name,
+                                    'prefix': self.layout.path_prefix,
+                                    'state': 'skip'})
+            return segment
+
         # Upload and record the rate at which it happened.
-        kib_per_second = do_lzop_put(self.creds, url, segment.path,
-                                     self.gpg_key_id)
+        if entry is not None:
+            with open(entry['path'], 'rb') as f:
+                kib_per_second = timed_put_file(
+                    self.blobstore, self.creds, url, f)
+                segment.uploaded_bytes = os.fstat(f.fileno()).st_size
+        else:
+            # Compression output is uploaded as it is produced, and
+            # only written to the cache on the side.
+            with cache.writing(segment.name, fingerprint) as cache_fp:
+                with lzop_stream(segment.path, self.gpg_key_id,
+                                 clear_xlog_tail=self.clear_xlog_tail,
+                                 tee=cache_fp) as stream:
+                    clock_start = time.time()
+                    k = self.blobstore.uri_put_stream(self.creds, url,
+                                                      stream)
+                    clock_finish = time.time()
+
+            kib_per_second = format_kib_per_second(
+                clock_start, clock_finish, k.size)
+            segment.uploaded_bytes = k.size
 
         logger.info(msg='completed archiving to a file ',
                     detail=('Archiving to "{url}" complete at '
@@ -64,6 +124,9 @@ class PartitionUploader(object):
         self.gpg_key = gpg_key
         self.blobstore = get_blobstore(storage.StorageLayout(backup_prefix))
 
+        # Filled in as partitions finish uploading.
+        self.member_index = tar_partition.MemberIndex()
+
     def __call__(self, tpart):
         """
         Synchronous version of the upload wrapper
@@ -82,8 +145,9 @@ class PartitionUploader(object):
             tf.flush()
 
             # TODO :: Move arbitray path construction to StorageLayout Object
-            url = '{0}/tar_partitions/part_{number:08d}.tar.lzo'.format(
-                self.backup_prefix.rstrip('/'), number=tpart.name)
+            part_name = 'part_{number:08d}.tar.lzo'.format(number=tpart.name)
+            url = '{0}/tar_partitions/{1}'.format(
+                self.backup_prefix.rstrip('/'), part_name)
 
             logger.info(msg='begin uploading a base backup volume',
                         detail='Uploading to "{url}".'.format(url=url))
@@ -107,8 +171,7 @@ class PartitionUploader(object):
                         detail=standard_detail_message(
                             "The socket error's message is '{0}'."
                             .format(socketmsg)))
-                elif (issubclass(typ, boto.exception.S3ResponseError) and
-                      value.error_code == 'RequestTimeTooSkewed'):
+                elif _is_request_time_skewed(typ, value):
                     logger.info(
                         msg='Retrying send because of a Request Skew time',
                         detail=standard_detail_message())
@@ -138,4 +201,7 @@ class PartitionUploader(object):
                         '{kib_per_second}KiB/s. '
                         .format(url=url, kib_per_second=kib_per_second)))
 
+            self.member_index.add_partition(part_name, k.size,
+                                            tpart.member_entries)
+
         return tpart
@@ -1,17 +1,25 @@
+from azure import WindowsAzureMissingResourceError
+
 from wal_e import retries
 from wal_e.worker.base import _Deleter
 
 
 class Deleter(_Deleter):
 
-    def __init__(self, wabs_conn, container):
-        super(Deleter, self).__init__()
+    def __init__(self, wabs_conn, container, concurrency=1):
+        super(Deleter, self).__init__(concurrency=concurrency)
         self.wabs_conn = wabs_conn
         self.container = container
 
     @retries.retry()
     def _delete_batch(self, page):
-        # Azure Blob Service has no concept of mass-delete, so we must nuke
-        # each blob one-by-one...
+        # Azure Blob Service has no concept of mass-delete in the API
+        # version used, so we must nuke each blob one-by-one, relying
+        # on several pages being deleted at once for speed...
         for blob in page:
-            self.wabs_conn.delete_blob(self.container, blob.name)
+            try:
+                self.wabs_conn.delete_blob(self.container, blob.name)
+            except WindowsAzureMissingResourceError:
+                # Already deleted, e.g. by an earlier attempt at this
+                # page that failed part way.
+                pass
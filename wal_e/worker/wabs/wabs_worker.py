@@ -8,6 +8,8 @@ with the intention that they are used in gevent greenlets.
 import gevent
 import re
 
+from azure.storage import BlobPrefix
+
 from wal_e import log_help
 from wal_e import storage
 from wal_e.blobstore import wabs
@@ -17,11 +19,32 @@ from wal_e.retries import retry
 from wal_e.tar_partition import TarPartition
 from wal_e.worker.base import _BackupList, _DeleteFromContext
 from wal_e.worker.base import generic_weird_key_hint_message
+from wal_e.worker.catalog import CatalogKey
 from wal_e.worker.wabs.wabs_deleter import Deleter
 
 logger = log_help.WalELogger(__name__)
 
 
+def _list_level(conn, layout, prefix):
+    # Return the blobs directly under prefix, and the names of the
+    # directories under it, without listing their contents.
+    blobs = []
+    directories = []
+    for item in wabs.list_blobs(conn, layout.store_name(), '/' + prefix,
+                                delimiter='/'):
+        if isinstance(item, BlobPrefix):
+            directories.append(item.name.lstrip('/'))
+        else:
+            blobs.append(item)
+
+    return blobs, directories
+
+
+def _make_key(conn, layout, name, size, last_modified):
+    # Build a blob as listed, from a row of the catalog.
+    return CatalogKey('/' + name, size, last_modified)
+
+
 class TarPartitionLister(object):
     def __init__(self, wabs_conn, layout, backup_info):
         self.wabs_conn = wabs_conn
@@ -32,9 +55,8 @@ class TarPartitionLister(object):
         prefix = self.layout.basebackup_tar_partition_directory(
             self.backup_info)
 
-        blob_list = self.wabs_conn.list_blobs(self.layout.store_name(),
-                                              prefix='/' + prefix)
-        for blob in blob_list.blobs:
+        for blob in wabs.list_blobs(self.wabs_conn, self.layout.store_name(),
+                                    '/' + prefix):
             url = 'wabs://{container}/{name}'.format(
                 container=self.layout.store_name(), name=blob.name)
             name_last_part = blob.name.rsplit('/', 1)[-1]
@@ -50,12 +72,15 @@ class TarPartitionLister(object):
 
 
 class BackupFetcher(object):
-    def __init__(self, wabs_conn, layout, backup_info, local_root, decrypt):
+    def __init__(self, wabs_conn, layout, backup_info, local_root, decrypt,
+                 delta=None, selective=None):
         self.wabs_conn = wabs_conn
         self.layout = layout
         self.local_root = local_root
         self.backup_info = backup_info
         self.decrypt = decrypt
+        self.delta = delta
+        self.selective = selective
 
     @retry()
     def fetch_partition(self, partition_name):
@@ -73,7 +98,9 @@ class BackupFetcher(object):
         with get_download_pipeline(PIPE, PIPE, self.decrypt) as pl:
             g = gevent.spawn(wabs.write_and_return_error,
                              url, self.wabs_conn, pl.stdin)
-            TarPartition.tarfile_extract(pl.stdout, self.local_root)
+            TarPartition.tarfile_extract(pl.stdout, self.local_root,
+                                         delta=self.delta,
+                                         selective=self.selective)
 
             # Raise any exceptions from self._write_and_close
             exc = g.get()
@@ -87,18 +114,28 @@ class BackupList(_BackupList):
         return self.conn.get_blob(self.layout.store_name(), blob.name)
 
     def _backup_list(self, prefix):
-        blob_list = self.conn.list_blobs(self.layout.store_name(),
-                                         prefix='/' + prefix)
-        return blob_list.blobs
+        return wabs.list_blobs(self.conn, self.layout.store_name(),
+                               '/' + prefix)
+
+    def _list_level(self, prefix):
+        return _list_level(self.conn, self.layout, prefix)
+
+    def _make_key(self, name, size, last_modified):
+        return _make_key(self.conn, self.layout, name, size, last_modified)
 
 
 class DeleteFromContext(_DeleteFromContext):
 
-    def __init__(self, wabs_conn, layout, dry_run):
-        super(DeleteFromContext, self).__init__(wabs_conn, layout, dry_run)
+    def __init__(self, wabs_conn, layout, dry_run, pool_size=1,
+                 catalog=None, index=None):
+        super(DeleteFromContext, self).__init__(wabs_conn, layout, dry_run,
+                                                pool_size=pool_size,
+                                                catalog=catalog,
+                                                index=index)
 
         if not dry_run:
-            self.deleter = Deleter(self.conn, self.layout.store_name())
+            self.deleter = Deleter(self.conn, self.layout.store_name(),
+                                   concurrency=pool_size)
         else:
             self.deleter = None
 
@@ -106,6 +143,11 @@ class DeleteFromContext(_DeleteFromContext):
         return self.layout.store_name()
 
     def _backup_list(self, prefix):
-        blob_list = self.conn.list_blobs(self.layout.store_name(),
-                                         prefix='/' + prefix)
-        return blob_list.blobs
+        return wabs.list_blobs(self.conn, self.layout.store_name(),
+                               '/' + prefix)
+
+    def _list_level(self, prefix):
+        return _list_level(self.conn, self.layout, prefix)
+
+    def _make_key(self, name, size, last_modified):
+        return _make_key(self.conn, self.layout, name, size, last_modified)
@@ -0,0 +1,170 @@
+"""Know which WAL files are archived without asking for each
+
+During recovery, Postgres asks for many history files and segments
+that were never archived, such as the history files of timelines that
+do not exist yet, and the segment after the last one archived.
+Getting each of them costs a request only to learn that it is
+missing, and so would prefetching segments beyond the last one.
+
+The index is a local copy of the names of archived WAL files, kept in
+".wal-e/wal-index.json" next to the segments:
+
+.wal-e
+    wal-index.json
+
+It is brought up to date by listing only the keys that sort after the
+last key seen, as WAL files are named in the order they are written.
+Files archived out of that order, for instance by several wal-push
+processes at once, or by an old primary after a failover, are only
+picked up by a complete listing, which is done every RELIST_INTERVAL
+seconds.  Until then, a file sorting before the last key seen is
+only reported missing once a request for it confirms so.
+
+"""
+import errno
+import json
+import os
+import sys
+import tempfile
+import time
+import traceback
+
+from os import path
+from wal_e import log_help
+
+logger = log_help.WalELogger(__name__)
+
+# Seconds after which the complete listing is requested again.
+RELIST_INTERVAL = 60 * 60
+
+
+def wal_file_name(key_name):
+    """Return the name of the WAL file stored at key_name"""
+    name = key_name.rsplit('/', 1)[-1]
+    if name.endswith('.lzo'):
+        name = name[:-len('.lzo')]
+
+    return name
+
+
+class WalIndex(object):
+
+    def __init__(self, base, blobstore, creds, wal_uri):
+        self.index_path = path.join(base, '.wal-e', 'wal-index.json')
+        self.blobstore = blobstore
+        self.creds = creds
+        self.wal_uri = wal_uri
+
+        self.names = set()
+        self.last_key = None
+        self.listed_at = None
+        self.relisted_at = None
+
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                state = json.load(f)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        except ValueError:
+            # Start over from a damaged index.
+            return
+
+        # An index of another archive is of no use.
+        if state.get('wal_uri') != self.wal_uri:
+            return
+
+        self.names = set(state['names'])
+        self.last_key = state['last_key']
+        self.listed_at = state['listed_at']
+        self.relisted_at = state['relisted_at']
+
+    def _save(self):
+        index_dir = path.dirname(self.index_path)
+        try:
+            os.makedirs(index_dir)
+        except EnvironmentError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        with tempfile.NamedTemporaryFile(dir=index_dir, delete=False) as tf:
+            json.dump({'wal_uri': self.wal_uri,
+                       'names': sorted(self.names),
+                       'last_key': self.last_key,
+                       'listed_at': self.listed_at,
+                       'relisted_at': self.relisted_at}, tf)
+        os.rename(tf.name, self.index_path)
+
+    def refresh(self):
+        """List the keys archived since the last listing"""
+        now = time.time()
+
+        relist = (self.relisted_at is None or
+                  now - self.relisted_at > RELIST_INTERVAL)
+        if relist:
+            keys = self.blobstore.uri_list(self.creds, self.wal_uri)
+            self.names = set()
+            self.relisted_at = now
+        else:
+            keys = self.blobstore.uri_list(self.creds, self.wal_uri,
+                                           start_after=self.last_key)
+
+        for key in keys:
+            self.names.add(wal_file_name(key))
+            self.last_key = max(self.last_key, key)
+
+        self.listed_at = now
+
+        # The index holds the name of every archived file, so it is
+        # only written again when the listing found something new.
+        if relist or keys:
+            self._save()
+
+    def missing(self, name, max_age):
+        """Check if a WAL file is known not to be archived
+
+        The answer is based on a listing at most max_age seconds old.
+        If the archive cannot be listed, nothing is known to be
+        missing.
+
+        """
+        if name in self.names:
+            return False
+
+        if self.listed_at is None or time.time() - self.listed_at > max_age:
+            try:
+                self.refresh()
+            except Exception:
+                logger.warning(
+                    msg='could not list archived WAL files',
+                    detail=''.join(
+                        traceback.format_exception(*sys.exc_info())))
+                return False
+
+        if name in self.names:
+            return False
+
+        # Files after the last key seen are known to be missing, but
+        # those before it may have been archived out of order since
+        # the last complete listing.
+        if name < wal_file_name(self.last_key or ''):
+            try:
+                archived = self.blobstore.uri_stat(
+                    self.creds, self.wal_uri + name + '.lzo') is not None
+            except Exception:
+                logger.warning(
+                    msg='could not look up archived WAL file',
+                    detail=''.join(
+                        traceback.format_exception(*sys.exc_info())))
+                return False
+
+            if archived:
+                self.names.add(name)
+                self._save()
+                return False
+
+        return True
@@ -1,10 +1,14 @@
+import contextlib
+import gevent
 import tempfile
 import time
 
 from wal_e import pipebuf
 from wal_e import storage
+from wal_e import wal_compact
 from wal_e.blobstore import get_blobstore
 from wal_e import pipeline
+from wal_e.piper import PIPE
 
 
 def uri_put_file(creds, uri, fp, content_encoding=None):
@@ -13,6 +17,105 @@ def uri_put_file(creds, uri, fp, content_encoding=None):
                                   content_encoding=content_encoding)
 
 
+def lzop_compress(local_path, fp, gpg_key, clear_xlog_tail=False):
+    """
+    Compress (and possibly encrypt) a local path into a file object.
+
+    :type clear_xlog_tail: bool
+    :param clear_xlog_tail: zero the unused tail of a WAL segment
+        before compression; see wal_e.wal_compact
+
+    """
+    if clear_xlog_tail:
+        with pipeline.get_upload_pipeline(PIPE, fp, gpg_key=gpg_key) as pl:
+            wal_compact.write_cleared(local_path, pl.stdin)
+    else:
+        with pipeline.get_upload_pipeline(
+                open(local_path, 'r'), fp, gpg_key=gpg_key):
+            pass
+
+    fp.flush()
+
+
+class LzopStream(object):
+    """
+    Read the output of a compression pipeline, like a file.
+
+    The end of the stream is only reported once the pipeline has
+    finished successfully: if it failed, the final read raises
+    instead, so that uploads reading the stream are never completed
+    with truncated data.
+
+    """
+    def __init__(self, pl, feeder=None, tee=None):
+        self._pl = pl
+        self._feeder = feeder
+        self._tee = tee
+
+    def read(self, size=None):
+        data = self._pl.stdout.read(size)
+
+        if data:
+            if self._tee is not None:
+                self._tee.write(data)
+        else:
+            if self._feeder is not None:
+                self._feeder.get()
+            self._pl.finish()
+
+        return data
+
+
+def _feed_cleared(local_path, stdin):
+    try:
+        wal_compact.write_cleared(local_path, stdin)
+        stdin.flush()
+    finally:
+        stdin.close()
+
+
+@contextlib.contextmanager
+def lzop_stream(local_path, gpg_key, clear_xlog_tail=False, tee=None):
+    """
+    Compress (and possibly encrypt) a local path as an LzopStream.
+
+    Everything read from the stream is also written to tee, if given.
+
+    """
+    if clear_xlog_tail:
+        source = PIPE
+    else:
+        source = open(local_path, 'rb')
+
+    with pipeline.get_upload_pipeline(source, PIPE, gpg_key=gpg_key) as pl:
+        feeder = None
+        if clear_xlog_tail:
+            feeder = gevent.spawn(_feed_cleared, local_path, pl.stdin)
+
+        try:
+            yield LzopStream(pl, feeder=feeder, tee=tee)
+        except:
+            # Let the pipeline exit rather than block on writing
+            # output that will never be read.
+            if feeder is not None:
+                feeder.kill()
+            pl.stdout.close()
+            raise
+
+
+def timed_put_file(blobstore, creds, url, fp):
+    """
+    Upload a file object from its start, returning the KiB/s achieved.
+
+    """
+    clock_start = time.time()
+    fp.seek(0)
+    k = blobstore.uri_put_file(creds, url, fp)
+    clock_finish = time.time()
+
+    return format_kib_per_second(clock_start, clock_finish, k.size)
+
+
 def do_lzop_put(creds, url, local_path, gpg_key):
     """
     Compress and upload a given local path.
@@ -29,33 +132,21 @@ def do_lzop_put(creds, url, local_path, gpg_key):
 
     with tempfile.NamedTemporaryFile(
             mode='r+b', bufsize=pipebuf.PIPE_BUF_BYTES) as tf:
-        with pipeline.get_upload_pipeline(
-                open(local_path, 'r'), tf, gpg_key=gpg_key):
-            pass
-
-        tf.flush()
-
-        clock_start = time.time()
-        tf.seek(0)
-        k = blobstore.uri_put_file(creds, url, tf)
-        clock_finish = time.time()
-
-        kib_per_second = format_kib_per_second(
-            clock_start, clock_finish, k.size)
-
-        return kib_per_second
+        lzop_compress(local_path, tf, gpg_key)
+        return timed_put_file(blobstore, creds, url, tf)
 
 
-def do_lzop_get(creds, url, path, decrypt, do_retry=True):
+def do_lzop_get(creds, url, path, decrypt, do_retry=True, raw=False):
     """
     Get and decompress an S3 or WABS URL
 
     This streams the content directly to lzop; the compressed version
-    is never stored on disk.
+    is never stored on disk, unless raw is given.
 
     """
     blobstore = get_blobstore(storage.StorageLayout(url))
-    return blobstore.do_lzop_get(creds, url, path, decrypt, do_retry=do_retry)
+    return blobstore.do_lzop_get(creds, url, path, decrypt, do_retry=do_retry,
+                                 raw=raw)
 
 
 def format_kib_per_second(start, finish, amount_in_bytes):